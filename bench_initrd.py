@@ -0,0 +1,577 @@
+#!/usr/bin/python
+# Copyright (c) 2011 Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only. with the special
+# exception on linking described in file LICENSE.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+##
+# Benchmarks for the initrd handling in eliloader.
+#
+# Run in dom0 (eliloader needs the XenAPI and xcp modules) against a vendor
+# initrd, e.g.
+#
+#   bench_initrd.py compression /path/to/initrd.img
+#
+# compression: unpacks the initrd once, then rebuilds it with each
+#    install-initrd-compression setting, reporting the time taken to build
+#    the image, its size, and the time taken to decompress it again.  The
+#    latter two approximate the cost of loading the image into the guest:
+#    the domain builder copies the compressed bytes, and the guest kernel
+#    decompresses them.
+#
+#   bench_initrd.py decompression [--threads=<n> ...] <initrd>
+#
+# decompression: rebuilds the initrd as an uncompressed cpio archive,
+#    compresses it as tweak_initrd would (and with bzip2), then times
+#    decompressing each with the serial tools (threads = 1, the old
+#    get_decompressor path) and with the threaded ones eliloader picks for
+#    each thread budget given.  Threaded xz decompression needs xz 5.4 and an
+#    image compressed in several blocks.
+#
+#   bench_initrd.py corpus [--size=<MB> ...] [--format=<f> ...]
+#                          [--layout=small|large ...] [--corpus=<dir>]
+#                          [--output=<file>]
+#
+# corpus: generates synthetic vendor initrds for every combination of
+#    format (cpio.gz, cpio.xz, cpio.lzma, ext2.gz), layout (many small files
+#    or a few large ones) and uncompressed size (default 20 and 200 MB),
+#    each with an overlay and a fixup map entry, and times md5sum,
+#    unpack_cpio_initrd, mkcpio, mount_ext2_initrd and the whole of
+#    tweak_initrd on each.  Every step runs in a child process, so its peak
+#    RSS (including that of the tools it runs) can be measured; the peak
+#    growth in use of the filesystems holding /tmp and BOOTDIR stands for
+#    its temporary disk usage.  The corpus is deterministic, and is kept in
+#    --corpus if given so later runs skip generating it; with --output,
+#    results are appended as tab separated lines tagged with the git commit
+#    benchmarked, for comparison across commits.  mount_ext2_initrd needs
+#    root and a free loop device, and is skipped without them.
+#
+#   bench_initrd.py copy [--size=<MB>]
+#
+# copy: times copyfd against the read()-a-new-string-per-block loop it
+#    replaced, copying from one pipe to another (as when feeding a
+#    decompressor's output to cpio) and from a pipe to a file, with and
+#    without splice.
+
+import sys
+import os
+import shutil
+import getopt
+import tempfile
+import time
+import subprocess
+import random
+import zlib
+import resource
+import threading
+import traceback
+
+import eliloader
+
+default_compressions = ['none', 'gzip:1', 'gzip', 'gzip:9', 'gzip::0',
+                        'xz:0', 'xz', 'xz:6:0', 'xz:9:0']
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+def decompress_to_null(compression, filename):
+    fmt = compression.split(':')[0]
+    if fmt == 'none':
+        cmd = ["/bin/cat", filename]
+    else:
+        cmd = eliloader.decompressor_for(fmt) + [filename]
+    null = open(os.devnull, "w")
+    try:
+        subprocess.check_call(cmd, stdout = null)
+    finally:
+        null.close()
+
+def bench_compression(initrd, compressions):
+    working_dir = tempfile.mkdtemp(prefix = "bench-initrd-")
+    output_dir = tempfile.mkdtemp(prefix = "bench-output-")
+    try:
+        eliloader.unpack_cpio_initrd(initrd, working_dir)
+
+        print "%-10s %10s %10s %8s %12s" % ("setting", "build (s)", "size (MB)",
+                                            "ratio", "decomp (s)")
+        raw_size = None
+        for compression in compressions:
+            output = os.path.join(output_dir, "initrd")
+            compressor = eliloader.get_compressor(compression)
+            build = timed(eliloader.mkcpio, working_dir, output, compressor)
+            size = os.path.getsize(output)
+            if raw_size is None:
+                raw_size = size
+            load = timed(decompress_to_null, compression, output)
+            print "%-10s %10.2f %10.2f %8.2f %12.2f" % \
+                (compression, build, size / 1048576.0,
+                 float(raw_size) / size, load)
+            os.unlink(output)
+    finally:
+        shutil.rmtree(working_dir)
+        shutil.rmtree(output_dir)
+
+def bench_decompression(initrd, thread_counts):
+    working_dir = tempfile.mkdtemp(prefix = "bench-initrd-")
+    output_dir = tempfile.mkdtemp(prefix = "bench-output-")
+    budget = eliloader.helper_thread_budget
+    try:
+        eliloader.unpack_cpio_initrd(initrd, working_dir)
+        raw = os.path.join(output_dir, "initrd.cpio")
+        eliloader.mkcpio(working_dir, raw)
+        raw_mb = os.path.getsize(raw) / 1048576.0
+
+        print "%-8s %8s %-10s %10s %10s" % ("format", "threads", "tool",
+                                            "time (s)", "MB/s")
+        for fmt, compressor in [("gzip", eliloader.get_compressor("gzip")),
+                                ("xz", eliloader.get_compressor("xz")),
+                                ("bzip2", ["/usr/bin/bzip2", "-c"])]:
+            compressed = os.path.join(output_dir, "initrd." + fmt)
+            src = open(raw)
+            dest = open(compressed, "w")
+            try:
+                subprocess.check_call(compressor, stdin = src, stdout = dest)
+            finally:
+                src.close()
+                dest.close()
+
+            for threads in [1] + thread_counts:
+                eliloader.helper_thread_budget = threads
+                tool = os.path.basename(eliloader.decompressor_for(fmt)[0])
+                t = timed(decompress_to_null, fmt, compressed)
+                print "%-8s %8d %-10s %10.2f %10.1f" % (fmt, threads, tool, t, raw_mb / t)
+            os.unlink(compressed)
+    finally:
+        eliloader.helper_thread_budget = budget
+        shutil.rmtree(working_dir)
+        shutil.rmtree(output_dir)
+
+corpus_formats = ['cpio.gz', 'cpio.xz', 'cpio.lzma', 'ext2.gz']
+# size of the files in each layout
+corpus_layouts = { 'small': 16 * 1024, 'large': 8 * 1024 * 1024 }
+corpus_sizes = [20, 200]
+
+# Compressors used to build the corpus.  These are fixed, rather than
+# whatever eliloader would use, so that the corpus doesn't change from one
+# commit to the next.
+corpus_compressors = { 'gz':   ["/bin/gzip", "-c", "-6"],
+                       'xz':   ["/usr/bin/xz", "-c", "-6", "--check=crc32", "--threads=1"],
+                       'lzma': ["/usr/bin/xz", "-c", "-6", "--format=lzma"] }
+
+text = "".join(["%s: Synthetic initrd content line %d for benchmarking.\n" % (w, i)
+                for i, w in enumerate(["init", "udev", "modprobe", "anaconda", "d-i"] * 13)])
+
+def synthetic_data(seed, size):
+    """ size bytes of data, determined by seed, which compresses roughly as
+    well as the binaries in an initrd do: half of it is random. """
+    half = size / 2
+    bits = random.Random(seed).getrandbits(max(8, half * 8))
+    noise = ("%0*x" % (half * 2, bits)).decode('hex')[:half]
+    start = zlib.crc32(seed) % len(text)
+    words = (text[start:] + text * (size / len(text) + 2))[:size - half]
+    return noise + words
+
+def make_tree(root, size_mb, file_size, seed):
+    """ Fill root with size_mb of files of file_size bytes.  Returns the
+    number of files. """
+    file_size = min(file_size, size_mb * 1024 * 1024)
+    count = size_mb * 1024 * 1024 / file_size
+    for i in range(count):
+        d = os.path.join(root, "d%03d" % (i / 256))
+        if not os.path.isdir(d):
+            os.mkdir(d)
+        f = open(os.path.join(d, "f%05d" % i), "wb")
+        f.write(synthetic_data("%s/%d" % (seed, i), file_size))
+        f.close()
+    return count
+
+def compress(cmd, infile, outfile):
+    src = open(infile, "rb")
+    dest = open(outfile, "wb")
+    try:
+        subprocess.check_call(cmd, stdin = src, stdout = dest)
+    finally:
+        src.close()
+        dest.close()
+
+def archive_tree(tree, outfile):
+    names = subprocess.Popen(["find", "."], cwd = tree, stdout = subprocess.PIPE)
+    dest = open(outfile, "wb")
+    try:
+        subprocess.check_call(["/bin/cpio", "-o", "-H", "newc", "--quiet"], cwd = tree,
+                              stdin = names.stdout, stdout = dest)
+    finally:
+        dest.close()
+    names.wait()
+
+def make_ext2(tree, outfile, size_bytes, files):
+    blocks = (size_bytes * 11 / 10 + files * 4096) / 4096 + 2048
+    null = open(os.devnull, "w")
+    try:
+        subprocess.check_call(["mke2fs", "-q", "-F", "-t", "ext2", "-b", "4096",
+                               "-N", str(files + 1024), "-d", tree, outfile, str(blocks)],
+                              stdout = null)
+    finally:
+        null.close()
+
+def make_image(corpus_dir, fmt, layout, size_mb):
+    """ Build (or find already built) the corpus image for fmt, layout and
+    size_mb.  Returns its path, its number of files, and the size of its
+    content in bytes. """
+    name = "initrd-%s-%dM.%s" % (layout, size_mb, fmt)
+    path = os.path.join(corpus_dir, name)
+    info = path + ".info"
+    if os.path.exists(path) and os.path.exists(info):
+        files, size = [int(f) for f in open(info).read().split()]
+        return path, files, size
+
+    print >> sys.stderr, "Generating %s..." % name
+    tree = tempfile.mkdtemp(prefix = "bench-tree-")
+    raw = path + ".raw"
+    try:
+        files = make_tree(tree, size_mb, corpus_layouts[layout], name)
+        size = size_mb * 1024 * 1024
+        container, compression = fmt.split(".")
+        if container == "cpio":
+            archive_tree(tree, raw)
+        else:
+            make_ext2(tree, raw, size, files)
+        compress(corpus_compressors[compression], raw, path)
+    finally:
+        shutil.rmtree(tree)
+        if os.path.exists(raw):
+            os.unlink(raw)
+
+    f = open(info, "w")
+    f.write("%d %d\n" % (files, size))
+    f.close()
+    return path, files, size
+
+def make_overlay(corpus_dir):
+    path = os.path.join(corpus_dir, "overlay.cpio")
+    if not os.path.exists(path):
+        tree = tempfile.mkdtemp(prefix = "bench-overlay-")
+        try:
+            os.makedirs(os.path.join(tree, "etc"))
+            f = open(os.path.join(tree, "etc", "bench-overlay"), "w")
+            f.write(synthetic_data("overlay", 64 * 1024))
+            f.close()
+            archive_tree(tree, path)
+        finally:
+            shutil.rmtree(tree)
+    return path
+
+def fs_used(path):
+    st = os.statvfs(path)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+class DiskSampler(threading.Thread):
+    """ Track the peak growth in use of the filesystems holding paths. """
+    def __init__(self, paths):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.paths = []
+        devs = []
+        for p in paths:
+            if os.stat(p).st_dev not in devs:
+                devs.append(os.stat(p).st_dev)
+                self.paths.append(p)
+        self.base = [fs_used(p) for p in self.paths]
+        self.peak = 0
+        self.done = threading.Event()
+    def sample(self):
+        used = sum([fs_used(p) - b for p, b in zip(self.paths, self.base)])
+        self.peak = max(self.peak, used)
+    def run(self):
+        while not self.done.isSet():
+            self.sample()
+            self.done.wait(0.05)
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.sample()
+
+class StepFailed(Exception):
+    pass
+
+def measure(fn, *args):
+    """ Run fn(*args) in a child process.  Returns the seconds it took, the
+    peak RSS in MB of the child and the tools it ran, and the peak growth
+    in MB of temporary disk usage. """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        rc = 1
+        try:
+            try:
+                sampler = DiskSampler(["/tmp", eliloader.BOOTDIR])
+                sampler.start()
+                start = time.time()
+                fn(*args)
+                elapsed = time.time() - start
+                sampler.stop()
+                os.write(w, "%f %d" % (elapsed, sampler.peak))
+                rc = 0
+            except:
+                traceback.print_exc()
+        finally:
+            os._exit(rc)
+
+    os.close(w)
+    data = ""
+    while True:
+        block = os.read(r, 4096)
+        if not block:
+            break
+        data += block
+    os.close(r)
+    _, status, usage = os.wait4(pid, 0)
+    if status != 0 or not data:
+        raise StepFailed
+    elapsed, disk = data.split()
+    return float(elapsed), usage.ru_maxrss / 1024.0, int(disk) / 1048576.0
+
+def git_commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        p = subprocess.Popen(["git", "rev-parse", "--short", "HEAD"], cwd = here,
+                             stdout = subprocess.PIPE, stderr = open(os.devnull, "w"))
+        commit = p.communicate()[0].strip()
+        if p.returncode != 0 or not commit:
+            return "unknown"
+        if subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd = here) != 0:
+            commit += "-dirty"
+        return commit
+    except OSError:
+        return "unknown"
+
+def corpus_steps(image, fmt, scratch):
+    """ Return the (name, function, arguments) of the steps to time on
+    image. """
+    def unpack():
+        d = tempfile.mkdtemp(dir = scratch)
+        eliloader.unpack_cpio_initrd(image, d)
+
+    def repack(tree):
+        eliloader.mkcpio(tree, os.path.join(scratch, "repacked"),
+                         eliloader.get_compressor(fmt == "cpio.xz" and "xz" or "gzip"))
+
+    def mount_ext2():
+        d = tempfile.mkdtemp(dir = scratch)
+        eliloader.mount_ext2_initrd(image, os.path.join(scratch, "ext2"), d)
+        eliloader.umount(d)
+
+    def tweak():
+        eliloader.verified_digests.clear()
+        eliloader.tweak_initrd(image, fmt == "cpio.xz" and "xz" or "gzip")
+
+    steps = [("md5sum", eliloader.md5sum, (image,))]
+    if fmt.startswith("cpio."):
+        steps += [("unpack_cpio_initrd", unpack, ()),
+                  ("mkcpio", repack, None)]
+    else:
+        steps += [("mount_ext2_initrd", mount_ext2, ())]
+    steps.append(("tweak_initrd", tweak, ()))
+    return steps
+
+def bench_corpus(corpus_dir, formats, layouts, sizes, output):
+    keep = corpus_dir is not None
+    if not keep:
+        corpus_dir = tempfile.mkdtemp(prefix = "bench-corpus-")
+    elif not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+
+    commit = git_commit()
+    when = time.strftime("%Y-%m-%dT%H:%M:%S")
+    results = output and open(output, "a")
+
+    boot_dir = tempfile.mkdtemp(prefix = "bench-boot-")
+    cache_dir = tempfile.mkdtemp(prefix = "bench-cache-")
+    eliloader.BOOTDIR = boot_dir
+    eliloader.TWEAKED_CACHE = cache_dir
+    eliloader.guest_installer_dir = corpus_dir
+    overlay = os.path.basename(make_overlay(corpus_dir))
+
+    print "commit %s" % commit
+    print "%-26s %-18s %8s %8s %9s %8s %8s" % ("image", "step", "time (s)", "MB/s",
+                                               "files/s", "RSS (MB)", "tmp (MB)")
+    try:
+        for fmt in formats:
+            for layout in layouts:
+                for size_mb in sizes:
+                    image, files, size = make_image(corpus_dir, fmt, layout, size_mb)
+                    digest = eliloader.md5sum(image)
+                    if fmt.startswith("cpio."):
+                        eliloader.cpio_initrd_fixups[digest] = overlay
+                    else:
+                        eliloader.ext2_initrd_fixups[digest] = overlay
+
+                    for step, fn, args in corpus_steps(image, fmt, boot_dir):
+                        tree = None
+                        if args is None:
+                            # mkcpio needs a tree to archive, unpacked untimed
+                            tree = tempfile.mkdtemp(prefix = "bench-tree-")
+                            eliloader.unpack_cpio_initrd(image, tree)
+                            args = (tree,)
+                        try:
+                            try:
+                                t, rss, disk = measure(fn, *args)
+                            except StepFailed:
+                                print "%-26s %-18s %s" % (os.path.basename(image), step,
+                                                          "failed/skipped")
+                                continue
+                        finally:
+                            if tree:
+                                shutil.rmtree(tree)
+                            for d in [boot_dir, cache_dir]:
+                                for name in os.listdir(d):
+                                    p = os.path.join(d, name)
+                                    if os.path.isdir(p):
+                                        subprocess.call(["umount", p], stderr = open(os.devnull, "w"))
+                                        shutil.rmtree(p, True)
+                                    else:
+                                        os.unlink(p)
+
+                        mbps = size / 1048576.0 / t
+                        fps = files / t
+                        print "%-26s %-18s %8.2f %8.1f %9.0f %8.1f %8.1f" % \
+                            (os.path.basename(image), step, t, mbps, fps, rss, disk)
+                        if results:
+                            results.write("\t".join([commit, when, fmt, layout, str(size_mb),
+                                                     str(files), step, "%.3f" % t, "%.2f" % mbps,
+                                                     "%.1f" % fps, "%.1f" % rss,
+                                                     "%.1f" % disk]) + "\n")
+                            results.flush()
+    finally:
+        shutil.rmtree(boot_dir, True)
+        shutil.rmtree(cache_dir, True)
+        if not keep:
+            shutil.rmtree(corpus_dir)
+        if results:
+            results.close()
+
+def legacy_copyfd(fromfd, tofd, limit):
+    # copyfd as it was before it reused its buffer
+    bytes_so_far = 0
+
+    while bytes_so_far <= limit:
+        block = fromfd.read(eliloader.copy_block_size)
+        l = len(block)
+
+        if l == 0:
+            break
+
+        bytes_so_far += l
+        tofd.write(block)
+    else:
+        return bytes_so_far, False
+
+    return bytes_so_far, True
+
+def copy_through_pipes(copy, source, to_file):
+    src = subprocess.Popen(["/bin/cat", source], stdout = subprocess.PIPE)
+    if to_file:
+        sink = None
+        dest = tempfile.TemporaryFile()
+    else:
+        sink = subprocess.Popen(["/bin/cat"], stdin = subprocess.PIPE,
+                                stdout = open(os.devnull, "w"))
+        dest = sink.stdin
+    copy(src.stdout, dest, 1 << 40)
+    dest.close()
+    src.wait()
+    if sink:
+        sink.wait()
+
+def bench_copy(size_mb):
+    source = tempfile.NamedTemporaryFile(prefix = "bench-copy-")
+    block = os.urandom(1024 * 1024)
+    for _ in range(size_mb):
+        source.write(block)
+    source.flush()
+
+    splice = eliloader.libc_splice
+    def no_splice(fromfd, tofd, limit):
+        eliloader.libc_splice = None
+        try:
+            return eliloader.copyfd(fromfd, tofd, limit)
+        finally:
+            eliloader.libc_splice = splice
+
+    engines = [("legacy", legacy_copyfd), ("readinto", no_splice)]
+    if splice is not None:
+        engines.append(("splice", eliloader.copyfd))
+
+    print "%-10s %-12s %10s %10s" % ("engine", "dest", "time (s)", "MB/s")
+    try:
+        for to_file, dest in [(False, "pipe"), (True, "file")]:
+            for name, copy in engines:
+                t = timed(copy_through_pipes, copy, source.name, to_file)
+                print "%-10s %-12s %10.3f %10.1f" % (name, dest, t, size_mb / t)
+    finally:
+        source.close()
+
+def usage():
+    print >> sys.stderr, "Usage: bench_initrd.py compression [--setting=<s> ...] <initrd>"
+    print >> sys.stderr, "       bench_initrd.py decompression [--threads=<n> ...] <initrd>"
+    print >> sys.stderr, "       bench_initrd.py corpus [--size=<MB> ...] [--format=<f> ...] " \
+        "[--layout=small|large ...] [--corpus=<dir>] [--output=<file>]"
+    print >> sys.stderr, "       bench_initrd.py copy [--size=<MB>]"
+    return 2
+
+def main():
+    if len(sys.argv) < 2:
+        return usage()
+    bench = sys.argv[1]
+
+    try:
+        opts, args = getopt.getopt(sys.argv[2:], "", ["setting=", "size=", "threads=",
+                                                        "format=", "layout=", "corpus=",
+                                                        "output="])
+    except getopt.GetoptError:
+        return usage()
+
+    settings = [val for opt, val in opts if opt == "--setting"]
+    thread_counts = [int(val) for opt, val in opts if opt == "--threads"]
+    sizes = [int(val) for opt, val in opts if opt == "--size"]
+    formats = [val for opt, val in opts if opt == "--format"]
+    layouts = [val for opt, val in opts if opt == "--layout"]
+    corpus_dir = None
+    output = None
+    for opt, val in opts:
+        if opt == "--corpus":
+            corpus_dir = val
+        if opt == "--output":
+            output = val
+    for f in formats:
+        if f not in corpus_formats:
+            return usage()
+    for l in layouts:
+        if not corpus_layouts.has_key(l):
+            return usage()
+
+    if bench == "compression" and len(args) == 1:
+        bench_compression(args[0], settings or default_compressions)
+    elif bench == "decompression" and len(args) == 1:
+        bench_decompression(args[0], thread_counts or [eliloader.helper_threads()])
+    elif bench == "corpus" and len(args) == 0:
+        bench_corpus(corpus_dir, formats or corpus_formats,
+                     layouts or sorted(corpus_layouts.keys()), sizes or corpus_sizes, output)
+    elif bench == "copy" and len(args) == 0:
+        bench_copy((sizes or [256])[0])
+    else:
+        return usage()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
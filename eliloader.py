@@ -23,6 +23,23 @@
 #    'nfs'.  Should be specified as would be used by the target installer, not
 #    including prefixes, e.g. method=.
 #
+# install-mirrors:  Default: empty.  Space or comma separated list of http or
+#    ftp repositories with the same content as install-repository.  Boot
+#    files are fetched from whichever has been fastest, with duplicate
+#    requests sent to the others when it is slow to respond.  The installer
+#    itself is still pointed at install-repository.
+#
+# install-cache-proxy:  Default: empty.  Read from the pool's other-config
+#    only.  host:port, where host is an IP address of dom0's that guests can
+#    reach.  A caching HTTP proxy is started there if one isn't already
+#    running, and http installers are told to fetch through it, so that VMs
+#    installing the same distro share each package download.
+#
+# install-shared-cache:  Default: empty.  Read from the pool's other-config
+#    only.  A directory on storage mounted by every host in the pool, under
+#    one of shared_cache_roots, used to share downloaded kernels and initrds
+#    between hosts.
+#
 # install-vnc:  Default: false.  Use VNC where available during the
 #    installation.
 #
@@ -36,11 +53,25 @@
 #    supported values are 'rhlike', 'sleslike', and 'debianlike'.
 #
 # install-arch:  Default: i386.  The architecture to install.
+#
+# install-initrd-compression:  Default: none.  Compression applied to initrds
+#    rebuilt from cpio archives by tweak_initrd.  One of 'none', 'gzip' or
+#    'xz', optionally followed by ':<level>' and ':<threads>', e.g. 'xz:6:1'.
+#    By default (or with 0 threads) compression uses as many threads as
+#    helper_thread_budget allows, normally one per dom0 CPU.  The guest
+#    kernel must be able to decompress the chosen format.
+#
+# install-initrd-pipeline:  Default: auto.  Whether to unpack a ramdisk we
+#    have fixups for while it is still downloading.  'auto' does so when the
+#    repository publishes an MD5 naming a known initrd, 'true' always does so
+#    speculatively (at the cost of unpacking initrds that turn out not to need
+#    tweaking), and 'false' never does.
 
 import sys
 import subprocess
 import os
 import os.path
+import stat
 import shutil
 import getopt
 import tempfile
@@ -49,15 +80,46 @@ import traceback
 import logging
 import re
 import itertools
+import hashlib
+import ConfigParser
+import StringIO
+import mmap
+import struct
+import zlib
+import errno
+import threading
+import thread
+import signal
+import time
+import Queue
+import urlparse
+import socket
+import BaseHTTPServer
+import SocketServer
+import fcntl
+import gc
+import resource
+import cProfile
+import ctypes
 import XenAPI
-import xcp.cmd
 import xcp.logger
 from xen.lowlevel import xs
 
 sys.path.append("/usr/lib/python")
 
+# pygrub's modules, for reading the installed system's disk ourselves
+try:
+    import fsimage
+    import grub.GrubConf
+except ImportError:
+    fsimage = grub = None
+
 BOOTDIR = "/var/run/xend/boot"
 PYGRUB = "/usr/bin/pygrub"
+PIGZ = "/usr/bin/pigz"
+XZ = "/usr/bin/xz"
+LBZIP2 = "/usr/bin/lbzip2"
+DEBUGFS = "/sbin/debugfs"
 DEBUG_SWITCH = "/var/run/nonpersistent/linux-guest-loader.debug"
 PROGRAM_NAME = "eliloader"
 
@@ -131,6 +193,15 @@ for f in mapfiles:
 pv_kernel_max_size =  32 * 1024 * 1024
 pv_initrd_max_size = 128 * 1024 * 1024
 copy_block_size    =   1 * 1024 * 1024
+# copyfd starts with blocks this small, and doubles them up to copy_block_size
+# for as long as the source keeps filling them.
+copy_block_min     =  64 * 1024
+
+# Number of times a download is attempted when it arrives truncated or does
+# not match the checksum published by the repository.
+fetch_attempts = 3
+# Largest repository checksum file (.treeinfo, SHA256SUMS, ...) we will read.
+repo_metadata_max_size = 1 * 1024 * 1024
 
 #### EXCEPTIONS
 
@@ -164,6 +235,209 @@ class ResourceAccessError(Exception):
 class MountFailureException(Exception):
     pass
 
+class Ext2PatchError(Exception):
+    pass
+
+class OutOfReach(Exception):
+    pass
+
+class TransferError(IOError):
+    pass
+
+class DigestMismatch(TransferError):
+    pass
+
+class StepTimeout(APILevelException):
+    exname = "TIMEOUT"
+
+##### PROCESS RUNNER
+#
+# Every helper process runs under a Watchdog, which kills it if it is still
+# running step_deadlines[step] seconds after it was started.  The step then
+# fails with StepTimeout, which unwinds through the usual cleanup of
+# temporary files and mounts, so that a hung NFS server or a pygrub wedged
+# on a damaged disk fails the VM start rather than holding it forever.
+# Commands run by run_command get a process group of their own, which is
+# killed as a whole (mount leaves the work to mount.nfs, for instance), and
+# are abandoned if they haven't gone kill_grace seconds later, e.g. when
+# stuck in the kernel.  boot_deadline bounds the whole of a boot: when it
+# expires every helper still running is killed and the main thread is
+# interrupted.  The interrupt waits while the main thread is between
+# enter_critical and leave_critical, rewriting a state file or renaming an
+# entry into a cache, so that none is left half written; it is raised by
+# leave_critical instead.
+#
+# Steps which don't depend on each other can be overlapped with start_step.
+
+step_deadlines = { 'mount': 90, 'umount': 30, 'pygrub': 120, 'debugfs': 120,
+                   'md5sum': 120, 'unpack': 300, 'pack': 300 }
+boot_deadline = 900
+kill_grace = 5
+
+watchdogs = []
+watchdogs_lock = threading.Lock()
+boot_timer = None
+boot_cancelled = False
+boot_sigint = None
+
+main_thread = thread.get_ident()
+critical_depth = 0
+interrupt_pending = False
+
+class Watchdog:
+    """ Kill procs, a list of Popen objects, if step hasn't finished within
+    its deadline.  stop() raises StepTimeout if they had to be killed. """
+
+    def __init__(self, step, procs = [], groups = False):
+        self.step = step
+        self.procs = list(procs)
+        self.groups = groups
+        self.expired = False
+        self.deadline = step_deadlines.get(step, boot_deadline)
+        self.timer = threading.Timer(self.deadline, self.expire)
+        self.timer.setDaemon(True)
+        watchdogs_lock.acquire()
+        try:
+            watchdogs.append(self)
+        finally:
+            watchdogs_lock.release()
+        self.timer.start()
+
+    def add(self, proc):
+        self.procs.append(proc)
+
+    def expire(self):
+        xcp.logger.debug("%s did not finish within %d seconds, killing it" %
+                         (self.step, self.deadline))
+        self.expired = True
+        self.kill()
+
+    def kill(self):
+        for p in self.procs:
+            if p.returncode is not None:
+                continue
+            try:
+                if self.groups:
+                    os.killpg(p.pid, signal.SIGKILL)
+                else:
+                    os.kill(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def cancel(self):
+        self.timer.cancel()
+        watchdogs_lock.acquire()
+        try:
+            if self in watchdogs:
+                watchdogs.remove(self)
+        finally:
+            watchdogs_lock.release()
+
+    def stop(self):
+        self.cancel()
+        if self.expired:
+            raise StepTimeout("%s did not finish within %d seconds" %
+                              (self.step, self.deadline))
+
+class Step:
+    """ A call of fn(*args) in a thread of its own. """
+
+    def __init__(self, fn, args):
+        self.name = fn.__name__
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target = self.run, args = (fn, args))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self, fn, args):
+        try:
+            self.value = fn(*args)
+        except:
+            self.error = sys.exc_info()
+
+    def result(self, timeout = None):
+        """ Wait for the call to return and return what it returned, or raise
+        what it raised.  Raises StepTimeout if it is still running after
+        timeout seconds. """
+        self.thread.join(timeout)
+        if self.thread.isAlive():
+            raise StepTimeout("Gave up waiting for %s after %d seconds" %
+                              (self.name, timeout))
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+def start_step(fn, *args):
+    """ Start calling fn(*args) in the background, returning a Step. """
+    return Step(fn, args)
+
+def run_command(cmd, step):
+    """ Run cmd within the deadline of step, returning its exit status and
+    what it wrote to stdout and stderr. """
+    xcp.logger.debug("Running %s" % " ".join(cmd))
+    def preexec():
+        os.setpgrp()
+        helper_preexec()
+    p = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                         close_fds = True, preexec_fn = preexec)
+    watchdog = Watchdog(step, [p], groups = True)
+    try:
+        out, err = start_step(p.communicate).result(watchdog.deadline + kill_grace)
+    finally:
+        watchdog.stop()
+    return p.returncode, out, err
+
+def cancel_boot():
+    global boot_cancelled
+    xcp.logger.debug("Boot did not finish within %d seconds, cancelling it" % boot_deadline)
+    boot_cancelled = True
+    watchdogs_lock.acquire()
+    try:
+        for w in watchdogs:
+            w.kill()
+    finally:
+        watchdogs_lock.release()
+    thread.interrupt_main()
+
+def enter_critical():
+    """ Hold off the boot deadline's interrupt until leave_critical. """
+    global critical_depth
+    if thread.get_ident() == main_thread:
+        critical_depth += 1
+
+def leave_critical():
+    global critical_depth, interrupt_pending
+    if thread.get_ident() != main_thread:
+        return
+    critical_depth -= 1
+    if critical_depth == 0 and interrupt_pending:
+        interrupt_pending = False
+        raise KeyboardInterrupt
+
+def boot_interrupt(signum, frame):
+    """ SIGINT handler, which interrupt_main also calls, during a boot. """
+    global interrupt_pending
+    if critical_depth > 0:
+        interrupt_pending = True
+        return
+    raise KeyboardInterrupt
+
+def start_boot_deadline():
+    global boot_timer, boot_sigint
+    boot_sigint = signal.signal(signal.SIGINT, boot_interrupt)
+    boot_timer = threading.Timer(boot_deadline, cancel_boot)
+    boot_timer.setDaemon(True)
+    boot_timer.start()
+
+def stop_boot_deadline():
+    global boot_sigint
+    if boot_timer is not None:
+        boot_timer.cancel()
+    if boot_sigint is not None:
+        signal.signal(signal.SIGINT, boot_sigint)
+        boot_sigint = None
+
 ##### UTILITY FUNCTIONS
 
 def mount(dev, mountpoint, options = None, fstype = None):
@@ -182,38 +456,677 @@ def mount(dev, mountpoint, options = None, fstype = None):
     cmd.append(dev)
     cmd.append(mountpoint)
 
-    rc = xcp.cmd.runCmd(cmd, False, False)
+    try:
+        rc, _, _ = run_command(cmd, 'mount')
+    except StepTimeout, e:
+        raise MountFailureException, "%s: %s" % (cmd, e)
     if rc != 0:
         raise MountFailureException, cmd
 
 def umount(mountpoint):
-    xcp.cmd.runCmd(["umount", mountpoint])
+    try:
+        run_command(["umount", mountpoint], 'umount')
+    except StepTimeout:
+        # detach it now and leave the kernel to finish when it can
+        run_command(["umount", "-l", mountpoint], 'umount')
+
+# Leading bytes of the compression formats kernels and initrds are shipped in,
+# and the commands that will decompress them to stdout.
+compression_formats = [
+    ("\037\213",           "gzip",  ["/bin/zcat"]),
+    ("\3757zXZ\000",       "xz",    ["/usr/bin/xzcat"]),
+    ("\x5d\x00",           "lzma",  ["/usr/bin/xzcat", "--format=lzma"]),
+    ("BZh",                "bzip2", ["/usr/bin/bzcat"]),
+    ]
+
+# Threads a helper such as pigz or xz may use.  0 means one per CPU online
+# in dom0.
+helper_thread_budget = 0
+
+def helper_threads():
+    threads = helper_thread_budget
+    if threads <= 0:
+        try:
+            threads = os.sysconf('SC_NPROCESSORS_ONLN')
+        except (ValueError, OSError):
+            threads = 1
+    return max(1, threads)
+
+def sniff_compression(header):
+    for magic, name, _ in compression_formats:
+        if header.startswith(magic):
+            return name
+    return None
+
+def decompressor_for(name):
+    """ Return the command to decompress stdin (or a file named after it) of
+    compression format name, using several threads where the format and the
+    tools in dom0 allow: pigz reads, inflates and checks in separate threads,
+    xz 5.4 and later decodes the blocks of multi-block files in parallel (and
+    ignores --threads when decompressing before that), and lbzip2 works on
+    bzip2 blocks in parallel.  lzma streams can only be decoded serially. """
+    threads = helper_threads()
+    if threads > 1:
+        if name == "gzip" and os.path.exists(PIGZ):
+            return [PIGZ, "-dc", "-p", "%d" % threads]
+        if name == "xz" and os.path.exists(XZ):
+            return [XZ, "-dc", "--threads=%d" % threads]
+        if name == "bzip2" and os.path.exists(LBZIP2):
+            return [LBZIP2, "-dc", "-n", "%d" % threads]
+
+    for _, n, prog in compression_formats:
+        if n == name:
+            return prog
+    return None
 
 def get_decompressor(filename):
     archive = open(filename)
-    header = archive.read(2)
+    header = archive.read(6)
     archive.close()
 
-    if header == "\037\213": # Gzip compressed
-        return ["/bin/zcat"]
-    elif header == "\x5d\x00": # Lzma compressed
-        return ["/usr/bin/xzcat", "--format=lzma"]
-    else: # Assume uncompressed
+    # None if uncompressed
+    return decompressor_for(sniff_compression(header))
+
+##### RESOURCE BUDGET
+#
+# A storm of first boots, each unpacking and repacking an initrd, can starve
+# xapi and the rest of the toolstack.  So before doing that sort of work,
+# eliloader moves itself, and with it every helper it goes on to spawn, into
+# a cgroup of its own, run-<pid>, under the cgroup helper_cgroup shared by
+# every run.  The shared cgroup gets helper_cpu_weight and helper_io_weight
+# against the default of 100, and at most helper_cpu_max CPUs if that is
+# set, between all the runs in it.  Each run gets helper_memory_max bytes of
+# memory to itself, which counts the files it unpacks in a tmpfs /tmp, so
+# that concurrent runs can't push each other into the OOM killer.  Daemons
+# it starts are put back where it was.
+#
+# We only ever create cgroups below ones that are already ours to manage, and
+# change nothing above them.  With cgroup v1, helper_cgroup goes under the
+# cgroup eliloader was started in.  With cgroup v2, a cgroup holding
+# processes can't hand controllers down to its children, so it goes under
+# helper_cgroup_delegate, a subtree delegated to us (e.g. a systemd slice with
+# Delegate=yes) which must already enable the cpu, io and memory controllers
+# for its children; without one there is no cgroup budget.
+#
+# Whether or not a cgroup could be set up, the helpers themselves (not
+# eliloader, which goes on talking to xapi) run at helper_nice and
+# helper_ioprio.
+#
+# The time the run spent stalled, and the time all runs spent throttled, is
+# logged when it finishes, and the run's cgroup removed.  Those of runs that
+# died are removed by the next run.
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+helper_cgroup = "linux-guest-loader"
+helper_cgroup_delegate = None
+helper_cpu_weight = 20
+helper_io_weight = 20
+helper_cpu_max = None
+helper_memory_max = 2 * 1024 * 1024 * 1024
+helper_nice = 10
+helper_ioprio = 7
+
+ioprio_set_syscalls = { 'x86_64': 251, 'i386': 289, 'i686': 289 }
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_BE = 2
+
+# (cgroup directories joined, cgroup.procs files left, statistics at entry)
+budget = None
+
+def write_cgroup(dir, name, value):
+    try:
+        fd = open(os.path.join(dir, name), "w")
+        try:
+            fd.write(value)
+        finally:
+            fd.close()
+        return True
+    except IOError, e:
+        xcp.logger.debug("Cannot set %s/%s to %s: %s" % (dir, name, value, e))
+        return False
+
+def own_cgroups():
+    """ Return a dictionary mapping each hierarchy this process is in (a v1
+    controller, or '' for v2) to its cgroup's path there. """
+    rc = {}
+    try:
+        for line in open("/proc/self/cgroup"):
+            fields = line.rstrip("\n").split(":", 2)
+            if len(fields) == 3:
+                for controller in fields[1].split(","):
+                    rc[controller] = fields[2]
+    except IOError:
+        pass
+    return rc
+
+def delegated_cgroup(controllers):
+    """ Return the directory of helper_cgroup_delegate if it hands all of
+    controllers down to its children, otherwise None. """
+    if not helper_cgroup_delegate:
+        xcp.logger.debug("No delegated cgroup to run within")
         return None
+    base = os.path.join(CGROUP_ROOT, helper_cgroup_delegate.strip("/"))
+    try:
+        enabled = open(os.path.join(base, "cgroup.subtree_control")).read().split()
+    except IOError, e:
+        xcp.logger.debug("Cannot use delegated cgroup %s: %s" % (base, e))
+        return None
+    missing = [c for c in controllers if c not in enabled]
+    if missing:
+        xcp.logger.debug("Delegated cgroup %s doesn't enable %s" % (base, " ".join(missing)))
+        return None
+    return base
+
+def join_cgroup(base, shared, own):
+    """ Create helper_cgroup under base if need be, and a cgroup for this run
+    under that, apply settings to each (lists of file name and value pairs)
+    and move this process into the run's.  Returns its directory, or None. """
+    parent = os.path.join(base, helper_cgroup)
+    dir = os.path.join(parent, "run-%d" % os.getpid())
+    try:
+        if not os.path.isdir(parent):
+            os.mkdir(parent)
+        for name in os.listdir(parent):
+            if name.startswith("run-"):
+                try:
+                    # only succeeds once a run's processes have all gone
+                    os.rmdir(os.path.join(parent, name))
+                except OSError:
+                    pass
+        for name, value in shared:
+            write_cgroup(parent, name, value)
+        os.mkdir(dir)
+    except OSError, e:
+        xcp.logger.debug("Cannot create cgroup %s: %s" % (dir, e))
+        return None
+    for name, value in own:
+        write_cgroup(dir, name, value)
+    if not write_cgroup(dir, "cgroup.procs", str(os.getpid())):
+        remove_cgroup(dir)
+        return None
+    return dir
+
+def remove_cgroup(dir):
+    try:
+        os.rmdir(dir)
+    except OSError, e:
+        xcp.logger.debug("Cannot remove cgroup %s: %s" % (dir, e))
+
+def enter_cgroups():
+    """ Move this process into a cgroup of its own under helper_cgroup.
+    Returns the directories joined and the cgroup.procs files of the
+    cgroups left. """
+    joined = []
+    left = []
+    own = own_cgroups()
+
+    if os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+        controllers = ["cpu", "io", "memory"]
+        base = delegated_cgroup(controllers)
+        if base is None:
+            return joined, left
+        # the runs' cgroups need the controllers too, for memory.max
+        shared = [("cgroup.subtree_control", "+" + c) for c in controllers] + \
+                 [("cpu.weight", str(helper_cpu_weight)),
+                  ("io.weight", "default %d" % helper_io_weight)]
+        if helper_cpu_max:
+            shared.append(("cpu.max", "%d 100000" % (helper_cpu_max * 100000)))
+        run = []
+        if helper_memory_max:
+            run.append(("memory.max", str(helper_memory_max)))
+        hierarchies = [(CGROUP_ROOT, base, '', shared, run)]
+    else:
+        def under_own(controller):
+            return os.path.join(CGROUP_ROOT, controller, own.get(controller, "").lstrip("/"))
+        hierarchies = [
+            (os.path.join(CGROUP_ROOT, "cpu"), under_own("cpu"), "cpu",
+             [("cpu.shares", str(max(2, helper_cpu_weight * 1024 / 100)))] +
+             (helper_cpu_max and [("cpu.cfs_quota_us", str(int(helper_cpu_max * 100000)))] or []),
+             []),
+            (os.path.join(CGROUP_ROOT, "blkio"), under_own("blkio"), "blkio",
+             [("blkio.weight", str(min(1000, max(10, helper_io_weight * 5))))], []),
+            (os.path.join(CGROUP_ROOT, "memory"), under_own("memory"), "memory", [],
+             helper_memory_max and [("memory.limit_in_bytes", str(helper_memory_max))] or []) ]
+
+    for root, base, controller, shared, run in hierarchies:
+        if not os.path.isdir(base) or not own.has_key(controller):
+            continue
+        dir = join_cgroup(base, shared, run)
+        if dir:
+            joined.append(dir)
+            left.append(os.path.join(root, own[controller].lstrip("/"), "cgroup.procs"))
+    return joined, left
+
+def set_ioprio(prio):
+    nr = ioprio_set_syscalls.get(os.uname()[4])
+    if nr is None:
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno = True)
+        return libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, prio) == 0
+    except (OSError, AttributeError):
+        return False
+
+def budget_stats(dirs):
+    """ Return microseconds spent stalled on CPU, IO and memory by the
+    cgroups dirs, throttled by the cgroups shared by all runs above them, and
+    waiting for a CPU by this process. """
+    stats = { 'throttled': 0, 'cpu': 0, 'io': 0, 'memory': 0, 'waiting': 0 }
+    for dir in dirs:
+        try:
+            for line in open(os.path.join(os.path.dirname(dir), "cpu.stat")):
+                fields = line.split()
+                if fields[0] == "throttled_usec":
+                    stats['throttled'] += int(fields[1])
+                elif fields[0] == "throttled_time":
+                    stats['throttled'] += int(fields[1]) / 1000
+        except (IOError, IndexError, ValueError):
+            pass
+        for kind in ['cpu', 'io', 'memory']:
+            try:
+                for line in open(os.path.join(dir, kind + ".pressure")):
+                    if line.startswith("some "):
+                        stats[kind] += int(line.split("total=")[1])
+            except (IOError, IndexError, ValueError):
+                pass
+    try:
+        stats['waiting'] = int(open("/proc/self/schedstat").read().split()[1]) / 1000
+    except (IOError, IndexError, ValueError):
+        pass
+    return stats
+
+def enter_budget():
+    """ Run this process, and any helpers it starts from now on, within the
+    resource budget above. """
+    global budget
+    if budget is not None:
+        return
+    joined, left = [], []
+    if helper_cgroup:
+        joined, left = enter_cgroups()
+    budget = (joined, left, budget_stats(joined))
+    xcp.logger.debug("Running within the resource budget of %s" %
+                     (joined and ", ".join(joined) or "helpers' nice and IO priority"))
+
+def helper_preexec():
+    """ Lower the priority of a helper between fork and exec, if this run is
+    within the budget. """
+    if budget is None:
+        return
+    try:
+        os.nice(helper_nice)
+    except OSError:
+        pass
+    set_ioprio(IOPRIO_CLASS_BE << 13 | helper_ioprio)
+
+def leave_budget():
+    """ Undo enter_budget in a child process, e.g. a daemon serving the whole
+    host, between fork and exec. """
+    if budget is None:
+        return
+    for procs in budget[1]:
+        write_cgroup(os.path.dirname(procs), "cgroup.procs", str(os.getpid()))
+
+def finish_budget():
+    """ Log how much this run was held back by the budget, and remove its
+    cgroups. """
+    global budget
+    if budget is None:
+        return
+    start = budget[2]
+    end = budget_stats(budget[0])
+    xcp.logger.debug("Resource budget: stalled on CPU %dms, IO %dms, memory %dms "
+                     "(all helpers), waited %dms for a CPU; all runs throttled %dms" %
+                     tuple([(end[k] - start[k]) / 1000 for k in
+                            ['cpu', 'io', 'memory', 'waiting', 'throttled']]))
+    for procs in budget[1]:
+        write_cgroup(os.path.dirname(procs), "cgroup.procs", str(os.getpid()))
+    for dir in budget[0]:
+        remove_cgroup(dir)
+    budget = None
+
+##### ARTEFACT INSPECTION
+#
+# Downloaded kernels and ramdisks are checked in place, through a read-only
+# mmap, before we spend any time tweaking them or hand them to the domain
+# builder.  Only the headers are touched, so this is cheap even for large
+# images.  The ELF notes of a compressed kernel are looked for only as far
+# as inspect_inflate_limit into its payload; beyond that the kernel is
+# passed without them being checked.  Ramdisk content we don't recognise,
+# such as a zstd or lz4 compressed segment, is passed untouched.
+
+XEN_NOTE_NAME = "Xen"
+XEN_ELFNOTE_GUEST_OS = 6
+XEN_ELFNOTE_LOADER = 8
+EM_386 = 3
+EM_X86_64 = 62
+
+# The most we'll inflate looking for the ELF notes of a compressed kernel.
+inspect_inflate_limit = 4 * 1024 * 1024
+
+class MappedReader:
+    """ Random access to a region of an mmap. """
+    def __init__(self, mapping, start = 0):
+        self.mapping = mapping
+        self.start = start
+    def get(self, offset, length):
+        offset += self.start
+        return self.mapping[offset:offset + length]
+
+class InflatingReader:
+    """ Random access to the decompressed content of a gzip stream in an mmap,
+    inflating only as far as the highest offset asked for. """
+    def __init__(self, mapping, start = 0):
+        self.mapping = mapping
+        self.pos = start
+        self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.data = ""
+    def get(self, offset, length):
+        if offset + length > inspect_inflate_limit:
+            raise OutOfReach(offset + length)
+        if len(self.data) < offset + length:
+            blocks = [self.data]
+            have = len(self.data)
+            while have < offset + length and self.pos < len(self.mapping):
+                chunk = self.mapping[self.pos:self.pos + copy_block_size]
+                self.pos += len(chunk)
+                try:
+                    block = self.inflater.decompress(chunk)
+                except zlib.error:
+                    break
+                blocks.append(block)
+                have += len(block)
+            self.data = "".join(blocks)
+        return self.data[offset:offset + length]
+
+def read_struct(reader, fmt, offset):
+    size = struct.calcsize(fmt)
+    data = reader.get(offset, size)
+    if len(data) != size:
+        raise InvalidSource("Truncated header at offset %d" % offset)
+    return struct.unpack(fmt, data)
+
+def parse_elf(reader):
+    """ Return a dictionary describing the ELF image read through reader:
+    its machine, and whether it carries the notes (or legacy __xen_guest
+    section) of a kernel able to boot as a Xen PV guest. """
+
+    ident = reader.get(0, 16)
+    if len(ident) != 16 or not ident.startswith("\177ELF"):
+        raise InvalidSource("Not an ELF image")
+    if ident[5] == "\001":
+        e = "<"
+    else:
+        e = ">"
+
+    if ident[4] == "\002":
+        (machine,) = read_struct(reader, e + "H", 18)
+        phoff, shoff = read_struct(reader, e + "QQ", 32)
+        phentsize, phnum, shentsize, shnum, shstrndx = read_struct(reader, e + "HHHHH", 54)
+        phdr, shdr = e + "I4xQ16xQ", e + "I20xQQ"
+    else:
+        (machine,) = read_struct(reader, e + "H", 18)
+        phoff, shoff = read_struct(reader, e + "II", 28)
+        phentsize, phnum, shentsize, shnum, shstrndx = read_struct(reader, e + "HHHHH", 42)
+        phdr, shdr = e + "II8xI", e + "I12xII"
+
+    info = { 'machine': machine, 'xen': False, 'xen-notes': [] }
+
+    for i in range(phnum):
+        p_type, p_offset, p_filesz = read_struct(reader, phdr, phoff + i * phentsize)
+        if p_type != 4: # PT_NOTE
+            continue
+        notes = reader.get(p_offset, p_filesz)
+        pos = 0
+        while pos + 12 <= len(notes):
+            namesz, descsz, ntype = struct.unpack(e + "III", notes[pos:pos + 12])
+            name = notes[pos + 12:pos + 12 + namesz].rstrip("\0")
+            pos += 12 + ((namesz + 3) & ~3) + ((descsz + 3) & ~3)
+            if name == XEN_NOTE_NAME:
+                info['xen'] = True
+                info['xen-notes'].append(ntype)
+
+    if not info['xen'] and shoff and shstrndx < shnum:
+        # Kernels predating the notes announce themselves with a section.
+        strtab = read_struct(reader, shdr, shoff + shstrndx * shentsize)
+        names = reader.get(strtab[1], strtab[2])
+        for i in range(shnum):
+            sh_name = read_struct(reader, shdr, shoff + i * shentsize)[0]
+            if names[sh_name:sh_name + 12] == "__xen_guest\0":
+                info['xen'] = True
+                break
+
+    return info
+
+def parse_inflated_elf(mapping, start = 0):
+    """ parse_elf the gzip compressed ELF image at start in mapping, or return
+    nothing if the parts we need are beyond inspect_inflate_limit. """
+    try:
+        return parse_elf(InflatingReader(mapping, start))
+    except OutOfReach, e:
+        xcp.logger.debug("Not inflating past %d bytes to offset %d" %
+                         (inspect_inflate_limit, e.args[0]))
+        return {}
+
+def inspect_kernel(filename):
+    """ Check that filename is a kernel we can boot as a PV guest, without
+    reading all of it.  Returns a dictionary of what was learned; 'xen' is
+    None where the image is valid but its payload can't be examined cheaply.
+    Raises InvalidSource for anything that is plainly not such a kernel. """
+
+    size = os.path.getsize(filename)
+    info = { 'size': size, 'format': None, 'xen': None }
+    if size == 0:
+        raise InvalidSource("Kernel '%s' is empty" % filename)
+
+    fd = open(filename)
+    try:
+        m = mmap.mmap(fd.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        try:
+            if m[:4] == "\177ELF":
+                info['format'] = 'elf'
+                info.update(parse_elf(MappedReader(m)))
+            elif sniff_compression(m[:6]) == 'gzip':
+                # e.g. the gzipped vmlinux of older Xen kernels
+                info['format'] = 'elf.gz'
+                info.update(parse_inflated_elf(m))
+            elif size > 0x250 and m[0x1fe:0x200] == "\x55\xaa" and m[0x202:0x206] == "HdrS":
+                info['format'] = 'bzImage'
+                (setup_sects,) = struct.unpack("<B", m[0x1f1])
+                (version,) = struct.unpack("<H", m[0x206:0x208])
+                info['protocol'] = "%d.%02d" % (version >> 8, version & 0xff)
+                if version >= 0x208:
+                    if setup_sects == 0:
+                        setup_sects = 4
+                    payload_offset, payload_length = struct.unpack("<II", m[0x248:0x250])
+                    start = (setup_sects + 1) * 512 + payload_offset
+                    info['payload-length'] = payload_length
+                    info['payload'] = sniff_compression(m[start:start + 6])
+                    if info['payload'] == 'gzip':
+                        info.update(parse_inflated_elf(m, start))
+                    elif m[start:start + 4] == "\177ELF":
+                        info.update(parse_elf(MappedReader(m, start)))
+            else:
+                raise InvalidSource("'%s' is neither an ELF image nor a bzImage" % filename)
+        finally:
+            m.close()
+    finally:
+        fd.close()
+
+    if info['xen'] is False:
+        raise InvalidSource("Kernel '%s' cannot boot as a Xen PV guest" % filename)
+    return info
+
+def cpio_segment_end(m, pos):
+    """ Return the offset just past the TRAILER!!! of the newc/crc cpio archive
+    at pos in m, or None if it doesn't parse. """
+    while pos + 110 <= len(m):
+        if m[pos:pos + 5] != "07070":
+            return None
+        try:
+            filesize = int(m[pos + 54:pos + 62], 16)
+            namesize = int(m[pos + 94:pos + 102], 16)
+        except ValueError:
+            return None
+        name = m[pos + 110:pos + 110 + namesize - 1]
+        pos = (pos + 110 + namesize + 3) & ~3
+        pos = (pos + filesize + 3) & ~3
+        if name == "TRAILER!!!":
+            return pos
+    return None
+
+def inspect_initrd(filename):
+    """ Describe the initrd in filename: its size and the format of each of
+    the segments it's made up of (e.g. an uncompressed cpio of early
+    microcode followed by a compressed main image).  The format of a segment
+    we don't recognise is None, and nothing after it is looked at.  Raises
+    InvalidSource for an empty file or a corrupt cpio archive. """
+
+    size = os.path.getsize(filename)
+    info = { 'size': size, 'segments': [] }
+    if size == 0:
+        raise InvalidSource("Ramdisk '%s' is empty" % filename)
+
+    fd = open(filename)
+    try:
+        m = mmap.mmap(fd.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        try:
+            pos = 0
+            while pos < size:
+                compression = sniff_compression(m[pos:pos + 6])
+                if compression is not None:
+                    # can't see past a compressed segment without inflating it
+                    info['segments'].append((pos, compression))
+                    break
+                if m[pos:pos + 5] == "07070":
+                    info['segments'].append((pos, 'cpio'))
+                    pos = cpio_segment_end(m, pos)
+                    if pos is None:
+                        raise InvalidSource("Ramdisk '%s' has a corrupt cpio archive" % filename)
+                    # archives are padded with zeros, often to a 512 byte boundary
+                    while pos < size and m[pos] == "\0":
+                        pos += 1
+                elif pos == 0 and m[1080:1082] == "\x53\xef":
+                    info['segments'].append((pos, 'ext2'))
+                    break
+                else:
+                    # e.g. zstd or lz4, which we leave to the kernel
+                    info['segments'].append((pos, None))
+                    break
+        finally:
+            m.close()
+    finally:
+        fd.close()
+
+    return info
+
+def inspect_boot_files(kernel, ramdisk):
+    """ Reject bad media before anything else is done with them. """
+    info = inspect_kernel(kernel)
+    xcp.logger.debug("Kernel %s: %s" % (kernel, info))
+    if ramdisk is not None:
+        info = inspect_initrd(ramdisk)
+        xcp.logger.debug("Ramdisk %s: %s" % (ramdisk, info))
+
+# splice(2) lets the kernel move data between a pipe and another fd without it
+# ever being copied into our address space.
+try:
+    libc = ctypes.CDLL(None, use_errno = True)
+    libc_splice = libc.splice
+    libc_splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    libc_splice.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    libc_splice = None
+
+SPLICE_F_MOVE = 1
+SPLICE_F_MORE = 4
+
+# Each thread copies through its own buffer, allocated once.
+copy_buffers = threading.local()
+
+def get_copy_buffer():
+    try:
+        return copy_buffers.view
+    except AttributeError:
+        copy_buffers.view = memoryview(bytearray(copy_block_size))
+        return copy_buffers.view
+
+def is_pipe(f):
+    try:
+        return stat.S_ISFIFO(os.fstat(f.fileno()).st_mode)
+    except (AttributeError, ValueError, OSError, IOError):
+        return False
+
+# Copy from one fd to another.  Every block copied is also fed to the hash
+# objects in digests, so callers can checksum data without a second pass.
+# Blocks are handed to tofd as views of the copy buffer, or as strings if it
+# won't take those, as text mode files won't.
+def copyfd(fromfd, tofd, limit, digests = None):
+    if not digests and libc_splice is not None and (is_pipe(fromfd) or is_pipe(tofd)):
+        rc = splicefd(fromfd, tofd, limit)
+        if rc is not None:
+            return rc
+
+    bytes_so_far = 0
+    view = get_copy_buffer()
+    size = copy_block_min
+    readinto = getattr(fromfd, 'readinto', None)
+    write = tofd.write
+
+    while bytes_so_far <= limit:
+        if readinto is not None:
+            l = readinto(view[:size])
+            block = view[:l]
+        else:
+            block = fromfd.read(size)
+            l = len(block)
+
+        if l == 0:
+            break
+
+        bytes_so_far += l
+        if digests:
+            for d in digests:
+                d.update(block)
+        try:
+            write(block)
+        except TypeError:
+            if not isinstance(block, memoryview):
+                raise
+            write = lambda block: tofd.write(block.tobytes())
+            write(block)
+
+        if l == size and size < copy_block_size:
+            size *= 2
+    else:
+        return bytes_so_far, False
 
-# Copy from one fd to another
-def copyfd(fromfd, tofd, limit):
+    return bytes_so_far, True
+
+# Copy between two fds, at least one of which is a pipe, using splice.  Returns
+# None, having copied nothing, if the kernel won't splice between them.
+def splicefd(fromfd, tofd, limit):
+    tofd.flush()
+    fd_in, fd_out = fromfd.fileno(), tofd.fileno()
     bytes_so_far = 0
 
     while bytes_so_far <= limit:
-        block = fromfd.read(copy_block_size)
-        l = len(block)
+        l = libc_splice(fd_in, None, fd_out, None, copy_block_size,
+                        SPLICE_F_MOVE | SPLICE_F_MORE)
+        if l < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if bytes_so_far == 0 and err in [errno.EINVAL, errno.ENOSYS]:
+                return None
+            raise IOError(err, os.strerror(err))
 
         if l == 0:
             break
 
         bytes_so_far += l
-        tofd.write(block)
     else:
         return bytes_so_far, False
 
@@ -287,25 +1200,1758 @@ class CdromRepo:
             umount(self.mntpoint)
             os.rmdir(self.mntpoint)
 
+##### ISO9660
+#
+# For cdrom installs we only need a couple of files off the disc, so rather
+# than mounting it we read them straight off the device: the volume
+# descriptors lead to the root directory, and each path is resolved one
+# directory record at a time.  Joliet and Rock Ridge names are understood, and
+# El Torito boot catalogs are noted for the logs.  Anything malformed raises
+# IsoError, and if the boot files can't be read this way fetch_first_boot
+# mounts the disc after all.
+
+ISO_SECTOR = 2048
+
+class IsoError(Exception):
+    pass
+
+class IsoFile:
+    """ A read-only file-like view of one extent of an ISO image. """
+    def __init__(self, image, start, size):
+        self.fd = open(image, "rb")
+        self.fd.seek(start)
+        self.remaining = size
+        self.size = size
+    def read(self, n = -1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.fd.read(n)
+        self.remaining -= len(data)
+        return data
+    def readinto(self, buf):
+        n = min(len(buf), self.remaining)
+        if n == 0:
+            return 0
+        # a slice of a bytearray would be a copy
+        n = self.fd.readinto(memoryview(buf)[:n])
+        self.remaining -= n
+        return n
+    def info(self):
+        return IsoFileInfo(self.size)
+    def close(self):
+        self.fd.close()
+
+class IsoFileInfo:
+    """ Enough of a urllib2 response's info() for fetchFile. """
+    def __init__(self, size):
+        self.size = size
+    def getheader(self, name, default = None):
+        if name.lower() == 'content-length':
+            return str(self.size)
+        return default
+
+class IsoImage:
+    def __init__(self, image):
+        self.image = image
+        self.joliet_root = None
+        self.root = None
+        self.boot_catalog = None
+        self.rock_ridge = False
+
+        fd = open(image, "rb")
+        try:
+            self.fd = fd
+            sector = 16
+            while True:
+                vd = self.read_sector(sector)
+                if len(vd) < ISO_SECTOR or vd[1:6] != "CD001":
+                    raise IsoError("%s is not an ISO9660 image" % image)
+                vd_type = ord(vd[0])
+                if vd_type == 255: # terminator
+                    break
+                if vd_type == 0 and vd[7:30] == "EL TORITO SPECIFICATION":
+                    (self.boot_catalog,) = struct.unpack("<I", vd[0x47:0x4b])
+                elif vd_type == 1 and self.root is None:
+                    self.root = self.parse_record(vd[156:190])
+                elif vd_type == 2 and vd[88:90] == "%/" and vd[90] in "@CE":
+                    self.joliet_root = self.parse_record(vd[156:190])
+                sector += 1
+                if sector > 64:
+                    raise IsoError("%s has no volume descriptor terminator" % image)
+            if self.root is None:
+                raise IsoError("%s has no primary volume descriptor" % image)
+
+            # Rock Ridge is announced by an SP entry in the root's '.' record.
+            dot = self.read_sector(self.root[0])
+            self.rock_ridge = self.system_use(dot).find("SP\x07\x01\xbe\xef") == 0
+        finally:
+            self.fd = None
+            fd.close()
+
+        xcp.logger.debug("ISO %s: joliet %s, rock ridge %s, el torito catalog %s" %
+                         (image, self.joliet_root is not None, self.rock_ridge,
+                          self.boot_catalog))
+
+    def read_sector(self, sector, count = 1):
+        self.fd.seek(sector * ISO_SECTOR)
+        return self.fd.read(count * ISO_SECTOR)
+
+    def parse_record(self, rec):
+        # returns (extent, size, is_directory)
+        if len(rec) < 34:
+            raise IsoError("%s: truncated directory record" % self.image)
+        extent, size = struct.unpack("<I4xI", rec[2:14])
+        return extent, size, bool(ord(rec[25]) & 2)
+
+    def system_use(self, rec):
+        name_len = ord(rec[32])
+        start = 33 + name_len + (1 - name_len % 2)
+        return rec[start:ord(rec[0])]
+
+    def rock_ridge_name(self, rec):
+        su = self.system_use(rec)
+        name = ""
+        pos = 0
+        while pos + 4 <= len(su):
+            sig, length = su[pos:pos + 2], ord(su[pos + 2])
+            if length < 4:
+                break
+            if sig == "NM":
+                name += su[pos + 5:pos + length]
+            pos += length
+        return name or None
+
+    def entries(self, directory, joliet):
+        """ Yield (name, record) for each entry of the directory at the
+        (extent, size, is_directory) given. """
+        extent, size, _ = directory
+        data = self.read_sector(extent, (size + ISO_SECTOR - 1) / ISO_SECTOR)
+        if len(data) < size:
+            raise IsoError("%s: directory at sector %d is truncated" % (self.image, extent))
+        pos = 0
+        while pos < size:
+            length = ord(data[pos])
+            if length == 0:
+                # records don't span sectors; skip to the next one
+                pos = (pos / ISO_SECTOR + 1) * ISO_SECTOR
+                continue
+            rec = data[pos:pos + length]
+            pos += length
+            if length < 34 or pos > size or 33 + ord(rec[32]) > length:
+                raise IsoError("%s: bad directory record at sector %d" % (self.image, extent))
+            name_len = ord(rec[32])
+            name = rec[33:33 + name_len]
+            if name in ["\0", "\1"]:
+                continue
+            rr_name = None
+            if joliet:
+                try:
+                    name = name.decode("utf-16-be").encode("utf-8")
+                except UnicodeError:
+                    raise IsoError("%s: bad Joliet name at sector %d" % (self.image, extent))
+            elif self.rock_ridge:
+                rr_name = self.rock_ridge_name(rec)
+            if rr_name:
+                name = rr_name
+            else:
+                # strip the version, and the dot of names without extension
+                name = name.split(";", 1)[0]
+                if not ord(rec[25]) & 2:
+                    name = name.rstrip(".")
+            yield name, rec
+
+    def lookup(self, path):
+        """ Return (offset, size) of the file at path, or raise IsoError. """
+        joliet = self.joliet_root is not None and not self.rock_ridge
+        if joliet:
+            node = self.joliet_root
+        else:
+            node = self.root
+
+        fd = open(self.image, "rb")
+        try:
+            self.fd = fd
+            for component in [c for c in path.split("/") if c]:
+                if not node[2]:
+                    raise IsoError("%s: %s is not a directory" % (self.image, path))
+                found = None
+                for name, rec in self.entries(node, joliet):
+                    if name == component:
+                        found = rec
+                        break
+                    if found is None and name.lower() == component.lower():
+                        found = rec
+                if found is None:
+                    raise IsoError("%s: %s not found" % (self.image, path))
+                node = self.parse_record(found)
+        finally:
+            self.fd = None
+            fd.close()
+
+        if node[2]:
+            raise IsoError("%s: %s is a directory" % (self.image, path))
+        return node[0] * ISO_SECTOR, node[1]
+
+    def open(self, path):
+        offset, size = self.lookup(path)
+        return IsoFile(self.image, offset, size)
+
+# Parsed images, keyed by device, so each is only parsed once per run.
+iso_images = {}
+
+def iso_repo_url(image):
+    """ Parse image, returning the URL prefix under which fetchFile and
+    checkFile can read its files.  Raises IsoError if it can't be parsed. """
+    if not iso_images.has_key(image):
+        iso_images[image] = IsoImage(image)
+    return "iso:%s!/" % image
+
+# Open source, which may be an iso: URL made by iso_repo_url, or anything
+# urllib2 understands.  Sources under a repository with mirrors are opened
+# with hedged requests.  method overrides the HTTP method, e.g. 'HEAD'.
+def urlopen(source, method = None, headers = {}):
+    if source[:4] == 'iso:':
+        image, path = source[4:].split("!", 1)
+        if not iso_images.has_key(image):
+            iso_images[image] = IsoImage(image)
+        try:
+            return iso_images[image].open(path)
+        except IsoError, e:
+            raise IOError(errno.ENOENT, str(e))
+
+    candidates = mirror_candidates(source)
+    if len(candidates) > 1:
+        # don't wait on mirrors we know to be down, unless they all are
+        hosts = read_state_file(REPO_HOSTS)
+        now = time.time()
+        up = [c for c in candidates if not breaker_open(hosts, url_host(c[1]), now)]
+        if up:
+            candidates = up
+        return hedged_urlopen(candidates, method, headers)
+
+    return open_url(source, method, headers)
+
+##### SHARED STATE
+#
+# Small amounts of state are shared between eliloader runs on a host through
+# text files of whitespace separated records, one per line, keyed by their
+# first field.  Readers take a shared lock on the file, writers an exclusive
+# one.
+
+def read_state_file(path):
+    records = {}
+    try:
+        fd = open(path)
+    except IOError:
+        return records
+    try:
+        fcntl.flock(fd.fileno(), fcntl.LOCK_SH)
+        for line in fd:
+            fields = line.split()
+            if fields:
+                records[fields[0]] = fields[1:]
+    finally:
+        fd.close()
+    return records
+
+def update_state_file(path, update):
+    """ Call update with the records of the state file at path, under an
+    exclusive lock, and write back whatever it leaves in the dictionary.
+    This state only ever saves us time, so failures are logged and ignored. """
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fd = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0644), "r+")
+    except (IOError, OSError), e:
+        xcp.logger.debug("Cannot update %s: %s" % (path, e))
+        return
+    enter_critical()
+    try:
+        try:
+            fcntl.flock(fd.fileno(), fcntl.LOCK_EX)
+            records = {}
+            for line in fd:
+                fields = line.split()
+                if fields:
+                    records[fields[0]] = fields[1:]
+
+            update(records)
+
+            fd.seek(0)
+            fd.truncate()
+            for key, fields in records.items():
+                fd.write(" ".join([key] + list(fields)) + "\n")
+        finally:
+            fd.close()
+    finally:
+        leave_critical()
+
+def ensure_daemon(pidfile, key, options):
+    """ Unless the pid recorded for key in pidfile is running, start this
+    program in the background with options, and record its pid there.
+    Returns False if it couldn't be started. """
+    running = []
+
+    def update(records):
+        if records.has_key(key):
+            try:
+                os.kill(int(records[key][0]), 0)
+                running.append(True)
+                return
+            except (OSError, ValueError, IndexError):
+                del records[key]
+
+        def detach():
+            os.setsid()
+            leave_budget()
+
+        cmd = [sys.executable, os.path.realpath(__file__)] + options
+        null = open(os.devnull, "r+")
+        try:
+            p = subprocess.Popen(cmd, stdin = null, stdout = null, stderr = null,
+                                 close_fds = True, preexec_fn = detach)
+        except OSError, e:
+            xcp.logger.debug("Cannot start %s: %s" % (" ".join(options), e))
+            return
+        finally:
+            null.close()
+        xcp.logger.debug("Started %s, pid %d" % (" ".join(options), p.pid))
+        records[key] = [str(p.pid)]
+        running.append(True)
+
+    update_state_file(pidfile, update)
+    return len(running) > 0
+
+##### REPOSITORY HEALTH
+#
+# During a boot storm every VM start probes and fetches from the same
+# repositories.  When a repository host stops answering, the first few runs
+# to notice open a circuit breaker for it in REPO_HOSTS, and the runs after
+# them fail straight away instead of each waiting out its own network
+# timeouts (or, with mirrors, go straight to another mirror).  Once the
+# breaker has cooled down requests are let through again, and the first
+# failure re-opens it.  Files found to be absent are likewise remembered in
+# REPO_ABSENT for a while, so the probes for layouts a repository doesn't
+# use are not repeated by every run.
+
+REPO_HOSTS = "/var/run/nonpersistent/linux-guest-loader/repo-hosts"
+REPO_ABSENT = "/var/run/nonpersistent/linux-guest-loader/repo-absent"
+
+# Seconds to remember that a file is absent.
+absent_ttl = 120
+# This many failures within breaker_window seconds open a host's breaker,
+# which then stays open for breaker_cooldown seconds.
+breaker_threshold = 3
+breaker_window = 60
+breaker_cooldown = 30
+# Seconds to wait on a repository connection before giving up.
+url_timeout = 60
+
+def url_host(url):
+    if url[:5] in ['http:', 'https'] or url[:4] == 'ftp:':
+        return urlparse.urlsplit(url)[1]
+    return None
+
+def breaker_open(hosts, host, now):
+    try:
+        return float(hosts[host][2]) > now
+    except (KeyError, IndexError, ValueError):
+        return False
+
+def host_failed(host):
+    def update(hosts):
+        now = time.time()
+        try:
+            failures, first, open_until = [float(f) for f in hosts[host]]
+        except (KeyError, ValueError):
+            failures, first, open_until = 0, now, 0
+        if now - first > breaker_window:
+            failures, first = 0, now
+        failures += 1
+        if failures >= breaker_threshold:
+            xcp.logger.debug("Opening circuit breaker for %s" % host)
+            open_until = now + breaker_cooldown
+        hosts[host] = ["%d" % failures, "%f" % first, "%f" % open_until]
+    update_state_file(REPO_HOSTS, update)
+
+def host_succeeded(host, hosts):
+    if hosts.has_key(host):
+        def update(hosts):
+            if hosts.has_key(host):
+                del hosts[host]
+        update_state_file(REPO_HOSTS, update)
+
+def remember_absent(url):
+    def update(absent):
+        now = time.time()
+        for u, fields in absent.items():
+            try:
+                if float(fields[0]) < now:
+                    del absent[u]
+            except (IndexError, ValueError):
+                del absent[u]
+        absent[url] = ["%f" % (now + absent_ttl)]
+    update_state_file(REPO_ABSENT, update)
+
+def known_absent(url):
+    try:
+        return float(read_state_file(REPO_ABSENT)[url][0]) > time.time()
+    except (KeyError, IndexError, ValueError):
+        return False
+
+# Open url with urllib2, failing fast if we already know it's absent or its
+# host is down, and keeping REPO_HOSTS and REPO_ABSENT up to date.  The
+# request is made through opener, if given, or else the fetch_context's.
+def open_url(url, method = None, headers = {}, opener = None):
+    host = url_host(url)
+    hosts = {}
+    if host is not None:
+        if known_absent(url):
+            xcp.logger.debug("%s is known to be absent" % url)
+            raise urllib2.HTTPError(url, 404, "Not Found (cached)", None, None)
+        hosts = read_state_file(REPO_HOSTS)
+        if breaker_open(hosts, host, time.time()):
+            raise urllib2.URLError("%s is not responding (circuit breaker open)" % host)
+
+    request = urllib2.Request(url, headers = headers)
+    if method:
+        request.get_method = lambda : method
+    opener = opener or fetch_context.opener
+    try:
+        if opener is None:
+            fd = urllib2.urlopen(request, timeout = url_timeout)
+        else:
+            fd = opener.open(request, timeout = url_timeout)
+    except urllib2.HTTPError, e:
+        if host is not None:
+            if e.code in [404, 410]:
+                remember_absent(url)
+            elif e.code >= 500:
+                host_failed(host)
+        raise
+    except StandardError:
+        if host is not None:
+            host_failed(host)
+        raise
+
+    if host is not None:
+        host_succeeded(host, hosts)
+    return fd
+
+##### MIRRORS
+#
+# A repository may be given a list of mirrors (other-config:install-mirrors).
+# Requests go to the mirror that has served us best so far; if it hasn't
+# started answering within its usual time we send the same request to the
+# next one too, and use whichever answers first.  How each mirror performed
+# is kept in MIRROR_STATS so later runs start with the best one.
+
+MIRROR_STATS = "/var/lib/linux-guest-loader/mirror-stats"
+
+# How long to wait for a mirror we know nothing about before hedging.
+hedge_delay_default = 1.0
+# Never hedge sooner than this, however fast a mirror usually is.
+hedge_delay_min = 0.2
+# Hedge when a mirror takes this many times longer than its average.
+hedge_delay_factor = 3.0
+# Weight of the latest measurement in the moving averages.
+mirror_stats_alpha = 0.3
+# Penalty, in seconds of latency, for each recent failure of a mirror.
+mirror_failure_penalty = 10.0
+# Transfer size used to weigh throughput against latency when ranking, and
+# the throughput assumed of mirrors we haven't downloaded from yet.
+mirror_rank_size = 32 * 1024 * 1024
+mirror_default_throughput = 10 * 1024 * 1024
+
+# What a fetch needs to know about the VM it's for: the URL prefixes of
+# equivalent repositories, keyed by the prefix the distro handlers build
+# their URLs from, and the urllib2 opener for its install-proxy (None for
+# urllib2's own).  Batch mode fetches for several VMs at once, one per
+# worker thread, so each thread has its own.  Threads started on behalf of
+# a fetch, like hedged requests, are handed what they need.
+class FetchContext(threading.local):
+    def __init__(self):
+        self.mirrors = {}
+        self.opener = None
+
+fetch_context = FetchContext()
+
+def register_mirrors(repo_url, others):
+    alts = [repo_url]
+    for m in others:
+        if not True in [m.startswith(x) for x in ['http:', 'https:', 'ftp:']]:
+            xcp.logger.debug("Ignoring mirror %s: only http and ftp are supported" % m)
+            continue
+        if not m.endswith("/"):
+            m += "/"
+        if m not in alts:
+            alts.append(m)
+    fetch_context.mirrors[repo_url] = alts
+    xcp.logger.debug("Mirrors of %s: %s" % (repo_url, alts[1:]))
+
+def read_mirror_stats():
+    """ Return a dictionary mapping mirror URL to a list of [time to first
+    byte, throughput, recent failures] averages. """
+    stats = {}
+    for mirror, fields in read_state_file(MIRROR_STATS).items():
+        try:
+            if len(fields) == 3:
+                stats[mirror] = [float(f) for f in fields]
+        except ValueError:
+            pass
+    return stats
+
+def record_mirror(mirror, ttfb = None, throughput = None, failed = False):
+    """ Fold a measurement of mirror into MIRROR_STATS. """
+
+    def average(old, new):
+        if old <= 0:
+            return new
+        return (1 - mirror_stats_alpha) * old + mirror_stats_alpha * new
+
+    def update(records):
+        try:
+            entry = [float(f) for f in records[mirror]]
+        except (KeyError, ValueError):
+            entry = [0.0, 0.0, 0.0]
+        if len(entry) != 3:
+            entry = [0.0, 0.0, 0.0]
+        if ttfb is not None:
+            entry[0] = average(entry[0], ttfb)
+        if throughput is not None:
+            entry[1] = average(entry[1], throughput)
+        if failed:
+            entry[2] += 1
+        elif ttfb is not None:
+            entry[2] *= 1 - mirror_stats_alpha
+        records[mirror] = ["%f" % f for f in entry]
+
+    update_state_file(MIRROR_STATS, update)
+
+def mirror_score(stats, mirror):
+    # expected seconds to fetch a typical boot file
+    ttfb, throughput, failures = hedge_delay_default, 0, 0
+    if stats.has_key(mirror):
+        ttfb, throughput, failures = stats[mirror]
+    if throughput <= 0:
+        throughput = mirror_default_throughput
+    return ttfb + failures * mirror_failure_penalty + mirror_rank_size / throughput
+
+def hedge_delay(stats, mirror):
+    if not stats.has_key(mirror) or stats[mirror][0] <= 0:
+        return hedge_delay_default
+    return max(hedge_delay_min, hedge_delay_factor * stats[mirror][0])
+
+# Return a list of (mirror, url) from which source may be fetched, best first.
+def mirror_candidates(source):
+    for prefix, alts in fetch_context.mirrors.items():
+        if source.startswith(prefix):
+            suffix = source[len(prefix):]
+            stats = read_mirror_stats()
+            ranked = [(mirror_score(stats, m), i, m) for i, m in enumerate(alts)]
+            ranked.sort()
+            return [(m, m + suffix) for _, _, m in ranked]
+    return [(None, source)]
+
+def mirror_of(url):
+    for alts in fetch_context.mirrors.values():
+        for m in alts:
+            if url.startswith(m):
+                return m
+    return None
+
+def hedged_urlopen(candidates, method, headers = {}):
+    """ Open the first of candidates to respond, sending the request to the
+    next candidate whenever the current one is slower than usual or fails. """
+
+    stats = read_mirror_stats()
+    results = Queue.Queue()
+    opener = fetch_context.opener
+
+    def attempt(mirror, url):
+        start = time.time()
+        try:
+            fd = open_url(url, method, headers, opener)
+        except StandardError, e:
+            results.put((mirror, None, e, time.time() - start))
+        else:
+            results.put((mirror, fd, None, time.time() - start))
+
+    started = {}
+    def start(mirror, url):
+        xcp.logger.debug("Requesting %s" % url)
+        started[mirror] = time.time()
+        t = threading.Thread(target = attempt, args = (mirror, url))
+        t.setDaemon(True)
+        t.start()
+
+    pending = 0
+    next = 0
+    error = None
+    winner = None
+    while winner is None:
+        if pending == 0:
+            if next == len(candidates):
+                break
+            start(*candidates[next])
+            next += 1
+            pending += 1
+
+        timeout = None
+        if next < len(candidates):
+            timeout = hedge_delay(stats, candidates[next - 1][0])
+        try:
+            mirror, fd, e, elapsed = results.get(True, timeout)
+        except Queue.Empty:
+            xcp.logger.debug("%s is slow, hedging" % candidates[next - 1][0])
+            start(*candidates[next])
+            next += 1
+            pending += 1
+            continue
+
+        pending -= 1
+        del started[mirror]
+        if fd is not None:
+            winner = fd
+            record_mirror(mirror, ttfb = elapsed)
+        elif isinstance(e, urllib2.HTTPError) and e.code < 500:
+            # the mirror is fine, the file just isn't there; the others
+            # won't have it either
+            error = e
+            break
+        else:
+            xcp.logger.debug("%s failed: %s" % (mirror, e))
+            record_mirror(mirror, failed = True)
+            error = e
+
+    if pending:
+        # the mirrors we gave up waiting for were at least this slow
+        now = time.time()
+        for mirror in started.keys():
+            record_mirror(mirror, ttfb = now - started[mirror])
+
+        # close the responses of the requests we no longer need
+        def reap(count):
+            for _ in range(count):
+                fd = results.get()[1]
+                if fd is not None:
+                    fd.close()
+        t = threading.Thread(target = reap, args = (pending, ))
+        t.setDaemon(True)
+        t.start()
+
+    if winner is None:
+        raise error
+    return winner
+
+##### CACHE INDEX
+#
+# Every run of eliloader is a new process, so the caches below have to be
+# cheap to consult from cold, however many entries they hold.  Each cache
+# directory has an index, .index: a hash table of fixed-size records, keyed
+# by the SHA1 naming an entry and found by open addressing, which we mmap
+# and probe directly.  A lookup touches a record or two and parses nothing.
+#
+# Readers take no lock.  Every record carries a CRC, and one caught half
+# written is read again.  Writers hold an flock on the index, and check it
+# hasn't been replaced by a rebuild under them.  The entries' .meta files
+# remain the authority: when the index can't answer (it is missing, or a key
+# couldn't be placed within index_max_probe slots of its home) the .meta file
+# is read instead, and "eliloader --rebuild-index <dir>" rebuilds and
+# compacts the index from them, under the writers' lock.
+#
+# The index depends on flock and on every process's mapping seeing the
+# others' stores, which NFS doesn't promise, so the shared tier has none:
+# set_shared_cache lists it in unindexed_caches, and its entries are always
+# found through their .meta files.
+
+INDEX_MAGIC = "LGLIDX01"
+
+# key, state, size, last use, md5, algorithm and raw value of a further
+# digest, ETag, Last-Modified, CRC32 of the preceding bytes
+index_record = struct.Struct("<20sB3xQd16s8s64s64s32s28xI")
+index_header = struct.Struct("<8sII")
+(INDEX_EMPTY, INDEX_USED, INDEX_DELETED) = range(3)
+
+index_slots_default = 4096
+index_max_probe = 32
+
+unindexed_caches = set()
+
+def seal_index_record(data):
+    return data[:-4] + struct.pack("<I", zlib.crc32(data[:-4]) & 0xffffffff)
+
+def pack_index_record(key, meta, last_use):
+    digest = ("", "")
+    for k, v in meta.items():
+        if k not in ['url', 'size', 'md5', 'etag', 'last-modified', 'last-use'] and \
+                len(k) <= 8 and len(v) <= 128:
+            digest = (k, v)
+    etag = meta.get('etag', '')
+    if len(etag) > 64:
+        etag = ''
+    last_modified = meta.get('last-modified', '')
+    if len(last_modified) > 32:
+        last_modified = ''
+    try:
+        data = index_record.pack(key, INDEX_USED, int(meta['size']), last_use,
+                                 meta.get('md5', '').decode('hex'), digest[0],
+                                 digest[1].decode('hex'), etag, last_modified, 0)
+    except (KeyError, ValueError, TypeError, struct.error):
+        return None
+    return seal_index_record(data)
+
+def unpack_index_record(fields):
+    key, state, size, last_use, md5, algo, digest, etag, last_modified, crc = fields
+    meta = { 'size': str(size), 'last-use': "%f" % last_use }
+    if md5 != "\0" * 16:
+        meta['md5'] = md5.encode('hex')
+    algo = algo.rstrip("\0")
+    if algo:
+        try:
+            meta[algo] = digest[:hashlib.new(algo).digest_size].encode('hex')
+        except ValueError:
+            pass
+    if etag.rstrip("\0"):
+        meta['etag'] = etag.rstrip("\0")
+    if last_modified.rstrip("\0"):
+        meta['last-modified'] = last_modified.rstrip("\0")
+    return meta
+
+class CacheIndex:
+    """ The index of cache directory dir. """
+
+    def __init__(self, dir):
+        self.path = os.path.join(dir, ".index")
+        self.enabled = dir not in unindexed_caches
+
+    def offsets(self, key, slots):
+        home = struct.unpack("<Q", key[:8])[0]
+        for i in range(min(index_max_probe, slots)):
+            yield (1 + (home + i) % slots) * index_record.size
+
+    def slots(self, m):
+        magic, slots, record_size = index_header.unpack(m[:index_header.size])
+        if magic != INDEX_MAGIC or record_size != index_record.size or \
+                len(m) < (slots + 1) * record_size:
+            return None
+        return slots
+
+    def read_record(self, m, offset):
+        for _ in range(3):
+            data = m[offset:offset + index_record.size]
+            fields = index_record.unpack(data)
+            if fields[1] == INDEX_EMPTY:
+                return fields
+            if zlib.crc32(data[:-4]) & 0xffffffff == fields[-1]:
+                return fields
+        return None
+
+    def lookup(self, key):
+        """ Return (known, meta): known is False if the index can't say
+        whether key is present, otherwise meta is key's metadata, in the
+        form read_artefact_meta returns, or None if it is absent. """
+        if not self.enabled:
+            return False, None
+        try:
+            fd = open(self.path, "rb")
+        except IOError:
+            return False, None
+        try:
+            try:
+                m = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                return False, None
+        finally:
+            fd.close()
+        try:
+            slots = self.slots(m)
+            if slots is None:
+                return False, None
+            for offset in self.offsets(key, slots):
+                fields = self.read_record(m, offset)
+                if fields is None:
+                    return False, None
+                if fields[1] == INDEX_EMPTY:
+                    return True, None
+                if fields[1] == INDEX_USED and fields[0] == key:
+                    return True, unpack_index_record(fields)
+            return False, None
+        finally:
+            m.close()
+
+    def records(self):
+        """ Return a dictionary mapping every key in the index to its
+        metadata. """
+        rc = {}
+        if not self.enabled:
+            return rc
+        try:
+            fd = open(self.path, "rb")
+            try:
+                m = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+            finally:
+                fd.close()
+        except (IOError, mmap.error, ValueError):
+            return rc
+        try:
+            slots = self.slots(m)
+            for i in range(slots or 0):
+                fields = self.read_record(m, (i + 1) * index_record.size)
+                if fields is not None and fields[1] == INDEX_USED:
+                    rc[fields[0]] = unpack_index_record(fields)
+        finally:
+            m.close()
+        return rc
+
+    def lock(self):
+        """ Return a descriptor of the index holding its lock, creating the
+        index file if need be. """
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    return fd
+            except OSError:
+                pass
+            # replaced by a rebuild while we waited for the lock
+            os.close(fd)
+
+    def update(self, fn):
+        """ Call fn(m, slots) with the index mapped writable, under its lock,
+        creating the index if need be.  Failures are logged and ignored:
+        the .meta files are still there. """
+        if not self.enabled:
+            return
+        try:
+            fd = self.lock()
+            try:
+                if os.fstat(fd).st_size == 0:
+                    os.ftruncate(fd, (index_slots_default + 1) * index_record.size)
+                    os.write(fd, index_header.pack(INDEX_MAGIC, index_slots_default,
+                                                   index_record.size))
+                m = mmap.mmap(fd, 0)
+                try:
+                    slots = self.slots(m)
+                    if slots is None:
+                        xcp.logger.debug("%s is corrupt, rebuild it" % self.path)
+                        return
+                    fn(m, slots)
+                finally:
+                    m.close()
+            finally:
+                os.close(fd)
+        except (IOError, OSError, mmap.error), e:
+            xcp.logger.debug("Cannot update %s: %s" % (self.path, e))
+
+    def put(self, key, meta, last_use = None):
+        data = pack_index_record(key, meta, last_use or time.time())
+        if data is None:
+            return
+
+        def update(m, slots):
+            free = None
+            for offset in self.offsets(key, slots):
+                fields = self.read_record(m, offset)
+                if fields is not None and fields[1] == INDEX_USED and fields[0] == key:
+                    free = offset
+                    break
+                if free is None and (fields is None or fields[1] != INDEX_USED):
+                    free = offset
+                if fields is not None and fields[1] == INDEX_EMPTY:
+                    break
+            if free is None:
+                xcp.logger.debug("%s is full, rebuild it" % self.path)
+                return
+            m[free:free + index_record.size] = data
+        self.update(update)
+
+    def touch(self, key):
+        def update(m, slots):
+            for offset in self.offsets(key, slots):
+                fields = self.read_record(m, offset)
+                if fields is None or fields[1] == INDEX_EMPTY:
+                    return
+                if fields[1] == INDEX_USED and fields[0] == key:
+                    meta = unpack_index_record(fields)
+                    m[offset:offset + index_record.size] = \
+                        pack_index_record(key, meta, time.time())
+                    return
+        self.update(update)
+
+    def remove(self, key):
+        def update(m, slots):
+            for offset in self.offsets(key, slots):
+                fields = self.read_record(m, offset)
+                if fields is None or fields[1] == INDEX_EMPTY:
+                    return
+                if fields[0] == key:
+                    # a tombstone, so that probes carry on past it
+                    m[offset:offset + index_record.size] = seal_index_record(
+                        index_record.pack(key, INDEX_DELETED, 0, 0, "", "", "", "", "", 0))
+                    return
+        self.update(update)
+
+def rebuild_index(dir):
+    """ Rebuild the index of cache directory dir from its .meta files, sized
+    for twice as many entries as it has, and drop any leftovers of entries
+    half published or half removed.  The index stays locked throughout, so
+    no writer's update is lost between our reading the directory and
+    renaming the new index into place. """
+    index = CacheIndex(dir)
+    fd = index.lock()
+    try:
+        keys = {}
+        now = time.time()
+        for name in os.listdir(dir):
+            path = os.path.join(dir, name)
+            if name.startswith(".publish-"):
+                if now - os.path.getmtime(path) > 3600:
+                    os.unlink(path)
+                continue
+            if not name.endswith(".meta"):
+                continue
+            entry = path[:-5]
+            meta = read_artefact_meta(entry)
+            try:
+                key = name[:-5].decode('hex')
+                last_use = os.path.getmtime(entry_file(entry))
+            except (TypeError, OSError):
+                os.unlink(path)
+                continue
+            if len(key) == 20 and meta is not None:
+                keys[key] = (meta, last_use)
+
+        slots = index_slots_default
+        while slots < 2 * len(keys):
+            slots *= 2
+
+        old = index.records()
+        table = bytearray((slots + 1) * index_record.size)
+        table[:index_header.size] = index_header.pack(INDEX_MAGIC, slots, index_record.size)
+        for key, (meta, last_use) in keys.items():
+            if old.has_key(key):
+                last_use = float(old[key]['last-use'])
+            data = pack_index_record(key, meta, last_use)
+            if data is None:
+                continue
+            home = struct.unpack("<Q", key[:8])[0]
+            for i in range(slots):
+                offset = (1 + (home + i) % slots) * index_record.size
+                if table[offset + 20] == INDEX_EMPTY:
+                    table[offset:offset + index_record.size] = data
+                    break
+            if i >= index_max_probe:
+                xcp.logger.debug("%s: %s is %d slots from home" % (dir, key.encode('hex'), i))
+
+        tmp = close_mkstemp(dir = dir, prefix = ".index-")
+        try:
+            f = open(tmp, "wb")
+            try:
+                f.write(table)
+            finally:
+                f.close()
+            os.chmod(tmp, 0644)
+            os.rename(tmp, index.path)
+        except:
+            os.unlink(tmp)
+            raise
+    finally:
+        os.close(fd)
+    xcp.logger.debug("Rebuilt %s: %d entries in %d slots" % (index.path, len(keys), slots))
+
+##### CHUNK STORE
+#
+# Successive point releases of a distro ship kernels and initrds that are
+# largely the same.  With artefact_chunking set, entries of ARTEFACT_CACHE
+# are kept not as whole files but as recipes, <entry>.chunks, listing the
+# SHA1 and length of each of their chunks, which are stored once each in
+# CHUNK_STORE whichever entries they appear in.
+#
+# Chunk boundaries are content-defined, so an insertion moves only the
+# boundaries near it.  A boundary follows the first run of chunk_window
+# bytes that chunk_table maps to "1" (1 position in 2**chunk_window), at
+# least chunk_min_size and at most chunk_max_size bytes after the last.  This
+# is a gear hash with a one-bit gear per byte, cut down so that it can be
+# evaluated with str.translate and str.find: a byte-at-a-time rolling hash
+# loop would be far too slow in python.
+#
+# A repository may publish the chunks of a file in the same format at
+# <url>.chunks ("eliloader --chunk-index <file>" writes it).  fetchFile then
+# downloads only the chunks we don't have, with HTTP Range requests, and
+# assembles the file from the store.  Compressed files change throughout
+# when anything in them changes, so the savings come from initrds shipped
+# uncompressed or compressed with gzip --rsyncable, and from identical
+# files published under different names.
+#
+# Chunks no recipe uses are removed when entries are trimmed, unless they
+# have been written or reused in the last chunk_grace seconds, which keeps
+# them safe from the trim while an entry using them is being published.
+
+CHUNK_STORE = "/var/cache/linux-guest-loader/chunks"
+
+artefact_chunking = False
+chunk_min_size = 4 * 1024
+chunk_max_size = 64 * 1024
+chunk_window = 14
+chunk_range_max_size = 8 * 1024 * 1024
+chunk_index_max_size = 4 * 1024 * 1024
+chunk_grace = 3600
+
+def make_chunk_table():
+    """ Map a pseudo-random half of the byte values to "1", the rest to "0". """
+    ranked = sorted(range(256), key = lambda b: hashlib.sha1(chr(b)).digest())
+    ones = set(ranked[:128])
+    return "".join([b in ones and "1" or "0" for b in range(256)])
+
+chunk_table = make_chunk_table()
+
+def chunk_path(digest):
+    return os.path.join(CHUNK_STORE, digest[:2], digest)
+
+def store_chunk(data):
+    """ Add data to the store if it isn't there already.  Returns its SHA1. """
+    digest = hashlib.sha1(data).hexdigest()
+    path = chunk_path(digest)
+    try:
+        os.utime(path, None)
+        return digest
+    except OSError:
+        pass
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = close_mkstemp(dir = os.path.dirname(path), prefix = ".chunk-")
+    try:
+        fd = open(tmp, "wb")
+        try:
+            fd.write(data)
+        finally:
+            fd.close()
+        os.chmod(tmp, 0444)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+    return digest
+
+def split_chunks(fd):
+    """ Yield the content-defined chunks of the file fd. """
+    marker = "1" * chunk_window
+    pending = ""
+    eof = False
+    while not eof:
+        block = fd.read(copy_block_size)
+        eof = not block
+        pending += block
+        bits = pending.translate(chunk_table)
+        pos = 0
+        while pos < len(pending):
+            lo = pos + chunk_min_size - chunk_window
+            hi = min(pos + chunk_max_size, len(pending))
+            i = bits.find(marker, lo, hi)
+            if i >= 0:
+                end = i + chunk_window
+            elif len(pending) - pos >= chunk_max_size or eof:
+                end = hi
+            else:
+                break
+            yield pending[pos:end]
+            pos = end
+        pending = pending[pos:]
+
+def chunk_file(path):
+    """ Store the chunks of file path, and return its recipe: a list of the
+    SHA1 and length of each. """
+    recipe = []
+    fd = open(path, "rb")
+    try:
+        for data in split_chunks(fd):
+            recipe.append((store_chunk(data), len(data)))
+    finally:
+        fd.close()
+    return recipe
+
+def parse_recipe(data):
+    recipe = []
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) != 2 or len(fields[0]) != 40:
+            raise ValueError("Bad chunk list line: '%s'" % line)
+        recipe.append((fields[0].lower(), int(fields[1])))
+    return recipe
+
+def format_recipe(recipe):
+    return "".join(["%s %d\n" % (digest, length) for digest, length in recipe])
+
+def read_recipe(path):
+    fd = open(path)
+    try:
+        return parse_recipe(fd.read())
+    finally:
+        fd.close()
+
+class ChunkedFile:
+    """ Read the content of a recipe from the chunk store. """
+
+    def __init__(self, recipe):
+        self.recipe = list(recipe)
+        self.fd = None
+
+    def readinto(self, buf):
+        while True:
+            if self.fd is None:
+                if not self.recipe:
+                    return 0
+                digest, _ = self.recipe.pop(0)
+                self.fd = open(chunk_path(digest), "rb")
+            l = self.fd.readinto(buf)
+            if l > 0:
+                return l
+            self.fd.close()
+            self.fd = None
+
+    def read(self, size):
+        buf = bytearray(size)
+        return str(buf[:self.readinto(buf)])
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+        self.recipe = []
+
+def entry_file(path):
+    """ The file holding the entry at path: the entry itself, or its recipe
+    if it is kept as chunks. """
+    if not os.path.exists(path) and os.path.exists(path + ".chunks"):
+        return path + ".chunks"
+    return path
+
+def entry_size(path):
+    """ The size of the content of the entry at path.  Raises OSError if it
+    or any of its chunks is missing. """
+    f = entry_file(path)
+    if f == path:
+        return os.path.getsize(path)
+    try:
+        recipe = read_recipe(f)
+    except (IOError, ValueError), e:
+        raise OSError(errno.ENOENT, str(e))
+    for digest, _ in recipe:
+        if not os.path.exists(chunk_path(digest)):
+            raise OSError(errno.ENOENT, "Missing chunk " + digest)
+    return sum([length for _, length in recipe])
+
+def open_entry(path):
+    f = entry_file(path)
+    if f == path:
+        return open(path, "rb")
+    return ChunkedFile(read_recipe(f))
+
+def gc_chunks():
+    """ Remove the chunks no recipe in ARTEFACT_CACHE uses. """
+    used = set()
+    try:
+        for name in os.listdir(ARTEFACT_CACHE):
+            if name.endswith(".chunks") and not name.startswith("."):
+                for digest, _ in read_recipe(os.path.join(ARTEFACT_CACHE, name)):
+                    used.add(digest)
+    except (IOError, OSError, ValueError), e:
+        # better to keep everything than to delete chunks in use
+        xcp.logger.debug("Cannot collect chunks: %s" % e)
+        return
+    now = time.time()
+    removed = 0
+    for dir, _, names in os.walk(CHUNK_STORE):
+        for name in names:
+            path = os.path.join(dir, name)
+            try:
+                if name not in used and now - os.path.getmtime(path) > chunk_grace:
+                    os.unlink(path)
+                    removed += 1
+            except OSError:
+                pass
+    xcp.logger.debug("Removed %d unused chunks" % removed)
+
+def chunk_runs(recipe):
+    """ Group the chunks of recipe we don't have into runs to fetch with one
+    Range request each.  Returns a list of (offset, [(digest, length)...]). """
+    runs = []
+    offset = 0
+    run = None
+    for digest, length in recipe:
+        if os.path.exists(chunk_path(digest)):
+            run = None
+        elif run is not None and run[0] + sum([l for _, l in run[1]]) + length <= \
+                run[0] + chunk_range_max_size:
+            run[1].append((digest, length))
+        else:
+            run = (offset, [(digest, length)])
+            runs.append(run)
+        offset += length
+    return runs
+
+def fetch_chunks(source, offset, chunks, total):
+    """ Fetch chunks, starting at offset, of source with a Range request, and
+    add them to the store.  Returns the response's validators. """
+    length = sum([l for _, l in chunks])
+    fd = urlopen(source, None, { 'Range': "bytes=%d-%d" % (offset, offset + length - 1) })
+    try:
+        if fd.getcode() != 206:
+            raise TransferError("%s ignored our Range request" % source)
+        content_range = fd.info().getheader('Content-Range') or ""
+        if not content_range.endswith("/%d" % total):
+            raise TransferError("%s has changed since its chunk list was made" % source)
+        for digest, l in chunks:
+            data = fd.read(l)
+            if len(data) != l or hashlib.sha1(data).hexdigest() != digest:
+                raise TransferError("%s doesn't match its chunk list" % source)
+            store_chunk(data)
+        return response_validators(fd)
+    finally:
+        fd.close()
+
+def fetch_chunked(source, dest, limit, expected, sink):
+    """ Fetch source to dest by way of the chunk store, if its repository
+    publishes a chunk list for it.  Returns the MD5 of the content, the
+    server's validators and the recipe, or None if it can't be done. """
+    try:
+        fd = urlopen(source + ".chunks")
+        try:
+            recipe = parse_recipe(fd.read(chunk_index_max_size))
+        finally:
+            fd.close()
+    except (OSError, urllib2.URLError, IOError, ValueError):
+        return None
+    total = sum([length for _, length in recipe])
+    if not recipe or total > limit:
+        return None
+
+    runs = chunk_runs(recipe)
+    xcp.logger.debug("%s: fetching %d of %d chunks in %d requests" %
+                     (source, sum([len(r[1]) for r in runs]), len(recipe), len(runs)))
+    validators = None
+    try:
+        for offset, chunks in runs:
+            v = fetch_chunks(source, offset, chunks, total)
+            if validators is not None and v != validators:
+                raise TransferError("%s changed while we fetched it" % source)
+            validators = v
+        if validators is None:
+            fd = urlopen(source, 'HEAD')
+            try:
+                if fd.info().getheader('Content-Length') != str(total):
+                    raise TransferError("%s has changed since its chunk list was made" % source)
+                validators = response_validators(fd)
+            finally:
+                fd.close()
+    except (OSError, urllib2.URLError, IOError, TransferError), e:
+        xcp.logger.debug("Chunked fetch of %s failed: %s" % (source, e))
+        return None
+
+    md5 = hashlib.md5()
+    digests = [md5]
+    if expected is not None and expected[0] != 'md5':
+        digests.append(hashlib.new(expected[0]))
+    src = ChunkedFile(recipe)
+    fd_dest = open(dest, "wb")
+    if sink is not None:
+        sink.reset()
+        fd_dest = TeeFile(fd_dest, sink)
+    try:
+        copyfd(src, fd_dest, limit, digests)
+    finally:
+        fd_dest.close()
+        src.close()
+
+    if expected is not None and digests[-1].hexdigest() != expected[1]:
+        xcp.logger.debug("%s assembled from chunks has %s %s, repository says %s" %
+                         (source, expected[0], digests[-1].hexdigest(), expected[1]))
+        return None
+    return md5.hexdigest(), validators, recipe
+
+def write_chunk_index(path):
+    """ Print the chunk list a repository should publish for the file path. """
+    recipe = []
+    fd = open(path, "rb")
+    try:
+        for data in split_chunks(fd):
+            recipe.append((hashlib.sha1(data).hexdigest(), len(data)))
+    finally:
+        fd.close()
+    sys.stdout.write(format_recipe(recipe))
+    return 0
+
+##### ARTEFACT CACHE
+#
+# Kernels and initrds downloaded by fetchFile are kept in a cache so that
+# installing the same distro again doesn't download them again.  The cache
+# has up to two tiers: ARTEFACT_CACHE on local disk, and optionally a
+# directory on storage shared by the pool (the pool's
+# other-config:install-shared-cache, which must lie under one of
+# shared_cache_roots: whoever sets it chooses where dom0 writes and
+# deletes).  fetchFile looks in the local tier, then the shared tier, and
+# only then goes to the network.  A file found in the shared tier is
+# promoted to the local one; a file downloaded is published to both, unless
+# another host has published it to the shared tier already.  The shared tier
+# is trimmed at most every shared_cache_trim_interval seconds, as listing it
+# over NFS is slow.
+#
+# Each entry is a file named after the SHA1 of its URL, with a .meta file
+# beside it recording its size, MD5, any repository digest it was verified
+# against, and the server's validators, and, in the local tiers, a record in
+# the directory's index.  The files are written to temporary names and renamed into place,
+# so readers on any host see either the whole entry or nothing.  An entry is
+# used without asking the repository if the caller's expected digest
+# matches it; otherwise the repository is asked (with a HEAD) whether the
+# file has changed.
+#
+# Initrds we have tweaked are kept the same way in TWEAKED_CACHE, keyed by
+# the vendor initrd's MD5, the overlay applied and the compression used.
+
+ARTEFACT_CACHE = "/var/cache/linux-guest-loader/artefacts"
+TWEAKED_CACHE = "/var/cache/linux-guest-loader/tweaked"
+
+# Directories consulted, in order, by fetchFile.  main() adds the shared
+# tier if one is configured.
+artefact_cache_tiers = [ARTEFACT_CACHE]
+artefact_cache_max_size = {ARTEFACT_CACHE: 2 * 1024 * 1024 * 1024,
+                           TWEAKED_CACHE: 1024 * 1024 * 1024}
+shared_cache_max_size = 20 * 1024 * 1024 * 1024
+shared_cache_trim_interval = 3600
+
+# Where SRs are mounted; a shared tier must be somewhere within one of them.
+shared_cache_roots = ["/var/run/sr-mount", "/run/sr-mount"]
+
+def shared_cache_dir(path):
+    """ Return the real path of path if it is an absolute path within one of
+    shared_cache_roots, otherwise None. """
+    if not path or not os.path.isabs(path):
+        return None
+    real = os.path.realpath(path)
+    for root in shared_cache_roots:
+        if real.startswith(os.path.realpath(root) + "/"):
+            return real
+    return None
+
+def set_shared_cache(path):
+    unindexed_caches.clear()
+    if path and shared_cache_dir(path) is None:
+        xcp.logger.debug("Ignoring shared cache %s: not within %s" %
+                         (path, " or ".join(shared_cache_roots)))
+        path = None
+    if path:
+        path = shared_cache_dir(path)
+        unindexed_caches.add(path)
+        artefact_cache_tiers[1:] = [path]
+        artefact_cache_max_size[path] = shared_cache_max_size
+    else:
+        artefact_cache_tiers[1:] = []
+
+def artefact_cacheable(source):
+    return source[:5] == 'http:' or source[:4] == 'ftp:'
+
+def artefact_key(source):
+    return hashlib.sha1(source).digest()
+
+def entry_path(tier, key):
+    return os.path.join(tier, key.encode('hex'))
+
+def read_artefact_meta(path):
+    meta = {}
+    try:
+        fd = open(path + ".meta")
+    except IOError:
+        return None
+    try:
+        for line in fd:
+            fields = line.rstrip("\n").split(" ", 1)
+            if len(fields) == 2:
+                meta[fields[0]] = fields[1]
+    finally:
+        fd.close()
+    return meta
+
+def find_entry(tier, key):
+    """ Return the metadata of the entry for key in tier, or None. """
+    known, meta = CacheIndex(tier).lookup(key)
+    if not known:
+        meta = read_artefact_meta(entry_path(tier, key))
+    return meta
+
+def response_validators(fd):
+    validators = {}
+    for h in ['ETag', 'Last-Modified']:
+        v = fd.info().getheader(h)
+        if v:
+            validators[h.lower()] = v
+    return validators
+
+def artefact_valid(source, path, meta, limit, expected):
+    """ Return True if the cached entry at path can be used for source. """
+    try:
+        size = int(meta['size'])
+        if size > limit or entry_size(path) != size or not meta.has_key('md5'):
+            return False
+    except (KeyError, ValueError, OSError):
+        return False
+
+    if expected is not None:
+        algo, hexdigest = expected
+        if not meta.has_key(algo):
+            # the index keeps one digest besides the MD5, the .meta file all
+            meta.update(read_artefact_meta(path) or {})
+        if not meta.has_key(algo):
+            # hashing a local copy is still cheaper than downloading it
+            if hash_file(path, algo) != hexdigest:
+                return False
+            meta[algo] = hexdigest
+            record_digest(path, meta)
+        return meta[algo] == hexdigest
+
+    # Nothing to check it against: ask the repository if it has changed.
+    validators = [k for k in ['etag', 'last-modified'] if meta.has_key(k)]
+    if not validators or not source.startswith("http"):
+        return False
+    try:
+        fd = urlopen(source, 'HEAD')
+    except (OSError, urllib2.URLError, IOError):
+        return False
+    try:
+        current = response_validators(fd)
+        length = fd.info().getheader('Content-Length')
+    finally:
+        fd.close()
+    if length is not None and length != meta['size']:
+        return False
+    return True in [current.get(k) == meta[k] for k in validators]
+
+def hash_file(path, algo):
+    h = hashlib.new(algo)
+    fd = open_entry(path)
+    try:
+        view = get_copy_buffer()
+        while True:
+            l = fd.readinto(view)
+            if l == 0:
+                break
+            h.update(view[:l])
+    finally:
+        fd.close()
+    return h.hexdigest()
+
+def record_digest(path, meta):
+    """ Rewrite the .meta file and index record of the entry at path with
+    meta, after a digest has been added to it, so it is never computed
+    again. """
+    tier, name = os.path.split(path)
+    try:
+        tmp = close_mkstemp(dir = tier, prefix = ".publish-")
+        try:
+            f = open(tmp, "w")
+            try:
+                for k, v in meta.items():
+                    if k != 'last-use':
+                        f.write("%s %s\n" % (k, v))
+            finally:
+                f.close()
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path + ".meta")
+        except:
+            os.unlink(tmp)
+            raise
+    except (IOError, OSError), e:
+        xcp.logger.debug("Cannot record digest of %s: %s" % (path, e))
+        return
+    CacheIndex(tier).put(name.decode('hex'), meta)
+
+def publish_artefact(tier, key, src_path, meta, recipe = None):
+    """ Atomically add src_path to tier as the entry for key.  If chunking,
+    recipe may give its chunks, already stored. """
+    chunked = artefact_chunking and tier == ARTEFACT_CACHE
+    try:
+        if not os.path.isdir(tier):
+            os.makedirs(tier)
+        path = entry_path(tier, key)
+        tmp = close_mkstemp(dir = tier, prefix = ".publish-")
+    except (IOError, OSError), e:
+        xcp.logger.debug("Cannot publish to %s: %s" % (tier, e))
+        return
+    try:
+        if chunked:
+            if recipe is None:
+                recipe = chunk_file(src_path)
+            f = open(tmp, "w")
+            try:
+                f.write(format_recipe(recipe))
+            finally:
+                f.close()
+        else:
+            try:
+                os.unlink(tmp)
+                os.link(src_path, tmp)
+            except OSError:
+                shutil.copyfile(src_path, tmp)
+        os.chmod(tmp, 0444)
+
+        f = open(tmp + ".meta", "w")
+        try:
+            for k, v in meta.items():
+                if k != 'last-use':
+                    f.write("%s %s\n" % (k, v))
+        finally:
+            f.close()
+
+        # data first, so a reader that finds the new .meta finds its data
+        enter_critical()
+        try:
+            if chunked:
+                os.rename(tmp, path + ".chunks")
+                if os.path.exists(path):
+                    os.unlink(path)
+            else:
+                os.rename(tmp, path)
+                if os.path.exists(path + ".chunks"):
+                    os.unlink(path + ".chunks")
+            os.rename(tmp + ".meta", path + ".meta")
+            CacheIndex(tier).put(key, meta)
+        finally:
+            leave_critical()
+        xcp.logger.debug("Published %s to %s" % (meta.get('url', path), tier))
+    except (IOError, OSError), e:
+        xcp.logger.debug("Cannot publish to %s: %s" % (tier, e))
+    for f in [tmp, tmp + ".meta"]:
+        if os.path.exists(f):
+            os.unlink(f)
+    trim_artefact_cache(tier)
+
+def trim_artefact_cache(tier):
+    """ Remove the least recently used entries of tier until it fits in its
+    artefact_cache_max_size. """
+    if tier in unindexed_caches:
+        stamp = os.path.join(tier, ".trimmed")
+        try:
+            if time.time() - os.path.getmtime(stamp) < shared_cache_trim_interval:
+                return
+        except OSError:
+            pass
+        try:
+            open(stamp, "w").close()
+        except IOError:
+            return
+    index = CacheIndex(tier)
+    recent = index.records()
+    entries = []
+    total = 0
+    try:
+        names = os.listdir(tier)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith(".") or name.endswith(".meta"):
+            continue
+        if name.endswith(".chunks"):
+            name = name[:-7]
+        try:
+            path = os.path.join(tier, name)
+            last_use = os.path.getmtime(entry_file(path))
+            size = entry_size(path)
+            key = name.decode('hex')
+        except (OSError, TypeError):
+            continue
+        if recent.has_key(key):
+            last_use = float(recent[key]['last-use'])
+        entries.append((last_use, size, key))
+        total += size
+    if total <= artefact_cache_max_size.get(tier, shared_cache_max_size):
+        return
+
+    entries.sort()
+    while total > artefact_cache_max_size.get(tier, shared_cache_max_size) and entries:
+        _, size, key = entries.pop(0)
+        index.remove(key)
+        for f in [".meta", "", ".chunks"]:
+            try:
+                os.unlink(entry_path(tier, key) + f)
+            except OSError:
+                pass
+        total -= size
+    if tier == ARTEFACT_CACHE and os.path.isdir(CHUNK_STORE):
+        gc_chunks()
+
+def install_artefact(path, dest):
+    """ Put a copy of cached file path at dest.  A hard link does, as
+    nothing writes to boot files in place. """
+    tmp = dest + ".link"
+    try:
+        os.link(path, tmp)
+        os.rename(tmp, dest)
+    except OSError:
+        fd_in = open_entry(path)
+        fd_out = open(dest, "wb")
+        try:
+            copyfd(fd_in, fd_out, 1 << 62)
+        finally:
+            fd_out.close()
+            fd_in.close()
+
+def fetch_cached(source, dest, limit, expected, sink):
+    """ Satisfy fetchFile from the artefact cache if possible, returning the
+    MD5 of the content, or None if it's not cached. """
+    key = artefact_key(source)
+    for tier in artefact_cache_tiers:
+        path = entry_path(tier, key)
+        meta = find_entry(tier, key)
+        if meta is None or not artefact_valid(source, path, meta, limit, expected):
+            continue
+
+        CacheIndex(tier).touch(key)
+        if tier != artefact_cache_tiers[0]:
+            meta['url'] = source
+            publish_artefact(artefact_cache_tiers[0], key, path, meta)
+            if os.path.exists(entry_path(artefact_cache_tiers[0], key)):
+                path = entry_path(artefact_cache_tiers[0], key)
+
+        try:
+            install_artefact(path, dest)
+        except (IOError, OSError), e:
+            xcp.logger.debug("Cannot use cached %s: %s" % (path, e))
+            continue
+        if sink is not None:
+            sink.reset()
+            fd = open(dest, "rb")
+            try:
+                copyfd(fd, sink, limit)
+            finally:
+                fd.close()
+                sink.close()
+        xcp.logger.debug("Using cached copy of %s from %s" % (source, tier))
+        return meta['md5']
+    return None
+
+def tweaked_key(digest, compression, overlay):
+    try:
+        st = os.stat(overlay)
+    except OSError:
+        return None
+    return hashlib.sha1("%s %s %s %d %d" % (digest, compression, overlay,
+                                            st.st_mtime, st.st_size)).digest()
+
+def find_tweaked(key):
+    """ Return the path of the cached tweaked initrd for key, or None. """
+    if key is None:
+        return None
+    meta = find_entry(TWEAKED_CACHE, key)
+    path = entry_path(TWEAKED_CACHE, key)
+    try:
+        if meta is None or os.path.getsize(path) != int(meta['size']):
+            return None
+    except (OSError, KeyError, ValueError):
+        return None
+    return path
+
+# MD5 digests of files downloaded by fetchFile, keyed by destination path.
+# These are computed while the data is streamed so that tweak_initrd never has
+# to read a freshly downloaded file again just to checksum it.
+verified_digests = {}
+digests_lock = threading.Lock()
+
+def remember_digest(path, digest):
+    digests_lock.acquire()
+    try:
+        verified_digests[path] = digest
+    finally:
+        digests_lock.release()
+
+def known_digest(path):
+    digests_lock.acquire()
+    try:
+        return verified_digests.get(path)
+    finally:
+        digests_lock.release()
+
 # Modified from host-installer.hg/util.py
 # source may be
 #  http://blah
 #  ftp://blah
 #  file://blah
 #
+# expected may be an (algorithm, hexdigest) tuple, e.g. as returned by
+# find_expected_digest().  The content is hashed as it is copied, and a
+# download which is truncated or does not match is retried immediately, up to
+# fetch_attempts times.  Returns the MD5 of the content.
+#
+# If sink is given, everything written to dest is also written to it as it
+# arrives; sink.reset() is called before each attempt.
+#
+# http and ftp downloads are kept in the artefact cache, and served from it
+# when they're still current.
+#
 # Raises ResourceAccessError or InvalidSource.
 #
-def fetchFile(source, dest, limit):
+def fetchFile(source, dest, limit, expected = None, sink = None):
 
-    if source[:5] != 'http:' and source[:5] != 'file:' and source[:4] != 'ftp:':
+    if source[:5] != 'http:' and source[:5] != 'file:' and source[:4] != 'ftp:' \
+            and source[:4] != 'iso:':
         raise InvalidSource, "Unknown source type."
 
+    cacheable = artefact_cacheable(source)
+    if cacheable:
+        digest = fetch_cached(source, dest, limit, expected, sink)
+        if digest is not None:
+            remember_digest(dest, digest)
+            return digest
+
+    if cacheable and artefact_chunking and source[:5] == 'http:':
+        fetched = fetch_chunked(source, dest, limit, expected, sink)
+        if fetched is not None:
+            digest, validators, recipe = fetched
+            remember_digest(dest, digest)
+            publish_fetched(source, dest, digest, validators, expected, recipe)
+            return digest
+
     # This something that can be fetched using urllib2
     xcp.logger.debug("Fetching '%s' to '%s'" % (source, dest))
 
+    attempt = 1
+    while True:
+        try:
+            digest, validators = fetch_once(source, dest, limit, expected, sink)
+        except DigestMismatch, e:
+            if attempt >= fetch_attempts:
+                raise InvalidSource, str(e)
+        except TransferError, e:
+            if attempt >= fetch_attempts:
+                xcp.logger.debug(str(e))
+                raise ResourceAccessError(source)
+        else:
+            remember_digest(dest, digest)
+            if cacheable:
+                publish_fetched(source, dest, digest, validators, expected)
+            return digest
+
+        xcp.logger.debug("%s, retrying (attempt %d of %d)" %
+                         (e, attempt + 1, fetch_attempts))
+        attempt += 1
+
+def publish_fetched(source, dest, digest, validators, expected, recipe = None):
+    meta = validators
+    meta['size'] = str(os.path.getsize(dest))
+    meta['md5'] = digest
+    if expected is not None:
+        meta[expected[0]] = expected[1]
+    meta['url'] = source
+    key = artefact_key(source)
+    for tier in artefact_cache_tiers:
+        if tier != artefact_cache_tiers[0] and find_entry(tier, key) is not None:
+            # another host got there first; don't copy it over NFS again
+            continue
+        publish_artefact(tier, key, dest, meta, recipe)
+
+def fetch_once(source, dest, limit, expected, sink):
     # Actually get the file
     try:
-        fd = urllib2.urlopen(source)
+        fd = urlopen(source)
         try:
             length = int(fd.info().getheader('content-length', None))
         except (ValueError, TypeError):
@@ -318,24 +2964,171 @@ def fetchFile(source, dest, limit):
     except (OSError, urllib2.HTTPError, urllib2.URLError, IOError):
         log_exception("ERROR: ", traceback.format_exc())
         raise ResourceAccessError(source)
-    fd_dest = open(dest, 'wb')
 
-    dest_len, success = copyfd(fd, fd_dest, limit)
+    # No point transferring anything if the server has told us it's too big.
+    if length is not None and length > limit:
+        fd.close()
+        raise ResourceTooLarge("File '%s' exceeds limit of %d bytes"
+                               % (source, limit))
+
+    md5 = hashlib.md5()
+    digests = [md5]
+    check = None
+    if expected is not None:
+        algo, hexdigest = expected
+        if algo == 'md5':
+            check = md5
+        else:
+            try:
+                check = hashlib.new(algo)
+            except ValueError:
+                fd.close()
+                raise InvalidSource("Unknown digest algorithm '%s' for '%s'" % (algo, source))
+            digests.append(check)
+
+    start = time.time()
+    try:
+        try:
+            fd_dest = open(dest, 'wb')
+            if sink is not None:
+                sink.reset()
+                fd_dest = TeeFile(fd_dest, sink)
+            try:
+                dest_len, success = copyfd(fd, fd_dest, limit, digests)
+            finally:
+                fd_dest.close()
+        except socket.error, e:
+            raise TransferError("Error during download of '%s': %s" % (source, e))
+    finally:
+        fd.close()
 
     dbg = ""
     if length is not None:
         dbg = "  expecting %d bytes, " % (length, )
     xcp.logger.debug(dbg + "got %d bytes, limit %d bytes" % (dest_len, limit))
 
-    fd_dest.close()
-    fd.close()
+    elapsed = time.time() - start
+    if hasattr(fd, 'geturl') and elapsed > 0:
+        mirror = mirror_of(fd.geturl())
+        if mirror is not None:
+            record_mirror(mirror, throughput = dest_len / elapsed)
 
     if not success:
         raise ResourceTooLarge("File '%s' exceeds limit of %d bytes"
                                % (source, limit))
 
     if length is not None and length != dest_len:
-        raise IOError("Closed connection during download")
+        raise TransferError("Closed connection during download of '%s'" % source)
+
+    if check is not None:
+        if check.hexdigest() != hexdigest:
+            raise DigestMismatch("'%s' has %s %s, repository says %s" %
+                                 (source, algo, check.hexdigest(), hexdigest))
+        xcp.logger.debug("Verified %s %s" % (algo, hexdigest))
+
+    return md5.hexdigest(), response_validators(fd)
+
+class TeeFile:
+    """ Write to a file and to a sink at the same time. """
+    def __init__(self, fd, sink):
+        self.fd = fd
+        self.sink = sink
+    def write(self, block):
+        self.fd.write(block)
+        self.sink.write(block)
+    def close(self):
+        self.fd.close()
+        self.sink.close()
+
+# Repositories publish checksums of their boot images in a variety of formats.
+# Each parser turns the content of one of these files into a dictionary
+# mapping a path, relative to the directory containing the file, to an
+# (algorithm, hexdigest) tuple.
+
+def parse_treeinfo(data):
+    """ Anaconda .treeinfo: 'path = sha256:digest' in [checksums]. """
+    cp = ConfigParser.RawConfigParser()
+    cp.optionxform = str
+    cp.readfp(StringIO.StringIO(data))
+    rc = {}
+    if cp.has_section('checksums'):
+        for path, value in cp.items('checksums'):
+            if ':' in value:
+                algo, hexdigest = value.split(':', 1)
+                rc[path] = (algo.strip().lower(), hexdigest.strip().lower())
+    return rc
+
+def parse_suse_content(data):
+    """ SUSE media 'content' file: 'HASH SHA256 digest  path'.  META lines
+    name files relative to the descr directory, so aren't ours. """
+    rc = {}
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) == 4 and fields[0] == 'HASH':
+            rc[fields[3]] = (fields[1].lower(), fields[2].lower())
+    return rc
+
+def sums_parser(algo):
+    """ Return a parser for md5sum/sha256sum style output: 'digest  path'. """
+    def parse(data):
+        rc = {}
+        for line in data.splitlines():
+            fields = line.split()
+            if len(fields) != 2:
+                continue
+            path = fields[1]
+            if path.startswith('./'):
+                path = path[2:]
+            rc[path] = (algo, fields[0].lower())
+        return rc
+    return parse
+
+# Parsed checksum files, keyed by URL, so each is fetched at most once a run.
+repo_digests = {}
+
+def find_repo_digests(index_url, parser):
+    digests_lock.acquire()
+    try:
+        if repo_digests.has_key(index_url):
+            return repo_digests[index_url]
+    finally:
+        digests_lock.release()
+
+    rc = {}
+    try:
+        fd = urlopen(index_url)
+        try:
+            data = fd.read(repo_metadata_max_size)
+        finally:
+            fd.close()
+        rc = parser(data)
+    except (StandardError, ConfigParser.Error):
+        xcp.logger.debug("No usable checksums at " + index_url)
+
+    digests_lock.acquire()
+    try:
+        # another thread may have fetched it meanwhile; either will do
+        repo_digests[index_url] = rc
+    finally:
+        digests_lock.release()
+    return rc
+
+# Return the (algorithm, hexdigest) the repository publishes for url in the
+# checksum file at index_url, or None if it doesn't.
+def find_expected_digest(index_url, parser, url):
+    base = index_url[:index_url.rfind('/') + 1]
+    if not url.startswith(base):
+        return None
+    digests = find_repo_digests(index_url, parser)
+    path = url[len(base):]
+    if not digests.has_key(path):
+        return None
+    try:
+        hashlib.new(digests[path][0])
+    except ValueError:
+        xcp.logger.debug("Cannot verify %s: unknown algorithm %s" % (url, digests[path][0]))
+        return None
+    return digests[path]
 
 # Test existence of a file
 # just return True for "exists" or False for "does not exist"
@@ -343,17 +3136,17 @@ def fetchFile(source, dest, limit):
 # Raises InvalidSource.
 def checkFile(source):
 
-    if source[:5] != 'http:' and source[:5] != 'file:' and source[:4] != 'ftp:':
+    if source[:5] != 'http:' and source[:5] != 'file:' and source[:4] != 'ftp:' \
+            and source[:4] != 'iso:':
         raise InvalidSource, "Unknown source type."
 
     # This something that can be fetched using urllib2
     xcp.logger.debug("Checking " + source)
     try:
-        request = urllib2.Request(source)
+        method = None
         if source[:5] == 'http:':
-            request.get_method = lambda : 'HEAD'
-        fd = urllib2.urlopen(request)
-        fd.close()
+            method = 'HEAD'
+        urlopen(source, method).close()
         return True
     except StandardError:
         return False
@@ -363,15 +3156,14 @@ def close_mkstemp(dir = None, prefix = 'tmp'):
     os.close(fd)
     return name
 
-def canonicaliseOtherConfig(vm_uuid):
-    session = XenAPI.xapi_local()
-    session.login_with_password("", "", "", PROGRAM_NAME)
-    try:
-        vm = session.xenapi.VM.get_by_uuid(vm_uuid)
-        other_config = session.xenapi.VM.get_other_config(vm)
-    finally:
-        session.logout()
+def get_pool_config(session):
+    pool_config = {}
+    for pool in session.xenapi.pool.get_all():
+        pool_config = session.xenapi.pool.get_other_config(pool)
+    return pool_config
 
+def canonicalise(other_config, pool_config):
+    """ Fill in the defaults of the other-config keys we use. """
     def collect(d, k, default = None):
         if d.has_key(k):
             return d[k]
@@ -387,12 +3179,18 @@ def canonicaliseOtherConfig(vm_uuid):
            'install-kernel':     collect(other_config, 'install-kernel', None),
            'install-ramdisk':    collect(other_config, 'install-ramdisk', None),
            'install-proxy':      collect(other_config, 'install-proxy', None),
+           'install-initrd-compression': collect(other_config, 'install-initrd-compression', 'none'),
+           'install-initrd-pipeline': collect(other_config, 'install-initrd-pipeline', 'auto'),
+           'install-mirrors':    collect(other_config, 'install-mirrors', None),
+           'install-cache-proxy': collect(pool_config, 'install-cache-proxy', None),
+           'install-shared-cache': collect(pool_config, 'install-shared-cache', None),
            'debian-release':     collect(other_config, 'debian-release') }
     return rc
 
-def propagatePostinstallLimits(session, vm):
+def propagatePostinstallLimits(session, vm, platform = None):
 
-    platform = session.xenapi.VM.get_platform(vm)
+    if platform is None:
+        platform = session.xenapi.VM.get_platform(vm)
 
     try:
         key_from = "pv-postinstall-kernel-max-size"
@@ -414,77 +3212,236 @@ def propagatePostinstallLimits(session, vm):
     except StandardError:
         pass
 
-def switchBootloader(vm_uuid, target_bootloader = "pygrub"):
+def switchBootloader(vm_uuid, target_bootloader = "pygrub", platform = None):
     if never_latch: return
     session = XenAPI.xapi_local()
     session.login_with_password("", "", "", PROGRAM_NAME)
     try:
-        xcp.logger.debug("Switching to " + target_bootloader)
         vm = session.xenapi.VM.get_by_uuid(vm_uuid)
-        session.xenapi.VM.set_PV_bootloader(vm, target_bootloader)
-        propagatePostinstallLimits(session, vm)
+        switch_bootloader(session, vm, platform, target_bootloader)
     finally:
         session.logout()
 
-def unpack_cpio_initrd(filename, working_dir):
+def switch_bootloader(session, vm, platform = None, target_bootloader = "pygrub"):
+    xcp.logger.debug("Switching to " + target_bootloader)
+    session.xenapi.VM.set_PV_bootloader(vm, target_bootloader)
+    propagatePostinstallLimits(session, vm, platform)
+
+def unpack_cpio_initrd(filename, working_dir, limit = pv_initrd_max_size):
     xcp.logger.debug("Unpacking cpio '%s' into '%s'" % (filename, working_dir))
     prog = get_decompressor(filename)
 
-    if prog is not None:
-        decomp = subprocess.Popen(prog + [filename], stdout = subprocess.PIPE)
-        source = decomp.stdout
-    else:
-        source = open(filename)
-
-    cpio = subprocess.Popen(["/bin/cpio", "-idu", "--quiet"], cwd = working_dir,
-                            stdin = subprocess.PIPE)
+    watchdog = Watchdog('unpack')
+    try:
+        if prog is not None:
+            decomp = subprocess.Popen(prog + [filename], stdout = subprocess.PIPE,
+                                      preexec_fn = helper_preexec)
+            watchdog.add(decomp)
+            source = decomp.stdout
+        else:
+            source = open(filename)
 
-    dest_len, success = copyfd(source, cpio.stdin, pv_initrd_max_size)
-    xcp.logger.debug("  got %d bytes, limit %d bytes" % (dest_len, pv_initrd_max_size))
+        cpio = subprocess.Popen(["/bin/cpio", "-idu", "--quiet"], cwd = working_dir,
+                                stdin = subprocess.PIPE, preexec_fn = helper_preexec)
+        watchdog.add(cpio)
 
-    cpio.stdin.close()
-    cpio.wait()
+        try:
+            dest_len, success = copyfd(source, cpio.stdin, limit)
+            xcp.logger.debug("  got %d bytes, limit %d bytes" % (dest_len, limit))
+        finally:
+            cpio.stdin.close()
+            cpio.wait()
 
-    source.close()
-    if prog is not None:
-        decomp.wait()
+            source.close()
+            if prog is not None:
+                decomp.wait()
+    finally:
+        watchdog.stop()
 
     if not success:
         raise ResourceTooLarge("Unpacking cpio '%s' exceeds limit of %d bytes"
-                               % (filename, pv_initrd_max_size))
+                               % (filename, limit))
 
-def mount_ext2_initrd(infile, outfile, working_dir):
-    xcp.logger.debug("Mounting ext2 '%s' on '%s'" % (infile, outfile))
+def decompress_ext2_initrd(infile, outfile, limit = pv_initrd_max_size):
+    xcp.logger.debug("Decompressing ext2 '%s' to '%s'" % (infile, outfile))
     prog = get_decompressor(infile)
 
-    if prog is not None:
-        decomp = subprocess.Popen(prog + [infile], stdout = subprocess.PIPE)
-        source = decomp.stdout
-    else:
-        source = open(infile)
-
-    dest = open(outfile, "w")
+    watchdog = Watchdog('unpack')
+    try:
+        if prog is not None:
+            decomp = subprocess.Popen(prog + [infile], stdout = subprocess.PIPE,
+                                      preexec_fn = helper_preexec)
+            watchdog.add(decomp)
+            source = decomp.stdout
+        else:
+            source = open(infile)
 
-    dest_len, success = copyfd(source, dest, pv_initrd_max_size)
-    xcp.logger.debug("  got %d bytes, limit %d bytes" % (dest_len, pv_initrd_max_size))
+        dest = open(outfile, "wb")
 
-    dest.close()
+        try:
+            dest_len, success = copyfd(source, dest, limit)
+            xcp.logger.debug("  got %d bytes, limit %d bytes" % (dest_len, limit))
+        finally:
+            dest.close()
 
-    source.close()
-    if prog is not None:
-        decomp.wait()
+            source.close()
+            if prog is not None:
+                decomp.wait()
+    finally:
+        watchdog.stop()
 
     if not success:
         raise ResourceTooLarge("Unpacking cpio '%s' exceeds limit of %d bytes"
-                               % (infile, pv_initrd_max_size))
+                               % (infile, limit))
 
+def mount_ext2_initrd(infile, outfile, working_dir, limit = pv_initrd_max_size):
+    xcp.logger.debug("Mounting ext2 '%s' on '%s'" % (infile, outfile))
+    decompress_ext2_initrd(infile, outfile, limit)
     mount(outfile, working_dir, options = ['loop'])
 
+# Patching ext2 images in place with debugfs, rather than loop-mounting them,
+# means tweaking old initrds needs neither loop devices nor the mount lock.
+# debugfs reads its commands a line at a time and splits them on whitespace,
+# so names and symlink targets holding whitespace, quotes or control
+# characters can't be given to it.
+
+def check_debugfs_arg(arg):
+    if re.search(r'[\s"\x00-\x1f\x7f]', arg):
+        raise Ext2PatchError("Cannot express %r to debugfs" % arg)
+
+def run_debugfs(image, commands, writable = False, strict = True):
+    """ Run commands as a single debugfs batch against image and return its
+    output.  If strict, any error reported by debugfs raises Ext2PatchError
+    since it carries on with the rest of the batch regardless. """
+
+    cmd_file = close_mkstemp(dir = "/tmp", prefix = "debugfs-")
+    try:
+        fd = open(cmd_file, "w")
+        fd.write("\n".join(commands) + "\n")
+        fd.close()
+
+        cmd = [DEBUGFS, "-f", cmd_file, image]
+        if writable:
+            cmd.insert(1, "-w")
+        (rc, out, err) = run_command(cmd, 'debugfs')
+    finally:
+        os.unlink(cmd_file)
+
+    # The version banner is always printed on stderr.
+    errors = [l for l in err.splitlines() if l.strip() and not l.startswith("debugfs ")]
+    if rc != 0 or (strict and errors):
+        raise Ext2PatchError("debugfs failed on '%s': %s" % (image, "; ".join(errors)))
+    return out
+
+def list_ext2_dirs(image, dirs):
+    """ Return a dictionary mapping each directory in dirs that exists in
+    image to a dictionary of its entries' names and modes. """
+
+    out = run_debugfs(image, ["ls -p " + d for d in dirs], strict = False)
+
+    rc = {}
+    entries = None
+    for line in out.splitlines():
+        if line.startswith("debugfs: ls -p "):
+            entries = {}
+            rc[line[len("debugfs: ls -p "):]] = entries
+        elif entries is not None and line.startswith("/"):
+            # /inode/mode/uid/gid/name/size/
+            fields = line.split("/")
+            if len(fields) >= 7 and fields[5] not in ['.', '..']:
+                entries[fields[5]] = int(fields[2], 8)
+    # directories that don't exist are reported on stderr, and have no entries
+    for d in rc.keys():
+        if not rc[d]:
+            del rc[d]
+    return rc
+
+def patch_ext2_image(image, overlay_dir):
+    """ Copy the tree at overlay_dir into the ext2 filesystem image, replacing
+    any files already there, using a single batch of debugfs writes. """
+
+    xcp.logger.debug("Patching ext2 '%s' from '%s'" % (image, overlay_dir))
+
+    # the directories we create or write into, parents first
+    dirs = ['/']
+    for root, ds, files in os.walk(overlay_dir):
+        base = root[len(overlay_dir):] or '/'
+        for d in ds:
+            path = os.path.join(base, d)
+            if os.path.islink(os.path.join(root, d)):
+                continue
+            dirs.append(path)
+
+    for path in dirs:
+        check_debugfs_arg(path)
+
+    existing = list_ext2_dirs(image, dirs)
+
+    commands = []
+    for root, ds, files in os.walk(overlay_dir):
+        base = root[len(overlay_dir):] or '/'
+        present = {}
+        if existing.has_key(base):
+            present = existing[base]
+        commands.append("cd " + base)
+
+        for name in ds + files:
+            check_debugfs_arg(name)
+
+            local = os.path.join(root, name)
+            path = os.path.join(base, name)
+            st = os.lstat(local)
+
+            if stat.S_ISDIR(st.st_mode):
+                if not present.has_key(name):
+                    commands.append("mkdir " + name)
+                elif not stat.S_ISDIR(present[name]):
+                    raise Ext2PatchError("'%s' is not a directory in '%s'" % (path, image))
+            else:
+                if present.has_key(name):
+                    if stat.S_ISDIR(present[name]):
+                        raise Ext2PatchError("'%s' is a directory in '%s'" % (path, image))
+                    commands.append("rm " + name)
+
+                if stat.S_ISREG(st.st_mode):
+                    commands.append("write %s %s" % (local, name))
+                elif stat.S_ISLNK(st.st_mode):
+                    target = os.readlink(local)
+                    check_debugfs_arg(target)
+                    commands.append("symlink %s %s" % (name, target))
+                elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                    kind = stat.S_ISCHR(st.st_mode) and 'c' or 'b'
+                    commands.append("mknod %s %s %d %d" % (name, kind,
+                                                           os.major(st.st_rdev),
+                                                           os.minor(st.st_rdev)))
+                elif stat.S_ISFIFO(st.st_mode):
+                    commands.append("mknod %s p" % name)
+                else:
+                    raise Ext2PatchError("Cannot copy '%s' into '%s'" % (local, image))
+
+            if not stat.S_ISLNK(st.st_mode):
+                commands.append("sif %s mode 0%o" % (name, st.st_mode))
+            commands.append("sif %s uid %d" % (name, st.st_uid))
+            commands.append("sif %s gid %d" % (name, st.st_gid))
+
+    run_debugfs(image, commands, writable = True)
+
+def patch_ext2_initrd(infile, outfile, cpio_overlay, limit = pv_initrd_max_size):
+    """ Decompress the ext2 initrd infile to outfile and apply cpio_overlay
+    to it, all without mounting anything. """
+
+    overlay_dir = tempfile.mkdtemp(dir = "/tmp", prefix = "initrd-overlay-")
+    try:
+        decompress_ext2_initrd(infile, outfile, limit)
+        unpack_cpio_initrd(cpio_overlay, overlay_dir)
+        patch_ext2_image(outfile, overlay_dir)
+    finally:
+        shutil.rmtree(overlay_dir)
+
 def md5sum(filename):
-    p = subprocess.Popen(["md5sum", filename], stdout=subprocess.PIPE)
-    stdout, _ = p.communicate()
+    (rc, stdout, _) = run_command(["md5sum", filename], 'md5sum')
 
-    if p.returncode != 0:
+    if rc != 0:
         raise InvalidSource("md5sum command failed.")
     return stdout.split()[0]
 
@@ -494,57 +3451,309 @@ def log_exception(prefix, backtrace):
 
 #### INITRD TWEAKING
 
-def mkcpio(working_dir, output_file):
+def get_compressor(compression):
+    """ Return the command to compress stdin to stdout according to the
+    install-initrd-compression setting compression, or None if the output
+    should be left uncompressed. """
+
+    fields = compression.split(':')
+    fmt = fields[0]
+    if fmt == 'none':
+        return None
+    if fmt not in ['gzip', 'xz'] or len(fields) > 3:
+        raise UnsupportedInstallMethod, \
+            "other-config:install-initrd-compression '%s' is not supported." % compression
+
+    try:
+        level = None
+        if len(fields) > 1 and fields[1] != '':
+            level = int(fields[1], 10)
+            if level < 0 or level > 9:
+                raise ValueError
+        threads = 0
+        if len(fields) > 2 and fields[2] != '':
+            threads = int(fields[2], 10)
+            if threads < 0:
+                raise ValueError
+    except ValueError:
+        raise UnsupportedInstallMethod, \
+            "other-config:install-initrd-compression '%s' is not supported." % compression
+    if threads == 0:
+        threads = helper_threads()
+
+    if fmt == 'gzip':
+        if threads > 1 and os.path.exists(PIGZ):
+            cmd = [PIGZ, "-c", "-p", "%d" % threads]
+        else:
+            cmd = ["/bin/gzip", "-c"]
+    else:
+        # The kernel's xz decoder only understands CRC32 integrity checks.
+        # Threaded xz splits its output into blocks, which it handles too.
+        cmd = [XZ, "-c", "--check=crc32", "--threads=%d" % threads]
+    if level is not None:
+        cmd.append("-%d" % level)
+    return cmd
+
+def mkcpio(working_dir, output_file, compressor = None):
     """ Make a cpio archive containg the files in working_dir, writing the
-    archive to output_file.  It will be uncompressed. """
+    archive to output_file.  If compressor is given the archive is piped
+    through it on its way to output_file, otherwise it will be uncompressed. """
 
     xcp.logger.debug("Building initrd from " + working_dir)
 
     # set output_file to be a full path so that we don't create the output
     # file under the new working directory of the cpio process.
     output_file = os.path.realpath(output_file)
-    cpio = subprocess.Popen(["/bin/cpio", "-F", output_file, "-oH", "newc",
-                             "--quiet"], cwd = working_dir,
-                            stdin = subprocess.PIPE, stdout = None)
+    watchdog = Watchdog('pack')
+    try:
+        if compressor is None:
+            cpio = subprocess.Popen(["/bin/cpio", "-F", output_file, "-oH", "newc",
+                                     "--quiet"], cwd = working_dir,
+                                    stdin = subprocess.PIPE, stdout = None,
+                                    preexec_fn = helper_preexec)
+            watchdog.add(cpio)
+        else:
+            xcp.logger.debug("Compressing with " + " ".join(compressor))
+            dest = open(output_file, "wb")
+            cpio = subprocess.Popen(["/bin/cpio", "-oH", "newc", "--quiet"],
+                                    cwd = working_dir, stdin = subprocess.PIPE,
+                                    stdout = subprocess.PIPE, preexec_fn = helper_preexec)
+            watchdog.add(cpio)
+            comp = subprocess.Popen(compressor, stdin = cpio.stdout, stdout = dest,
+                                    preexec_fn = helper_preexec)
+            watchdog.add(comp)
+            cpio.stdout.close()
+            dest.close()
 
-    for root, ds, files in os.walk(working_dir):
-        assert root.startswith(working_dir), "Root of current walk path starts with original walk path"
-        base = root[len(working_dir) + 1:]
-        for f in files + ds:
-            path = os.path.join(base, f)
-            cpio.stdin.write(path + "\n")
+        try:
+            for root, ds, files in os.walk(working_dir):
+                assert root.startswith(working_dir), "Root of current walk path starts with original walk path"
+                base = root[len(working_dir) + 1:]
+                for f in files + ds:
+                    path = os.path.join(base, f)
+                    cpio.stdin.write(path + "\n")
+        finally:
+            cpio.stdin.close()
+            cpio.wait()
+            if compressor is not None:
+                comp.wait()
+    finally:
+        watchdog.stop()
+
+    if compressor is not None:
+        if comp.returncode != 0 or cpio.returncode != 0:
+            raise InvalidSource("Compressing initrd '%s' failed." % output_file)
+
+# Creation of a StreamingUnpacker makes a temporary directory, which is removed
+# automatically when the object goes out of scope unless tweak_initrd has
+# taken it over.
+class StreamingUnpacker:
+    """ A fetchFile sink that unpacks a cpio initrd into a temporary directory
+    while it is being downloaded, so that tweak_initrd doesn't have to read
+    it back and unpack it once the download is complete. """
+
+    def __init__(self, limit = pv_initrd_max_size):
+        self.limit = limit
+        self.working_dir = None
+        self.procs = []
+        self.pump = None
+        self.feed = None
+        self.watchdog = None
+        self.failed = False
+        self.complete = False
+        self.result = None
+
+    def reset(self):
+        self.abort()
+        self.working_dir = tempfile.mkdtemp(dir = "/tmp", prefix = "initrd-fixup-")
+        self.failed = False
+        self.complete = False
+
+    def start(self, header):
+        compression = sniff_compression(header)
+        if compression is None and not header.startswith("07070"):
+            # nothing we can unpack on the fly, e.g. an ext2 image
+            self.failed = True
+            return
+
+        cpio = subprocess.Popen(["/bin/cpio", "-idu", "--quiet"], cwd = self.working_dir,
+                                stdin = subprocess.PIPE, preexec_fn = helper_preexec)
+        self.procs.append(cpio)
+        self.watchdog = Watchdog('unpack', [cpio])
+        if compression is None:
+            self.feed = cpio.stdin
+            return
+
+        decomp = subprocess.Popen(decompressor_for(compression), stdin = subprocess.PIPE,
+                                  stdout = subprocess.PIPE, preexec_fn = helper_preexec)
+        self.procs.insert(0, decomp)
+        self.watchdog.add(decomp)
+        self.feed = decomp.stdin
+
+        # Pump the decompressed stream into cpio, enforcing the size limit.
+        def pump():
+            try:
+                try:
+                    self.result = copyfd(decomp.stdout, cpio.stdin, self.limit)
+                except (IOError, OSError):
+                    self.result = None
+            finally:
+                decomp.stdout.close()
+                cpio.stdin.close()
+        self.pump = threading.Thread(target = pump)
+        # a sink never closed mustn't keep the bootloader from exiting
+        self.pump.setDaemon(True)
+        self.pump.start()
+
+    def write(self, block):
+        if self.failed:
+            return
+        if self.feed is None:
+            header = block[:6]
+            if isinstance(header, memoryview):
+                header = header.tobytes()
+            self.start(header)
+            if self.failed:
+                return
+        try:
+            self.feed.write(block)
+        except (IOError, OSError):
+            # the decompressor or cpio gave up; tweak_initrd will start over
+            self.failed = True
+
+    def close(self):
+        if self.feed is not None:
+            try:
+                self.feed.close()
+            except (IOError, OSError):
+                self.failed = True
+            self.feed = None
+        if self.pump is not None:
+            self.pump.join()
+            self.pump = None
+            if self.result is None or not self.result[1]:
+                self.failed = True
+        for p in self.procs:
+            if p.wait() != 0:
+                self.failed = True
+        self.procs = []
+        if self.watchdog is not None:
+            try:
+                self.watchdog.stop()
+            except StepTimeout, e:
+                # tweak_initrd will start over
+                xcp.logger.debug(str(e))
+                self.failed = True
+            self.watchdog = None
+        self.complete = not self.failed
+        if self.complete:
+            xcp.logger.debug("Unpacked initrd into '%s' while downloading" % self.working_dir)
+
+    def abort(self):
+        for p in self.procs:
+            try:
+                os.kill(p.pid, 9)
+            except OSError:
+                pass
+        self.close()
+        if self.working_dir:
+            shutil.rmtree(self.working_dir, True)
+            self.working_dir = None
+
+    def claim(self):
+        """ Hand over the unpacked tree; the caller must remove it. """
+        working_dir = self.working_dir
+        self.working_dir = None
+        return working_dir
+
+    def __del__(self):
+        # if we're getting called due to an unhandled exception, the
+        # os and shutil modules may have already been unloaded
+        import os
+        import shutil
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+        for p in self.procs:
+            try:
+                os.kill(p.pid, 9)
+            except OSError:
+                pass
+        if self.working_dir:
+            shutil.rmtree(self.working_dir, True)
 
-    cpio.communicate()
+def initrd_unpacker(expected, other_config):
+    """ Return a StreamingUnpacker to pass to fetchFile for the ramdisk if
+    other-config:install-initrd-pipeline says it's worth unpacking while
+    downloading, otherwise None. """
 
-def tweak_initrd(filename):
+    setting = other_config['install-initrd-pipeline']
+    if not cpio_initrd_fixups or setting == 'false':
+        return None
+    if expected is not None and expected[0] == 'md5' and \
+            cpio_initrd_fixups.has_key(expected[1]):
+        overlay = os.path.join(guest_installer_dir, cpio_initrd_fixups[expected[1]])
+        if find_tweaked(tweaked_key(expected[1], other_config['install-initrd-compression'],
+                                    overlay)):
+            # tweak_initrd won't need to unpack it at all
+            return None
+    if setting == 'true':
+        return StreamingUnpacker(other_config.initrd_max_size)
+    # 'auto': only if the repository tells us up front we'll need it
+    if expected is not None and expected[0] == 'md5' and \
+            cpio_initrd_fixups.has_key(expected[1]):
+        return StreamingUnpacker(other_config.initrd_max_size)
+    return None
+
+def tweak_initrd(filename, compression = 'none', unpacker = None,
+                 limit = pv_initrd_max_size):
     """ Patch an initrd with custom files if they are available.  Returns the
     filename of a patched initrd that should be used instead of the file as
     passed in as filename.  The caller is responsible for removing the old
-    version of the initrd. """
-
-    digest = md5sum(filename)
+    version of the initrd.  Rebuilt cpio initrds are compressed according to
+    compression, an install-initrd-compression setting.  If unpacker is the
+    StreamingUnpacker the initrd was downloaded through, its tree is used
+    rather than unpacking filename again.  The unpacked initrd may be no
+    larger than limit. """
+
+    digest = known_digest(filename)
+    if digest is None:
+        digest = md5sum(filename)
     initrd_path = None
     _initrd_path = None
 
     xcp.logger.debug(filename + " has MD5 " + digest)
 
     if cpio_initrd_fixups.has_key(digest):
-        # we can patch this initrd, let's unpack it to a temporary directory:
         xcp.logger.debug("Fixup with " + cpio_initrd_fixups[digest])
-        working_dir = tempfile.mkdtemp(dir = "/tmp", prefix = "initrd-fixup-")
         cpio_overlay = os.path.join(guest_installer_dir, cpio_initrd_fixups[digest])
         if not os.path.isfile(cpio_overlay):
             raise SupportPackageMissing, "Dom0 does not contain a required file: %s" % cpio_overlay
 
+        key = tweaked_key(digest, compression, cpio_overlay)
+        initrd_path = reuse_tweaked(key)
+        if initrd_path:
+            if unpacker is not None:
+                unpacker.abort()
+            return initrd_path
+
+        # we can patch this initrd, let's unpack it to a temporary directory:
+        compressor = get_compressor(compression)
+        unpacked = unpacker is not None and unpacker.complete
+        if unpacked:
+            working_dir = unpacker.claim()
+        else:
+            working_dir = tempfile.mkdtemp(dir = "/tmp", prefix = "initrd-fixup-")
+
         try:
             try:
                 # unpack the vendor initrd, then unpack our changes over it:
-                unpack_cpio_initrd(filename, working_dir)
+                if not unpacked:
+                    unpack_cpio_initrd(filename, working_dir, limit)
                 unpack_cpio_initrd(cpio_overlay, working_dir)
 
                 # now repack to make the final image:
                 _initrd_path = close_mkstemp(dir = BOOTDIR, prefix="tweaked-initrd-")
-                mkcpio(working_dir, _initrd_path)
+                mkcpio(working_dir, _initrd_path, compressor)
             except:
                 xcp.logger.debug("Cleaning '%s' and '%s'" % (working_dir, _initrd_path))
                 raise
@@ -556,20 +3765,39 @@ def tweak_initrd(filename):
             shutil.rmtree(working_dir)
             if _initrd_path:
                 os.unlink(_initrd_path)
+        publish_tweaked(key, initrd_path, digest, compression)
 
     elif ext2_initrd_fixups.has_key(digest):
-        # we can patch this initrd, let's unpack it to a temporary directory:
-        working_dir = tempfile.mkdtemp(dir = "/tmp", prefix = "initrd-fixup-")
         cpio_overlay = os.path.join(guest_installer_dir, ext2_initrd_fixups[digest])
         if not os.path.isfile(cpio_overlay):
             raise SupportPackageMissing, "Dom0 does not contain a required file: %s" % cpio_overlay
 
+        # the compression setting doesn't apply to ext2 images
+        key = tweaked_key(digest, 'ext2', cpio_overlay)
+        initrd_path = reuse_tweaked(key)
+        if initrd_path:
+            return initrd_path
+
+        # we can patch this initrd, let's unpack it to a temporary directory:
+        working_dir = tempfile.mkdtemp(dir = "/tmp", prefix = "initrd-fixup-")
+
+        mounted = False
         try:
             try:
-                # unpack the vendor initrd, then unpack our changes over it:
                 _initrd_path = close_mkstemp(dir = BOOTDIR, prefix="tweaked-initrd-")
-                mount_ext2_initrd(filename, _initrd_path, working_dir)
-                unpack_cpio_initrd(cpio_overlay, working_dir)
+                patched = False
+                if os.path.exists(DEBUGFS):
+                    try:
+                        patch_ext2_initrd(filename, _initrd_path, cpio_overlay, limit)
+                        patched = True
+                    except Ext2PatchError, e:
+                        xcp.logger.debug("%s, falling back to loop mount" % e)
+
+                if not patched:
+                    # unpack the vendor initrd, then unpack our changes over it:
+                    mount_ext2_initrd(filename, _initrd_path, working_dir, limit)
+                    mounted = True
+                    unpack_cpio_initrd(cpio_overlay, working_dir)
             except:
                 xcp.logger.debug("Cleaning '%s' and '%s'" % (working_dir, _initrd_path))
                 raise
@@ -577,30 +3805,208 @@ def tweak_initrd(filename):
                 initrd_path = _initrd_path
                 _initrd_path = None
         finally:
-            umount(working_dir)
+            if mounted:
+                umount(working_dir)
             shutil.rmtree(working_dir)
             if _initrd_path:
                 os.unlink(_initrd_path)
+        publish_tweaked(key, initrd_path, digest, 'ext2')
 
     return initrd_path
 
-def tweak_bootable_disk(vm):
-    if never_latch: return
+def reuse_tweaked(key):
+    """ Return a copy in BOOTDIR of the cached tweaked initrd for key, or
+    None if there isn't one. """
+    path = find_tweaked(key)
+    if path is None:
+        return None
+    dest = close_mkstemp(dir = BOOTDIR, prefix="tweaked-initrd-")
+    try:
+        install_artefact(path, dest)
+    except (IOError, OSError), e:
+        xcp.logger.debug("Cannot use cached %s: %s" % (path, e))
+        os.unlink(dest)
+        return None
+    CacheIndex(TWEAKED_CACHE).touch(key)
+    xcp.logger.debug("Using cached tweaked initrd %s" % path)
+    return dest
+
+def publish_tweaked(key, initrd_path, digest, compression):
+    if key is not None:
+        publish_artefact(TWEAKED_CACHE, key, initrd_path,
+                         { 'size': str(os.path.getsize(initrd_path)), 'vendor-md5': digest,
+                           'compression': compression })
+
+# Working out which disk to boot from next time takes a handful of xapi
+# calls, which handle_first_boot overlaps with fetching the installer.  The
+# flags are only set once the fetch has succeeded, so that a failed start
+# still boots from the CD when it is retried.
+
+def plan_bootable_disk(vm_ref):
+    """ Return a logged in session and the bootable flag each of vm_ref's
+    VBDs should have, bootable = (device == 0), for apply_bootable_disk. """
     session = XenAPI.xapi_local()
     session.xenapi.login_with_password("", "", "", PROGRAM_NAME)
     try:
-        # get all VBDs, set bootable = (device == 0):
-        vm_ref = session.xenapi.VM.get_by_uuid(vm)
-        vbds = session.xenapi.VM.get_VBDs(vm_ref)
+        changes = [(vbd, session.xenapi.VBD.get_userdevice(vbd) == "0")
+                   for vbd in session.xenapi.VM.get_VBDs(vm_ref)]
+    except:
+        session.logout()
+        raise
+    return session, changes
 
-        for vbd in vbds:
-            session.xenapi.VBD.set_bootable(vbd, session.xenapi.VBD.get_userdevice(vbd) == "0")
+def apply_bootable_disk(session, changes):
+    try:
+        for vbd, bootable in changes:
+            session.xenapi.VBD.set_bootable(vbd, bootable)
     finally:
         session.logout()
 
+##### PREBUILDING TWEAKED INITRDS
+#
+# Building a tweaked initrd means unpacking and repacking the vendor's, in
+# the first boot of the first VM to use it.  "eliloader --prebuild [<path>
+# ...]" builds the tweaked initrd of every map file entry into TWEAKED_CACHE
+# ahead of time, from the vendor initrds in the artefact cache and any
+# initrds found under the paths given (e.g. mounted install media).  Cpio
+# initrds are built with every compression a tweaked initrd has been built
+# with before, as well as any given with --compression.
+#
+# The data package runs it when installed.  The maps' mtimes are recorded
+# in PREBUILD_STATE, and a first boot which finds they have changed since
+# (e.g. when another *-guest-installer package is installed) starts one in
+# the background.
+
+PREBUILD_STATE = "/var/cache/linux-guest-loader/prebuilt"
+PREBUILD_PIDFILE = "/var/run/nonpersistent/linux-guest-loader/prebuild.pid"
+
+vendor_initrd_name = re.compile(r'initrd|\.img$|\.gz$')
+
+def map_mtimes():
+    rc = {}
+    for f in mapfiles:
+        try:
+            rc[f] = "%d" % os.stat(os.path.join(guest_installer_dir, f)).st_mtime
+        except OSError:
+            pass
+    return rc
+
+def prebuild_needed():
+    done = read_state_file(PREBUILD_STATE)
+    for f, mtime in map_mtimes().items():
+        if done.get(f) != [mtime]:
+            return True
+    return False
+
+def used_compressions():
+    """ The compressions tweaked initrds in TWEAKED_CACHE were built with. """
+    rc = set()
+    try:
+        names = os.listdir(TWEAKED_CACHE)
+    except OSError:
+        return rc
+    for name in names:
+        if name.endswith(".meta") and not name.startswith("."):
+            meta = read_artefact_meta(os.path.join(TWEAKED_CACHE, name[:-5]))
+            if meta and meta.has_key('compression') and meta['compression'] != 'ext2':
+                rc.add(meta['compression'])
+    return rc
+
+def find_vendor_initrds(wanted, sources):
+    """ Return a dictionary mapping those MD5s in wanted we have an initrd
+    for to its path. """
+    found = {}
+    for tier in artefact_cache_tiers:
+        try:
+            names = os.listdir(tier)
+        except OSError:
+            continue
+        for name in names:
+            if name.startswith(".") or name.endswith(".meta"):
+                continue
+            if name.endswith(".chunks"):
+                name = name[:-7]
+            try:
+                meta = find_entry(tier, name.decode('hex'))
+            except TypeError:
+                continue
+            if meta and wanted.has_key(meta.get('md5')):
+                found.setdefault(meta['md5'], os.path.join(tier, name))
+
+    def consider(path):
+        try:
+            if os.path.getsize(path) > pv_initrd_max_size:
+                return
+        except OSError:
+            return
+        digest = md5sum(path)
+        if wanted.has_key(digest):
+            found.setdefault(digest, path)
+
+    for source in sources:
+        if os.path.isdir(source):
+            for dir, _, files in os.walk(source):
+                for f in files:
+                    if vendor_initrd_name.search(f):
+                        consider(os.path.join(dir, f))
+        else:
+            consider(source)
+    return found
+
+def prebuild(sources, compressions):
+    mtimes = map_mtimes()
+    if not os.path.isdir(BOOTDIR):
+        os.makedirs(BOOTDIR)
+
+    compressions = set(compressions) | used_compressions() | set(['none'])
+    builds = {}
+    for digest in cpio_initrd_fixups.keys() + ext2_initrd_fixups.keys():
+        if ext2_initrd_fixups.has_key(digest):
+            overlay = os.path.join(guest_installer_dir, ext2_initrd_fixups[digest])
+            todo = [('ext2', 'none')]
+        else:
+            overlay = os.path.join(guest_installer_dir, cpio_initrd_fixups[digest])
+            todo = [(c, c) for c in compressions]
+        todo = [t for t in todo if not find_tweaked(tweaked_key(digest, t[0], overlay))]
+        if todo:
+            builds[digest] = (overlay, todo)
+    vendor = find_vendor_initrds(builds, sources)
+
+    built = 0
+    for digest, (overlay, todo) in builds.items():
+        if not vendor.has_key(digest):
+            xcp.logger.debug("Prebuild: no initrd with MD5 %s for %s" % (digest, overlay))
+            continue
+        src = vendor[digest]
+        if not os.path.isfile(src):
+            # kept as chunks
+            src = close_mkstemp(dir = BOOTDIR, prefix = "vendor-initrd-")
+            install_artefact(vendor[digest], src)
+        try:
+            for _, compression in todo:
+                remember_digest(src, digest)
+                try:
+                    os.unlink(tweak_initrd(src, compression))
+                    built += 1
+                except (StandardError, APILevelException, MountFailureException,
+                        ResourceAccessError), e:
+                    xcp.logger.debug("Prebuild of %s with %s failed: %s" %
+                                     (overlay, compression, e))
+        finally:
+            if src != vendor[digest]:
+                os.unlink(src)
+
+    xcp.logger.debug("Prebuilt %d tweaked initrds" % built)
+    def update(records):
+        records.clear()
+        for f, mtime in mtimes.items():
+            records[f] = [mtime]
+    update_state_file(PREBUILD_STATE, update)
+    return 0
+
 ##### DISTRO-SPECIFIC CODE
 
-def rhel_first_boot_handler(vm, repo_url):
+def rhel_first_boot_handler(vm, repo_url, other_config):
     need_clean = True
 
     if checkFile(repo_url + "images/xen/vmlinuz"):
@@ -616,12 +4022,19 @@ def rhel_first_boot_handler(vm, repo_url):
     # download the kernel and ramdisk:
     vmlinuz_url = repo_url + vmlinuz_suburl
     ramdisk_url = repo_url + ramdisk_suburl
+    treeinfo_url = repo_url + ".treeinfo"
     try:
         try:
-            fetchFile(vmlinuz_url, vmlinuz_file, pv_kernel_max_size)
-            fetchFile(ramdisk_url, ramdisk_file, pv_initrd_max_size)
-
-            modified_ramdisk = tweak_initrd(ramdisk_file)
+            fetchFile(vmlinuz_url, vmlinuz_file, other_config.kernel_max_size,
+                      find_expected_digest(treeinfo_url, parse_treeinfo, vmlinuz_url))
+            expected = find_expected_digest(treeinfo_url, parse_treeinfo, ramdisk_url)
+            unpacker = initrd_unpacker(expected, other_config)
+            fetchFile(ramdisk_url, ramdisk_file, other_config.initrd_max_size, expected, unpacker)
+            inspect_boot_files(vmlinuz_file, ramdisk_file)
+
+            modified_ramdisk = tweak_initrd(ramdisk_file,
+                                            other_config['install-initrd-compression'],
+                                            unpacker, other_config.initrd_max_size)
             if modified_ramdisk:
                 os.unlink(ramdisk_file)
                 ramdisk_file = modified_ramdisk
@@ -663,9 +4076,13 @@ def sles_first_boot_handler(vm, repo_url, other_config):
     vmlinuz_file = close_mkstemp(dir = BOOTDIR, prefix = "vmlinuz-")
     ramdisk_url = repo_url + bootdir + initrd_fname
     ramdisk_file = close_mkstemp(dir = BOOTDIR, prefix = "ramdisk-")
+    content_url = repo_url + "content"
     try:
-        fetchFile(vmlinuz_url, vmlinuz_file, pv_kernel_max_size)
-        fetchFile(ramdisk_url, ramdisk_file, pv_initrd_max_size)
+        fetchFile(vmlinuz_url, vmlinuz_file, other_config.kernel_max_size,
+                  find_expected_digest(content_url, parse_suse_content, vmlinuz_url))
+        fetchFile(ramdisk_url, ramdisk_file, other_config.initrd_max_size,
+                  find_expected_digest(content_url, parse_suse_content, ramdisk_url))
+        inspect_boot_files(vmlinuz_file, ramdisk_file)
     except:
         xcp.logger.debug("Cleaning '%s' and '%s'" % (vmlinuz_file, ramdisk_file))
         os.unlink(vmlinuz_file)
@@ -713,6 +4130,7 @@ def debian_first_boot_handler(vm, repo_url, other_config):
         if not checkFile(vmlinuz_url):
             vmlinuz_url = repo_url + "install/vmlinuz"
             ramdisk_url = repo_url + "install/initrd.gz"
+        sums_url, sums_parse = repo_url + "md5sum.txt", sums_parser('md5')
     else:
         comp = repo_url.split('/dists/', 1)
         if len(comp) != 2 or comp[1].replace('/','') == "":
@@ -720,14 +4138,20 @@ def debian_first_boot_handler(vm, repo_url, other_config):
         boot_dir = "main/installer-%s/current/images/netboot/xen/" % other_config['install-arch']
         vmlinuz_url = repo_url + boot_dir + "vmlinuz"
         ramdisk_url = repo_url + boot_dir + "initrd.gz"
+        sums_url = repo_url + "main/installer-%s/current/images/SHA256SUMS" % other_config['install-arch']
+        sums_parse = sums_parser('sha256')
 
     # download the kernel and ramdisk:
     vmlinuz_file = close_mkstemp(dir = BOOTDIR, prefix = "vmlinuz-")
     ramdisk_file = close_mkstemp(dir = BOOTDIR, prefix = "ramdisk-")
 
     try:
-        fetchFile(vmlinuz_url, vmlinuz_file, pv_kernel_max_size)
-        fetchFile(ramdisk_url, ramdisk_file, pv_initrd_max_size)
+        fetchFile(vmlinuz_url, vmlinuz_file, other_config.kernel_max_size,
+                  find_expected_digest(sums_url, sums_parse, vmlinuz_url))
+        expected = find_expected_digest(sums_url, sums_parse, ramdisk_url)
+        unpacker = initrd_unpacker(expected, other_config)
+        fetchFile(ramdisk_url, ramdisk_file, other_config.initrd_max_size, expected, unpacker)
+        inspect_boot_files(vmlinuz_file, ramdisk_file)
     except:
         xcp.logger.debug("Cleaning '%s' and '%s'" % (vmlinuz_file, ramdisk_file))
         os.unlink(vmlinuz_file)
@@ -735,7 +4159,9 @@ def debian_first_boot_handler(vm, repo_url, other_config):
         raise
 
     # Possibly apply tweaks to initrd.
-    modified_ramdisk = tweak_initrd(ramdisk_file)
+    modified_ramdisk = tweak_initrd(ramdisk_file,
+                                    other_config['install-initrd-compression'],
+                                    unpacker, other_config.initrd_max_size)
     if modified_ramdisk:
         os.unlink(ramdisk_file)
         ramdisk_file = modified_ramdisk
@@ -775,7 +4201,7 @@ def pygrub_first_boot_handler(vm_uuid, repo_url, other_config):
         return ret
 
     if other_config['install-repository'] == "cdrom":
-        (rc, out, err) = xcp.cmd.runCmd([PYGRUB] + sys.argv[1:], True, True)
+        (rc, out, err) = run_command([PYGRUB] + sys.argv[1:], 'pygrub')
         if rc != 0:
             raise InvalidSource, "Error %d running %s" % (rc,PYGRUB)
 
@@ -801,9 +4227,10 @@ def pygrub_first_boot_handler(vm_uuid, repo_url, other_config):
             ramdisk_file = None
 
         try:
-            fetchFile(vmlinuz_url, vmlinuz_file, pv_kernel_max_size)
+            fetchFile(vmlinuz_url, vmlinuz_file, other_config.kernel_max_size)
             if ramdisk_url is not None and ramdisk_file is not None:
-                fetchFile(ramdisk_url, ramdisk_file, pv_initrd_max_size)
+                fetchFile(ramdisk_url, ramdisk_file, other_config.initrd_max_size)
+            inspect_boot_files(vmlinuz_file, ramdisk_file)
         except:
             os.unlink(vmlinuz_file)
             xcp.logger.debug("Cleaning '%s' and '%s'" % (vmlinuz_file, ramdisk_file))
@@ -816,16 +4243,692 @@ def pygrub_first_boot_handler(vm_uuid, repo_url, other_config):
 def pygrub_first_boot_args(repo):
     return ""
 
+##### INSTALLER CACHING PROXY
+#
+# Once booted, installers fetch hundreds of megabytes of packages from the
+# repository, and every VM being installed from the same distro fetches the
+# same ones.  If the pool's other-config:install-cache-proxy is set, and is
+# one of dom0's own addresses, we make sure a caching HTTP proxy is running
+# in dom0 there, and point the installer at it.  Only content that never changes under the same URL
+# (packages, images, checksum-named repodata) is cached; everything else is
+# passed straight through, via install-proxy if that's set.  Concurrent
+# requests for the same uncached file wait for a single upstream download.
+#
+# Guests must not be able to use the proxy to reach anything else from
+# dom0, xapi on the loopback address above all.  A first boot which points
+# its installer at the proxy records the host:port of its repository and
+# mirrors in CACHE_PROXY_HOSTS, and the proxy answers requests for any other
+# host:port with 403.  It also refuses any host which resolves to a
+# loopback, link-local or multicast address or one of dom0's own, whatever
+# the repository says, and it passes redirects back to the client rather
+# than following them, so that the client's next request is checked too.
+
+CACHE_PROXY_DIR = "/var/cache/linux-guest-loader/proxy"
+CACHE_PROXY_PIDFILE = "/var/run/nonpersistent/linux-guest-loader/cache-proxy.pid"
+CACHE_PROXY_HOSTS = "/var/run/nonpersistent/linux-guest-loader/cache-proxy-hosts"
+
+cache_proxy_max_size = 4 * 1024 * 1024 * 1024
+# The proxy exits after this many seconds without a request.
+cache_proxy_idle_timeout = 3600
+cache_proxy_immutable = re.compile(r'(\.(rpm|drpm|deb|udeb|img|squashfs|iso)$)|'
+                                   r'(/repodata/[0-9a-f]{32,}-[^/]+$)')
+cache_proxy_forward_headers = ['Content-Type', 'Content-Length', 'Last-Modified',
+                               'ETag', 'Content-Range', 'Accept-Ranges', 'Location']
+# An installation's hosts may be used through the proxy for this many
+# seconds after its first boot.
+cache_proxy_host_ttl = 2 * 24 * 3600
+
+default_ports = { 'http': 80, 'https': 443, 'ftp': 21 }
+
+# Kernel arguments telling each distro's installer to use a proxy.
+proxy_args = { DISTRO_RHLIKE:     "proxy=%s",
+               DISTRO_SLESLIKE:   "proxy=%s",
+               DISTRO_DEBIANLIKE: "mirror/http/proxy=%s" }
+
+def url_endpoint(url):
+    """ Return the host:port url refers to, or None if it doesn't have one. """
+    parts = urlparse.urlsplit(url)
+    try:
+        port = parts.port or default_ports.get(parts.scheme)
+    except ValueError:
+        return None
+    if not parts.hostname or port is None:
+        return None
+    return "%s:%d" % (parts.hostname.lower(), port)
+
+def allow_cache_proxy_hosts(urls):
+    """ Let the caching proxy fetch from the hosts of urls for the next
+    cache_proxy_host_ttl seconds. """
+    now = time.time()
+    def update(records):
+        for endpoint, fields in records.items():
+            try:
+                if float(fields[0]) < now:
+                    del records[endpoint]
+            except (IndexError, ValueError):
+                del records[endpoint]
+        for url in urls:
+            endpoint = url_endpoint(url)
+            if endpoint is not None:
+                records[endpoint] = ["%d" % (now + cache_proxy_host_ttl)]
+    update_state_file(CACHE_PROXY_HOSTS, update)
+
+def cache_proxy_hosts():
+    now = time.time()
+    hosts = []
+    for endpoint, fields in read_state_file(CACHE_PROXY_HOSTS).items():
+        try:
+            if float(fields[0]) >= now:
+                hosts.append(endpoint)
+        except (IndexError, ValueError):
+            pass
+    return hosts
+
+def local_address(family, address):
+    """ Return True if address is one of dom0's own. """
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        try:
+            sock.bind((address, 0))
+            return True
+        except socket.error:
+            return False
+    finally:
+        sock.close()
+
+def address_refused(family, address):
+    """ Return True if the proxy must not connect to address: a loopback,
+    link-local, multicast or unspecified address, or one of dom0's own. """
+    if family == socket.AF_INET6:
+        packed = socket.inet_pton(socket.AF_INET6, address.split('%')[0])
+        if packed[:12] == '\0' * 10 + '\xff' * 2:
+            # IPv4-mapped
+            return address_refused(socket.AF_INET, socket.inet_ntoa(packed[12:]))
+        if packed in ['\0' * 16, '\0' * 15 + '\1'] or packed[0] == '\xff' \
+                or (ord(packed[0]) == 0xfe and ord(packed[1]) & 0xc0 == 0x80):
+            return True
+    elif family == socket.AF_INET:
+        first, second = [int(x) for x in address.split('.')[:2]]
+        if first in [0, 127] or first >= 224 or (first, second) == (169, 254):
+            return True
+    else:
+        return True
+    return local_address(family, address)
+
+def cache_proxy_refusal(url):
+    """ Return the reason the caching proxy mustn't fetch url, or None if it
+    may. """
+    if not url.startswith("http://"):
+        return "Only http:// URLs are proxied"
+    endpoint = url_endpoint(url)
+    if endpoint is None or endpoint not in cache_proxy_hosts():
+        return "Not an installation repository"
+    host, port = endpoint.rsplit(":", 1)
+    try:
+        addresses = socket.getaddrinfo(host, int(port), 0, socket.SOCK_STREAM)
+    except socket.error, e:
+        return "Cannot resolve %s: %s" % (host, e)
+    for family, _, _, _, sockaddr in addresses:
+        if address_refused(family, sockaddr[0]):
+            return "%s is a local address" % host
+    return None
+
+class NoRedirect(urllib2.HTTPRedirectHandler):
+    """ Hand redirects back to the proxy's client, which will ask for the
+    new location through the proxy, where it can be checked. """
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+class ClientSocket:
+    """ Write to a proxy client's socket, but stop quietly once that fails:
+    when a client hangs up we still want to finish filling the cache. """
+    def __init__(self, sock):
+        self.sock = sock
+    def write(self, block):
+        if self.sock is None:
+            return
+        try:
+            # sendall, unlike the socket's file object, takes the buffers
+            # copyfd hands out without copying them
+            self.sock.sendall(block)
+        except (IOError, OSError, socket.error):
+            self.sock = None
+    def close(self):
+        pass
+
+class CachingProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args):
+        xcp.logger.debug("cache-proxy: %s %s" % (self.client_address[0], format % args))
+
+    def do_GET(self):
+        self.proxy(True)
+
+    def do_HEAD(self):
+        self.proxy(False)
+
+    def proxy(self, body):
+        self.server.last_request = time.time()
+        url = self.path
+        if not url.startswith("http://"):
+            self.send_error(501, "Only http:// URLs are proxied")
+            return
+        refusal = cache_proxy_refusal(url)
+        if refusal is not None:
+            self.log_message("refused %s: %s", url, refusal)
+            self.send_error(403, refusal)
+            return
+        if body and cache_proxy_immutable.search(urlparse.urlsplit(url)[2]) \
+                and not self.headers.getheader('Range'):
+            self.serve_cached(url)
+        else:
+            self.relay(url, body)
+
+    def open_upstream(self, url, body, forward = True):
+        request = urllib2.Request(url)
+        if not body:
+            request.get_method = lambda : 'HEAD'
+        if forward:
+            for h in ['Range', 'If-Modified-Since', 'If-None-Match', 'Accept']:
+                if self.headers.getheader(h):
+                    request.add_header(h, self.headers.getheader(h))
+        try:
+            return self.server.opener.open(request, timeout = url_timeout)
+        except urllib2.HTTPError, e:
+            return e
+        except StandardError, e:
+            self.send_error(502, str(e))
+            return None
+
+    def send_upstream_headers(self, resp):
+        self.send_response(resp.code)
+        for h in cache_proxy_forward_headers:
+            if resp.info().getheader(h):
+                self.send_header(h, resp.info().getheader(h))
+        self.end_headers()
+
+    def relay(self, url, body):
+        resp = self.open_upstream(url, body)
+        if resp is None:
+            return
+        try:
+            self.send_upstream_headers(resp)
+            if body:
+                copyfd(resp, ClientSocket(self.connection), 1 << 62)
+        finally:
+            resp.close()
+
+    def serve_cached(self, url):
+        path = os.path.join(self.server.cache_dir, hashlib.sha1(url).hexdigest())
+        lock = self.server.url_lock(url)
+        lock.acquire()
+        try:
+            if not os.path.exists(path):
+                self.fill_cache(url, path)
+                return
+        finally:
+            lock.release()
+            self.server.url_unlock(url)
+
+        try:
+            fd = open(path, "rb")
+        except IOError:
+            # evicted under our feet
+            self.relay(url, True)
+            return
+        try:
+            os.utime(path, None)
+            self.send_response(200)
+            self.send_header('Content-Length', str(os.fstat(fd.fileno()).st_size))
+            if os.path.exists(path + ".type"):
+                self.send_header('Content-Type', open(path + ".type").read().strip())
+            self.end_headers()
+            copyfd(fd, ClientSocket(self.connection), 1 << 62)
+        finally:
+            fd.close()
+
+    def fill_cache(self, url, path):
+        # fetch the whole file, whatever this client asked for
+        resp = self.open_upstream(url, True, forward = False)
+        if resp is None:
+            return
+        try:
+            self.send_upstream_headers(resp)
+            if resp.code != 200:
+                copyfd(resp, ClientSocket(self.connection), 1 << 62)
+                return
+
+            tmp = close_mkstemp(dir = self.server.cache_dir, prefix = ".fill-")
+            try:
+                fd = open(tmp, "wb")
+                try:
+                    dest = TeeFile(fd, ClientSocket(self.connection))
+                    length, _ = copyfd(resp, dest, 1 << 62)
+                finally:
+                    fd.close()
+                expected = resp.info().getheader('Content-Length')
+                if expected is not None and int(expected) != length:
+                    xcp.logger.debug("cache-proxy: short read of %s, not caching" % url)
+                    return
+                if resp.info().getheader('Content-Type'):
+                    f = open(path + ".type", "w")
+                    f.write(resp.info().getheader('Content-Type'))
+                    f.close()
+                os.rename(tmp, path)
+                tmp = None
+            finally:
+                if tmp is not None:
+                    os.unlink(tmp)
+        finally:
+            resp.close()
+        self.server.evict()
+
+class CachingProxy(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, cache_dir, upstream):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CachingProxyHandler)
+        self.cache_dir = cache_dir
+        handlers = [NoRedirect()]
+        if upstream:
+            handlers.append(urllib2.ProxyHandler({"http" : upstream}))
+        self.opener = urllib2.build_opener(*handlers)
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        self.last_request = time.time()
+        self.timeout = 60
+
+    def url_lock(self, url):
+        self.locks_lock.acquire()
+        try:
+            lock, users = self.locks.get(url, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self.locks[url] = (lock, users + 1)
+            return lock
+        finally:
+            self.locks_lock.release()
+
+    def url_unlock(self, url):
+        self.locks_lock.acquire()
+        try:
+            lock, users = self.locks[url]
+            if users == 1:
+                del self.locks[url]
+            else:
+                self.locks[url] = (lock, users - 1)
+        finally:
+            self.locks_lock.release()
+
+    def evict(self):
+        """ Remove the least recently used files until the cache fits in
+        cache_proxy_max_size. """
+        if not self.evict_lock.acquire(False):
+            return
+        try:
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if name.startswith(".") or name.endswith(".type"):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+                total += st.st_size
+            entries.sort()
+            while total > cache_proxy_max_size and entries:
+                _, size, name = entries.pop(0)
+                for f in [name, name + ".type"]:
+                    try:
+                        os.unlink(os.path.join(self.cache_dir, f))
+                    except OSError:
+                        pass
+                total -= size
+        finally:
+            self.evict_lock.release()
+
+def run_cache_proxy(listen, upstream):
+    host, port = listen.rsplit(":", 1)
+    if not os.path.isdir(CACHE_PROXY_DIR):
+        os.makedirs(CACHE_PROXY_DIR)
+    try:
+        server = CachingProxy((host, int(port)), CACHE_PROXY_DIR, upstream)
+    except socket.error, e:
+        xcp.logger.debug("cache-proxy: cannot listen on %s: %s" % (listen, e))
+        return 1
+    xcp.logger.debug("cache-proxy: listening on %s" % listen)
+    while time.time() - server.last_request < cache_proxy_idle_timeout:
+        server.handle_request()
+    xcp.logger.debug("cache-proxy: idle, exiting")
+    return 0
+
+def cache_proxy_listen_valid(listen):
+    """ Return True if listen is host:port, host one of dom0's own IP
+    addresses. """
+    try:
+        host, port = listen.rsplit(":", 1)
+        if not 0 < int(port) < 65536:
+            return False
+        family = socket.getaddrinfo(host, None, 0, 0, 0, socket.AI_NUMERICHOST)[0][0]
+    except (ValueError, socket.error):
+        return False
+    return family in [socket.AF_INET, socket.AF_INET6] and local_address(family, host)
+
+def ensure_cache_proxy(listen, upstream):
+    """ Start a caching proxy listening on listen (host:port), unless one is
+    already running there.  Returns False if the proxy couldn't be started. """
+    if not cache_proxy_listen_valid(listen):
+        xcp.logger.debug("Not starting a caching proxy on %s: not a dom0 address" % listen)
+        return False
+    cmd = ["--cache-proxy", "--listen=%s" % listen]
+    if upstream:
+        cmd.append("--upstream=%s" % upstream)
+    return ensure_daemon(CACHE_PROXY_PIDFILE, listen, cmd)
+
+##### INSTALLED SYSTEM
+#
+# The second boot used to run pygrub up to three times, each reading the
+# new system's disk afresh, then exec it to read the disk once more.
+# Instead we read it once, in-process, with the fsimage and grub config
+# modules pygrub itself uses: find the filesystem holding a grub or grub2
+# config, take its default entry, and copy out that entry's kernel and
+# initrd.  Whenever anything isn't as expected (the modules are missing, we
+# can't follow the partitioning, there is no config, the default entry
+# isn't a plain Linux one) we fall back to pygrub, as we do for the
+# special cases handle_second_boot knows about.
+#
+# The files extracted are kept in SECOND_BOOT_CACHE/<vm-uuid>, with a
+# fingerprint of the config, the entry's paths, and the sizes and first
+# fingerprint_head_size bytes of its files (fsimage has no stat, so the
+# sizes are found by reading the files through), so a VM booted this way
+# again (if never_latch is set, or latching failed) reuses them when
+# nothing has changed.  Only the
+# second_boot_cache_vms VMs most recently booted are kept.
+
+SECOND_BOOT_CACHE = "/var/cache/linux-guest-loader/second-boot"
+
+read_grub_configs = True
+fingerprint_head_size = 64 * 1024
+second_boot_cache_vms = 50
+
+SECTOR_SIZE = 512
+
+# Where pygrub looks, in the order it looks.
+grub_configs = [ ("/boot/grub/grub.cfg",   'Grub2ConfigFile'),
+                 ("/grub/grub.cfg",        'Grub2ConfigFile'),
+                 ("/boot/grub2/grub.cfg",  'Grub2ConfigFile'),
+                 ("/grub2/grub.cfg",       'Grub2ConfigFile'),
+                 ("/boot/grub/menu.lst",   'GrubConfigFile'),
+                 ("/grub/menu.lst",        'GrubConfigFile'),
+                 ("/boot/grub/grub.conf",  'GrubConfigFile'),
+                 ("/grub/grub.conf",       'GrubConfigFile') ]
+
+def gpt_offsets(fd):
+    fd.seek(SECTOR_SIZE)
+    header = fd.read(92)
+    if len(header) < 92 or header[:8] != "EFI PART":
+        return []
+    lba, count, size = struct.unpack("<QII", header[72:88])
+    if size < 128:
+        return []
+    count = min(count, 128)
+    fd.seek(lba * SECTOR_SIZE)
+    table = fd.read(count * size)
+    offsets = []
+    for i in range(len(table) / size):
+        entry = table[i * size:(i + 1) * size]
+        if entry[:16] != "\0" * 16:
+            offsets.append(struct.unpack("<Q", entry[32:40])[0] * SECTOR_SIZE)
+    return offsets
+
+def partition_offsets(img):
+    """ Return the offsets of the partitions of disk img that could hold a
+    filesystem, or [0] if it isn't partitioned. """
+    fd = open(img, "rb")
+    try:
+        mbr = fd.read(SECTOR_SIZE)
+        if len(mbr) < SECTOR_SIZE or mbr[510:] != "\x55\xaa":
+            return [0]
+        offsets = []
+        for i in range(4):
+            entry = mbr[446 + i * 16:462 + i * 16]
+            kind = ord(entry[4])
+            start = struct.unpack("<I", entry[8:12])[0]
+            if kind == 0xee:
+                return gpt_offsets(fd)
+            # skip extended partitions: we leave logical ones to pygrub
+            if kind not in [0x00, 0x05, 0x0f, 0x85] and start:
+                offsets.append(start * SECTOR_SIZE)
+        return offsets or [0]
+    finally:
+        fd.close()
+
+def default_entry(cfg):
+    """ Return the index of the entry pygrub would boot from cfg: a number,
+    or the title of an entry (the last part of it for entries in
+    submenus), falling back to the first entry as pygrub does. """
+    default = cfg.default
+    if type(default) != int:
+        default = str(default).strip()
+        if default.isdigit():
+            default = int(default)
+        else:
+            title = default.split(">")[-1]
+            default = 0
+            for i, image in enumerate(cfg.images):
+                if image.title == title:
+                    default = i
+                    break
+    if default < 0 or default >= len(cfg.images):
+        return 0
+    return default
+
+def read_installed_entry(img):
+    """ Find the default entry of the grub config of the system installed on
+    img.  Returns a dictionary of the filesystem it is on, the config's
+    SHA1, the titles of all the entries, and the chosen entry's kernel,
+    initrd (or None) and arguments.  Returns None if unsure. """
+    if fsimage is None:
+        return None
+    for offset in partition_offsets(img):
+        try:
+            fs = fsimage.open(img, offset)
+        except (IOError, OSError):
+            continue
+        for path, parser in grub_configs:
+            if not fs.file_exists(path):
+                continue
+            data = fs.open_file(path).read()
+            cfg = getattr(grub.GrubConf, parser)()
+            cfg.parse(data)
+            if not cfg.images:
+                xcp.logger.debug("No entries in %s" % path)
+                return None
+            index = default_entry(cfg)
+            image = cfg.images[index]
+            if not image.kernel or not fs.file_exists(image.kernel[1]):
+                return None
+            initrd = image.initrd and image.initrd[1] or None
+            if initrd and not fs.file_exists(initrd):
+                return None
+            xcp.logger.debug("Found entry %d, '%s', in %s at offset %d" %
+                             (index, image.title, path, offset))
+            return { 'fs': fs, 'config': hashlib.sha1(data).hexdigest(),
+                     'titles': [i.title for i in cfg.images],
+                     'kernel': image.kernel[1], 'initrd': initrd,
+                     'args': image.args or "" }
+    return None
+
+def copy_guest_file(fs, path, dest, limit):
+    src = fs.open_file(path)
+    fd = open(dest, "wb")
+    try:
+        offset = 0
+        while True:
+            data = src.read(copy_block_size, offset)
+            if not data:
+                break
+            offset += len(data)
+            if offset > limit:
+                raise ResourceTooLarge("%s exceeds limit of %d bytes" % (path, limit))
+            fd.write(data)
+    finally:
+        fd.close()
+
+def guest_file_size(fs, path, limit):
+    """ Return the size of path in fs, reading no more than just past
+    limit. """
+    src = fs.open_file(path)
+    size = 0
+    while size <= limit:
+        data = src.read(copy_block_size, size)
+        if not data:
+            break
+        size += len(data)
+    return size
+
+def entry_fingerprint(entry, files):
+    fs = entry['fs']
+    h = hashlib.sha1(entry['config'])
+    for _, path, limit, _ in files:
+        h.update("\0%s\0%d\0" % (path, guest_file_size(fs, path, limit)))
+        h.update(fs.open_file(path).read(fingerprint_head_size, 0))
+    return h.hexdigest()
+
+def extract_entry(vm, entry, other_config):
+    """ Copy the kernel and initrd of entry to BOOTDIR, from SECOND_BOOT_CACHE
+    if they haven't changed.  Returns their paths. """
+    files = [("kernel", entry['kernel'], other_config.kernel_max_size, "vmlinuz-")]
+    if entry['initrd']:
+        files.append(("ramdisk", entry['initrd'], other_config.initrd_max_size, "ramdisk-"))
+
+    cache = os.path.join(SECOND_BOOT_CACHE, vm)
+    fingerprint = entry_fingerprint(entry, files)
+    cached = read_state_file(os.path.join(cache, "fingerprint")).get('fingerprint') == [fingerprint]
+
+    paths = []
+    try:
+        for name, path, limit, prefix in files:
+            dest = close_mkstemp(dir = BOOTDIR, prefix = prefix)
+            paths.append(dest)
+            if cached:
+                try:
+                    install_artefact(os.path.join(cache, name), dest)
+                    continue
+                except (IOError, OSError):
+                    cached = False
+            copy_guest_file(entry['fs'], path, dest, limit)
+    except:
+        for p in paths:
+            os.unlink(p)
+        raise
+
+    if cached:
+        xcp.logger.debug("Boot files of %s are unchanged, used cached copies" % vm)
+        os.utime(cache, None)
+    else:
+        save_second_boot(cache, [f[0] for f in files], paths, fingerprint)
+    return paths[0], len(paths) > 1 and paths[1] or None
+
+def save_second_boot(cache, names, paths, fingerprint):
+    try:
+        if not os.path.isdir(cache):
+            os.makedirs(cache)
+        state = os.path.join(cache, "fingerprint")
+        if os.path.exists(state):
+            os.unlink(state)
+        for name, path in zip(names, paths):
+            tmp = os.path.join(cache, "." + name)
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            try:
+                os.link(path, tmp)
+            except OSError:
+                shutil.copyfile(path, tmp)
+            os.rename(tmp, os.path.join(cache, name))
+        update_state_file(state, lambda records: records.update(fingerprint = [fingerprint]))
+    except (IOError, OSError), e:
+        xcp.logger.debug("Cannot cache boot files in %s: %s" % (cache, e))
+        return
+
+    vms = [(os.path.getmtime(os.path.join(SECOND_BOOT_CACHE, d)), d)
+           for d in os.listdir(SECOND_BOOT_CACHE)]
+    vms.sort(reverse = True)
+    for _, d in vms[second_boot_cache_vms:]:
+        shutil.rmtree(os.path.join(SECOND_BOOT_CACHE, d), ignore_errors = True)
+
+def boot_installed_system(vm, img, args, other_config):
+    """ Boot the default entry of the system installed on img, without
+    pygrub, if we can.  Returns False if pygrub is needed. """
+    if not read_grub_configs:
+        return False
+    distro = distros[other_config['install-distro']]
+    try:
+        entry = read_installed_entry(img)
+        if entry is None:
+            xcp.logger.debug("No grub entry found in %s, using pygrub" % img)
+            return False
+        if distro == DISTRO_RHLIKE and \
+                [t for t in entry['titles'] if re.search(r'Oracle.*el5uek', t, re.IGNORECASE)]:
+            xcp.logger.debug("RHEL_LIKE: Oracle 5.x el5uek kernel found, using pygrub")
+            return False
+        kernel, ramdisk = extract_entry(vm, entry, other_config)
+    except Exception, e:
+        xcp.logger.debug("Reading %s failed, using pygrub: %s" % (img, e))
+        return False
+
+    if not never_latch:
+        switchBootloader(vm, platform = other_config.platform)
+        update_rounds(vm, 2, 2)
+    print boot_spec(kernel, ramdisk, (entry['args'] + " " + args).strip())
+    return True
+
 ##### MAIN HANDLERS
 
 def handle_first_boot(vm, img, args, other_config):
+    plan = None
+    if other_config['install-repository'] == 'cdrom' and not never_latch:
+        # SLES/RHEL: booting from CDROM this time but booting from 1st disk next time
+        plan = start_step(plan_bootable_disk, other_config.vm_ref)
+
+    try:
+        kernel, ramdisk = fetch_first_boot(vm, img, other_config)
+    except:
+        exc = sys.exc_info()
+        if plan is not None:
+            # leave the flags alone, so the retry boots from the CD again
+            try:
+                session, _ = plan.result(kill_grace)
+                session.logout()
+            except Exception:
+                pass
+        raise exc[0], exc[1], exc[2]
+    distro = distros[other_config['install-distro']]
+
+    if plan is not None:
+        apply_bootable_disk(*plan.result(boot_deadline))
+
+    args = first_boot_args(args, other_config)
+
+    # Tell eliloader to run 2nd boot phase next time this vm is started
+    if rounds[distro] == 1:
+        switchBootloader(vm, platform = other_config.platform)
+
+    print boot_spec(kernel, ramdisk, args)
+
+def fetch_first_boot(vm, img, other_config):
+    """ Fetch (and tweak) the installer kernel and ramdisk for vm, returning
+    their paths in BOOTDIR. """
     if other_config['install-distro'] not in distros.keys():
         raise RuntimeError, "other-config:install-distro was not present or known."
     distro = distros[other_config['install-distro']]
 
     repo = other_config['install-repository']
-    vnc = other_config['install-vnc']
-    vncpasswd = other_config['install-vncpasswd']
 
     # extract the kernel and ramdisk
 
@@ -841,9 +4944,13 @@ def handle_first_boot(vm, img, args, other_config):
 
     # calculate repo_url, a prefix that can be passed into fetchFile
     if repo == "cdrom":
-        # CdromRepo.__init__ triggers a mount.  CdromRepo.__del__ does the umount.
-        cdrom_repo = CdromRepo(img)
-        repo_url = "file://%s/" % cdrom_repo.mntpoint
+        try:
+            repo_url = iso_repo_url(img)
+        except (IsoError, IOError, struct.error), e:
+            xcp.logger.debug("Reading %s failed (%s), mounting it instead" % (img, e))
+            # CdromRepo.__init__ triggers a mount.  CdromRepo.__del__ does the umount.
+            cdrom_repo = CdromRepo(img)
+            repo_url = "file://%s/" % cdrom_repo.mntpoint
     elif repo.startswith("nfs"):
         # NfsRepo.__init__ triggers a mount.  NfsRepo.__del__ does the umount.
         nfs_repo = NfsRepo(repo)
@@ -852,22 +4959,42 @@ def handle_first_boot(vm, img, args, other_config):
         repo_url = repo
         if not repo_url.endswith("/"):
             repo_url += "/"
+        if other_config['install-mirrors']:
+            register_mirrors(repo_url, re.split(r'[\s,]+', other_config['install-mirrors'].strip()))
 
     # invoke distro specific handler for extraction of kernel and ramdisk
     if distro == DISTRO_RHLIKE:
-        kernel, ramdisk = rhel_first_boot_handler(vm, repo_url)
+        handler = rhel_first_boot_handler
     elif distro == DISTRO_SLESLIKE:
-        kernel, ramdisk = sles_first_boot_handler(vm, repo_url, other_config)
+        handler = sles_first_boot_handler
     elif distro == DISTRO_DEBIANLIKE:
-        kernel, ramdisk = debian_first_boot_handler(vm, repo_url, other_config)
+        handler = debian_first_boot_handler
     elif distro == DISTRO_PYGRUB:
-        kernel, ramdisk = pygrub_first_boot_handler(vm, repo_url, other_config)
+        handler = pygrub_first_boot_handler
     else:
         raise UnsupportedInstallMethod
 
-    if repo == 'cdrom':
-        # SLES/RHEL: booting from CDROM this time but booting from 1st disk next time
-        tweak_bootable_disk(vm)
+    try:
+        kernel, ramdisk = handler(vm, repo_url, other_config)
+    except (ResourceAccessError, InvalidSource), e:
+        if not repo_url.startswith("iso:"):
+            raise
+        # our reader may have misread the image: the kernel's won't
+        xcp.logger.debug("Reading %s failed (%s), mounting it instead" %
+                         (img, getattr(e, 'source', e)))
+        cdrom_repo = CdromRepo(img)
+        repo_url = "file://%s/" % cdrom_repo.mntpoint
+        kernel, ramdisk = handler(vm, repo_url, other_config)
+
+    return kernel, ramdisk
+
+def first_boot_args(args, other_config):
+    """ Return the installer's command line: args with everything needed to
+    find the repository and honour other_config added. """
+    distro = distros[other_config['install-distro']]
+    repo = other_config['install-repository']
+    vnc = other_config['install-vnc']
+    vncpasswd = other_config['install-vncpasswd']
 
     # Calculate the extra args need by kernel to locate installation repository
     if distro == DISTRO_RHLIKE:
@@ -881,10 +5008,6 @@ def handle_first_boot(vm, img, args, other_config):
     else:
         raise UnsupportedInstallMethod
 
-    # Tell eliloader to run 2nd boot phase next time this vm is started
-    if rounds[distro] == 1:
-        switchBootloader(vm)
-
     # Put it all together
     args += " " + extra_args
     if vnc:
@@ -892,20 +5015,36 @@ def handle_first_boot(vm, img, args, other_config):
     if vncpasswd:
         args += " vncpassword=%s" % vncpasswd
 
+    # Send the installer's own downloads through a caching proxy in dom0
+    cache_proxy = other_config['install-cache-proxy']
+    if cache_proxy and repo.startswith("http:") and proxy_args.has_key(distro) \
+            and ensure_cache_proxy(cache_proxy, other_config['install-proxy']):
+        hosts = [repo]
+        if other_config['install-mirrors']:
+            hosts += re.split(r'[\s,]+', other_config['install-mirrors'].strip())
+        allow_cache_proxy_hosts(hosts)
+        args += " " + proxy_args[distro] % ("http://%s/" % cache_proxy)
+
     # Or set user defined options if available
     if other_config['install-args'] is not None:
         args += " " + other_config['install-args']
 
+    return args
+
+def boot_spec(kernel, ramdisk, args):
     if ramdisk is not None:
-        print 'linux (kernel %s)(ramdisk %s)(args "%s")' % (kernel, ramdisk, args)
+        return 'linux (kernel %s)(ramdisk %s)(args "%s")' % (kernel, ramdisk, args)
     else:
-        print 'linux (kernel %s)(args "%s")' % (kernel, args)
+        return 'linux (kernel %s)(args "%s")' % (kernel, args)
 
 def handle_second_boot(vm, img, args, other_config):
     distro = distros[other_config['install-distro']]
 
-    prepend_args = [PYGRUB]
+    if distro in [DISTRO_SLESLIKE, DISTRO_RHLIKE] and \
+            boot_installed_system(vm, img, args, other_config):
+        return
 
+    prepend_args = [PYGRUB]
 
     if distro == DISTRO_SLESLIKE:
         # SLES 9/10 installers do not create /boot/grub/menu.lst when installing on top of XEN
@@ -914,7 +5053,7 @@ def handle_second_boot(vm, img, args, other_config):
         # which case /we/ need to tell pygrub where to find the kernel and initrd.
 
         cmd = ["pygrub", "-q", "-n", img]
-        (rc, out, err) = xcp.cmd.runCmd(cmd, True, True)
+        (rc, out, err) = run_command(cmd, 'pygrub')
         if rc > 1:
             raise PygrubError(rc, err)
 
@@ -932,7 +5071,7 @@ def handle_second_boot(vm, img, args, other_config):
             for k, i in [ ("/%s" % kernel, "/%s" % initrd ), ("/boot/%s" % kernel , "/boot/%s" % initrd ) ]:
                 xcp.logger.debug("SLES_LIKE: Trying %s and %s" % (k, i) )
                 cmd = ["pygrub", "-n", "--kernel", k, "--ramdisk", i, img]
-                (rc, out, err) = xcp.cmd.runCmd(cmd, True, True)
+                (rc, out, err) = run_command(cmd, 'pygrub')
                 if rc > 1:
                     raise PygrubError(rc, err)
 
@@ -945,9 +5084,9 @@ def handle_second_boot(vm, img, args, other_config):
                     session.login_with_password("", "", "", PROGRAM_NAME)
                     try:
                         prepend_args += ["--kernel", k, "--ramdisk", i]
-                        vm_ref = session.xenapi.VM.get_by_uuid(vm)
                         if not never_latch:
-                            session.xenapi.VM.set_PV_bootloader_args(vm_ref, "--kernel %s --ramdisk %s" % (k, i))
+                            session.xenapi.VM.set_PV_bootloader_args(other_config.vm_ref,
+                                                                     "--kernel %s --ramdisk %s" % (k, i))
                     finally:
                         session.logout()
                     break
@@ -957,7 +5096,7 @@ def handle_second_boot(vm, img, args, other_config):
         # pygrub's default by setting PV-bootloader-args (with --entry N)
 
         cmd = ["pygrub", "-q", "-l", img]
-        (rc, out, err) = xcp.cmd.runCmd(cmd, True, True)
+        (rc, out, err) = run_command(cmd, 'pygrub')
         if rc != 0:
             raise PygrubError(rc, err)
 
@@ -992,9 +5131,8 @@ def handle_second_boot(vm, img, args, other_config):
             session.login_with_password("", "", "", PROGRAM_NAME)
             try:
                 prepend_args += ["--entry", str(idx)]
-                vm_ref = session.xenapi.VM.get_by_uuid(vm)
                 if not never_latch:
-                    session.xenapi.VM.set_PV_bootloader_args(vm_ref, "--entry %s" % idx)
+                    session.xenapi.VM.set_PV_bootloader_args(other_config.vm_ref, "--entry %s" % idx)
             finally:
                 session.logout()
     else:
@@ -1006,9 +5144,10 @@ def handle_second_boot(vm, img, args, other_config):
     # now exec pygrub - hackily call update_rounds since we won't get to
     # run again.
     if not never_latch:
-        switchBootloader(vm)
+        switchBootloader(vm, platform = other_config.platform)
         update_rounds(vm, 2, 2)
     xcp.logger.debug("Launching pygrub for real..")
+    finish_profile()
     os.execv(PYGRUB, prepend_args + sys.argv[1:])
 
 def update_rounds(vm, current_round, rounds_required):
@@ -1016,66 +5155,440 @@ def update_rounds(vm, current_round, rounds_required):
     session.xenapi.login_with_password("", "", "", PROGRAM_NAME)
     try:
         vm_ref = session.xenapi.VM.get_by_uuid(vm)
-
-        # remove the install-round field: ignore errors as the key might
-        # not be there and this is OK (default value is 1).
-        session.xenapi.VM.remove_from_other_config(vm_ref, "install-round")
-
-        # write a new value in for install-round if appropriate:
-        if current_round != rounds_required:
-            session.xenapi.VM.add_to_other_config(vm_ref, "install-round", str(current_round + 1))
-        else:
-            # All rounds complete. Remove install-distro key from other_config param.
-            # If we don't do this and we later perform a "convert to template" on this VM,
-            # the GUI will infer from the presence of this key that it must query the user
-            # for the install media location.  This is unecessary since the template already
-            # contains a fully installed disk image, that only needs to be copied.
-            session.xenapi.VM.remove_from_other_config(vm_ref, "install-distro")
-
+        advance_round(session, vm_ref, current_round, rounds_required)
     finally:
         session.logout()
 
-def find_host_size_limits():
-    global pv_kernel_max_size, pv_initrd_max_size
-    store = xs.xs()
+def advance_round(session, vm_ref, current_round, rounds_required):
+    # remove the install-round field: ignore errors as the key might
+    # not be there and this is OK (default value is 1).
+    session.xenapi.VM.remove_from_other_config(vm_ref, "install-round")
 
-    try:
-        pv_kernel_max_size = int(store.read("", "/mh/limits/pv-kernel-max-size"), 10 )
-    except (ValueError, TypeError, xs.Error):
-        pass
+    # write a new value in for install-round if appropriate:
+    if current_round != rounds_required:
+        session.xenapi.VM.add_to_other_config(vm_ref, "install-round", str(current_round + 1))
+    else:
+        # All rounds complete. Remove install-distro key from other_config param.
+        # If we don't do this and we later perform a "convert to template" on this VM,
+        # the GUI will infer from the presence of this key that it must query the user
+        # for the install media location.  This is unecessary since the template already
+        # contains a fully installed disk image, that only needs to be copied.
+        session.xenapi.VM.remove_from_other_config(vm_ref, "install-distro")
+
+##### PROFILING
+#
+# While DEBUG_SWITCH exists, each boot is run under cProfile, and the
+# objects it leaves behind are counted by type: python 2 has no tracemalloc,
+# so gc's view of the heap has to stand in for it.  The results go in
+# PROFILE_DIR/<vm-uuid>/<time>-<pid>-<phase>.{prof,alloc}.  Only the newest
+# profile_runs runs of each VM, and the profile_vms VMs most recently
+# profiled, are kept.
+
+PROFILE_DIR = "/var/log/linux-guest-loader/profiles"
+
+profile_runs = 10
+profile_vms = 20
+profile_top = 40
+
+active_profile = None
+
+def object_counts():
+    counts = {}
+    for o in gc.get_objects():
+        t = type(o)
+        counts[t] = counts.get(t, 0) + 1
+    return counts
+
+def start_profile(vm_uuid, phase):
+    """ Start profiling this run, if DEBUG_SWITCH asks for it. """
+    global active_profile
+    if not os.path.exists(DEBUG_SWITCH):
+        return
+    name = "%s-%d-%s" % (time.strftime("%Y%m%dT%H%M%S"), os.getpid(), phase)
+    profiler = cProfile.Profile()
+    active_profile = (os.path.join(PROFILE_DIR, vm_uuid), name, profiler,
+                      time.time(), object_counts())
+    profiler.enable()
+
+def finish_profile():
+    """ Stop profiling and write out the results.  Call before exec'ing. """
+    global active_profile
+    if active_profile is None:
+        return
+    vm_dir, name, profiler, started, before = active_profile
+    profiler.disable()
+    active_profile = None
+
+    after = object_counts()
+    growth = [(after[t] - before.get(t, 0), after[t], t) for t in after.keys()]
+    growth.sort(reverse = True)
+    self_ru = resource.getrusage(resource.RUSAGE_SELF)
+    child_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
 
     try:
-        pv_initrd_max_size = int(store.read("", "/mh/limits/pv-ramdisk-max-size"), 10 )
-    except (ValueError, TypeError, xs.Error):
-        pass
+        if not os.path.isdir(vm_dir):
+            os.makedirs(vm_dir)
+        prefix = os.path.join(vm_dir, name)
+        profiler.dump_stats(prefix + ".prof")
+        fd = open(prefix + ".alloc", "w")
+        try:
+            fd.write("wall %.3fs, max rss %dkB (helpers %dkB)\n" %
+                     (time.time() - started, self_ru.ru_maxrss, child_ru.ru_maxrss))
+            fd.write("%10s %10s  type\n" % ("new", "live"))
+            for new, live, t in growth[:profile_top]:
+                fd.write("%10d %10d  %s.%s\n" % (new, live, t.__module__, t.__name__))
+        finally:
+            fd.close()
+        xcp.logger.debug("Profile written to %s.{prof,alloc}" % prefix)
+        trim_profiles(vm_dir)
+    except (IOError, OSError), e:
+        xcp.logger.debug("Cannot write profile: %s" % e)
+
+def trim_profiles(vm_dir):
+    runs = sorted(set([os.path.splitext(f)[0] for f in os.listdir(vm_dir)]))
+    for run in runs[:-profile_runs]:
+        for ext in [".prof", ".alloc"]:
+            try:
+                os.unlink(os.path.join(vm_dir, run + ext))
+            except OSError:
+                pass
 
-    xcp.logger.debug("Host limits: kernel %d, ramdisk %d" %
-                     (pv_kernel_max_size, pv_initrd_max_size))
+    vms = [(os.path.getmtime(os.path.join(PROFILE_DIR, d)), d) for d in os.listdir(PROFILE_DIR)]
+    vms.sort(reverse = True)
+    for _, d in vms[profile_vms:]:
+        shutil.rmtree(os.path.join(PROFILE_DIR, d), ignore_errors = True)
 
-def find_vm_size_limits(vm):
-    global pv_kernel_max_size, pv_initrd_max_size
-    store = xs.xs()
+##### CONFIGURATION
+#
+# Everything a run needs to know about its VM and host is gathered up front
+# by resolve_config: the host's and the VM's size limits from xenstore, in
+# one transaction, and the VM's record from xapi in one call.  The pool's
+# other-config takes a further xapi call, so it is kept in HOST_CONFIG
+# between runs and reread after host_config_ttl seconds.  The host's limits
+# cost nothing extra to read in the transaction we open anyway, so they are
+# read afresh every time, and there is nothing to go stale.
+
+HOST_CONFIG = "/var/run/nonpersistent/linux-guest-loader/host-config"
+
+host_config_ttl = 60
+
+xs_host_limits = { 'kernel':  "/mh/limits/pv-kernel-max-size",
+                   'ramdisk': "/mh/limits/pv-ramdisk-max-size" }
+xs_vm_limit = "/local/domain/%d/platform/pv-%s-max-size"
+
+uuid_pattern = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$',
+                          re.IGNORECASE)
+
+class BootConfig:
+    """ What we know about the VM being booted.  Indexing gives its
+    canonicalised other-config (see canonicalise); the attributes vm_uuid,
+    vm_ref, domid, platform, pv_args, pool_config, kernel_max_size and
+    initrd_max_size the rest.  Read-only. """
+
+    def __init__(self, other_config, **attrs):
+        self.__dict__['_other_config'] = dict(other_config)
+        self.__dict__.update(attrs)
+
+    def __getitem__(self, key):
+        return self._other_config[key]
+
+    def has_key(self, key):
+        return self._other_config.has_key(key)
+
+    def __contains__(self, key):
+        return self._other_config.has_key(key)
+
+    def keys(self):
+        return self._other_config.keys()
+
+    def get(self, key, default = None):
+        return self._other_config.get(key, default)
+
+    def __setitem__(self, key, value):
+        raise TypeError, "BootConfig is read-only"
+
+    def __setattr__(self, name, value):
+        raise TypeError, "BootConfig is read-only"
+
+def read_host_config():
+    """ Return the cached pool other-config, or None if not cached or
+    stale. """
+    records = read_state_file(HOST_CONFIG)
+    now = time.time()
+    pool_config = None
 
     try:
-        domains = store.ls("", "/vm/" + vm + "/domains")
-        domid = int(domains[0], 10)
-    except (ValueError, TypeError, IndexError, xs.Error):
-        raise APILevelException("Unable to find domid for " + vm)
+        if now - float(records['pool'][0]) < host_config_ttl:
+            pool_config = {}
+            for key, fields in records.items():
+                if key.startswith("pool:"):
+                    pool_config[key[5:]] = " ".join(fields)
+    except (KeyError, IndexError, ValueError):
+        pool_config = None
+
+    return pool_config
+
+def write_host_config(pool_config):
+    def update(records):
+        records.clear()
+        records['pool'] = ["%f" % time.time()]
+        for key, value in pool_config.items():
+            # only our own keys, and only those we can write back
+            if key.startswith("install-") and value and not re.search(r'\s', key):
+                records["pool:" + key] = value.split()
+    update_state_file(HOST_CONFIG, update)
+
+def read_xenstore(vm_uuid, host_limits):
+    """ Read, in one transaction, the host's size limits if host_limits is
+    set, and the domid and size limits of vm_uuid if given. """
+
+    def read_int(store, t, path):
+        try:
+            return int(store.read(t, path), 10)
+        except (ValueError, TypeError, xs.Error):
+            return None
 
-    xs_path = "/local/domain/%s/platform/pv-%s-max-size"
+    store = xs.xs()
+    while True:
+        t = store.transaction_start()
+        host = {}
+        vm = {}
+        domid = None
+        if host_limits:
+            for name, path in xs_host_limits.items():
+                host[name] = read_int(store, t, path)
+        if vm_uuid:
+            try:
+                domid = int(store.ls(t, "/vm/" + vm_uuid + "/domains")[0], 10)
+            except (ValueError, TypeError, IndexError, xs.Error):
+                xcp.logger.debug("Unable to find domid for " + vm_uuid)
+            if domid is not None:
+                for name in xs_host_limits.keys():
+                    vm[name] = read_int(store, t, xs_vm_limit % (domid, name))
+        if store.transaction_end(t):
+            return host, domid, vm
+        xcp.logger.debug("xenstore transaction conflicted, retrying")
+
+def size_limits(*limits):
+    """ Return the kernel and ramdisk size limits to enforce: the first of
+    each set in limits (dictionaries like xs_host_limits), or else
+    pv_kernel_max_size and pv_initrd_max_size. """
+    kernel, ramdisk = pv_kernel_max_size, pv_initrd_max_size
+    for l in reversed(limits):
+        if l.get('kernel') is not None:
+            kernel = l['kernel']
+        if l.get('ramdisk') is not None:
+            ramdisk = l['ramdisk']
+    xcp.logger.debug("Size limits: kernel %d, ramdisk %d" % (kernel, ramdisk))
+    return kernel, ramdisk
+
+def resolve_config(vm_uuid):
+    """ Gather everything about vm_uuid and its host into a BootConfig. """
+    if vm_uuid is None or not uuid_pattern.match(vm_uuid):
+        raise UsageError
+    pool_config = read_host_config()
 
+    session = XenAPI.xapi_local()
+    session.login_with_password("", "", "", PROGRAM_NAME)
     try:
-        pv_kernel_max_size = int(store.read("", xs_path % (domid, "kernel")), 10)
-    except (ValueError, TypeError, xs.Error):
-        pass
+        records = session.xenapi.VM.get_all_records_where('field "uuid" = "%s"' % vm_uuid)
+        cache_pool = pool_config is None
+        if cache_pool:
+            pool_config = get_pool_config(session)
+    finally:
+        session.logout()
+    if len(records) != 1:
+        raise APILevelException("Unable to find VM " + vm_uuid)
+    vm_ref, record = records.items()[0]
+
+    if cache_pool:
+        write_host_config(pool_config)
+
+    return vm_boot_config(vm_uuid, vm_ref, record, pool_config)
+
+def vm_boot_config(vm_uuid, vm_ref, record, pool_config):
+    """ Make the BootConfig of vm_uuid from its VM record and the pool's
+    other-config, reading its domid and size limits from xenstore. """
+    host, domid, vm_limits = read_xenstore(vm_uuid, True)
+    kernel_max_size, initrd_max_size = size_limits(vm_limits, host)
+    return BootConfig(canonicalise(record['other_config'], pool_config),
+                      vm_uuid = vm_uuid, vm_ref = vm_ref, domid = domid,
+                      platform = record['platform'], pv_args = record['PV_args'],
+                      pool_config = pool_config,
+                      kernel_max_size = kernel_max_size,
+                      initrd_max_size = initrd_max_size)
+
+##### BATCH MODE
+#
+# Orchestration tools start VMs in bulk, and their installs mostly share a
+# handful of repositories.  "eliloader --batch <uuid>..." prepares the first
+# boot of many VMs at once, e.g. from a pre-boot hook: it reads all their
+# records in one xapi call, fetches and tweaks the boot files once for each
+# group of VMs that would get the same ones, on a pool of worker threads,
+# and then gives every VM its own links to them.  One line is printed per VM,
+# its UUID followed either by the boot spec eliloader would have printed or
+# by "error: <reason>", and the VMs' install state is advanced as if each had
+# booted.
+#
+# Only network installs in their first round can be batched: cdrom installs
+# need each VM's own media, and later rounds read each VM's own disk.  Each
+# VM's configuration is resolved as a single boot's would be (see
+# vm_boot_config), so the same other-config keys and size limits apply.
+
+batch_workers = 4
+
+# other-config keys that determine which boot files a first boot fetches.
+batch_group_keys = ['install-repository', 'install-distro', 'install-arch',
+                    'debian-release', 'install-kernel', 'install-ramdisk',
+                    'install-initrd-compression', 'install-mirrors', 'install-proxy']
+
+def read_vm_records(uuids, pool_config = None):
+    """ Return a dictionary mapping each of uuids that exists to its VM
+    (ref, record), and the pool's other-config: pool_config, or if that is
+    None as read from xapi. """
+    for uuid in uuids:
+        if not uuid_pattern.match(uuid):
+            raise UsageError
+    query = " or ".join(['field "uuid" = "%s"' % uuid for uuid in uuids])
 
+    session = XenAPI.xapi_local()
+    session.login_with_password("", "", "", PROGRAM_NAME)
     try:
-        pv_initrd_max_size = int(store.read("", xs_path % (domid, "ramdisk")), 10)
-    except (ValueError, TypeError, xs.Error):
-        pass
+        records = session.xenapi.VM.get_all_records_where(query)
+        if pool_config is None:
+            pool_config = get_pool_config(session)
+    finally:
+        session.logout()
+
+    vms = {}
+    for ref, record in records.items():
+        vms[record['uuid']] = (ref, record)
+    return vms, pool_config
+
+def run_pool(jobs, workers):
+    """ Call each function in jobs on one of up to workers threads.  Returns
+    a list of (True, result) or (False, exception) in the order of jobs. """
+    results = [None] * len(jobs)
+    queue = Queue.Queue()
+    for i in range(len(jobs)):
+        queue.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (True, jobs[i]())
+            except Exception, e:
+                log_exception("ERROR: ", traceback.format_exc())
+                results[i] = (False, e)
+
+    threads = [threading.Thread(target = worker)
+               for _ in range(min(workers, len(jobs)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def describe_failure(e):
+    if isinstance(e, APILevelException):
+        return e.apifmt().strip().replace("\n", ": ")
+    if isinstance(e, ResourceAccessError):
+        return "Could not access %s" % e.source
+    return str(e) or e.__class__.__name__
+
+def link_boot_file(path, prefix):
+    """ Give another VM its own name for boot file path: the toolstack
+    deletes boot files once it has built the domain. """
+    dest = close_mkstemp(dir = BOOTDIR, prefix = prefix)
+    install_artefact(path, dest)
+    return dest
+
+def fetch_group(uuid, other_config):
+    """ Fetch the first boot files of a group of VMs, in a worker thread. """
+    install_proxy(other_config['install-proxy'])
+    return fetch_first_boot(uuid, None, other_config)
+
+def handle_batch(uuids):
+    cached = read_host_config()
+    vms, pool_config = read_vm_records(uuids, cached)
+    if cached is None:
+        write_host_config(pool_config)
+    # the shared tier is pool-wide: see canonicalise
+    set_shared_cache(canonicalise({}, pool_config)['install-shared-cache'])
+
+    results = {}
+    groups = {}
+    for uuid in uuids:
+        if not vms.has_key(uuid):
+            results[uuid] = "error: no such VM"
+            continue
+        ref, record = vms[uuid]
+        other_config = vm_boot_config(uuid, ref, record, pool_config)
+        if not distros.has_key(other_config['install-distro']):
+            results[uuid] = "error: distribution '%s' is not supported" % \
+                other_config['install-distro']
+        elif other_config['install-round'] != '1':
+            results[uuid] = "error: not in its first install round"
+        elif other_config['install-repository'] == 'cdrom':
+            results[uuid] = "error: cdrom installs can't be batched"
+        else:
+            key = tuple([other_config[k] for k in batch_group_keys])
+            groups.setdefault(key, []).append((uuid, other_config))
+
+    fetched = {}
+    keys = groups.keys()
+    xcp.logger.debug("Batch: fetching %d groups" % len(keys))
+    jobs = [lambda member = groups[key][0]: fetch_group(*member) for key in keys]
+    for key, result in zip(keys, run_pool(jobs, batch_workers)):
+        fetched[key] = result
+
+    ready = []
+    for key, members in groups.items():
+        ok, value = fetched[key]
+        for n, (uuid, other_config) in enumerate(members):
+            if not ok:
+                results[uuid] = "error: " + describe_failure(value)
+                continue
+            try:
+                kernel, ramdisk = value
+                if n > 0:
+                    kernel = link_boot_file(kernel, "vmlinuz-")
+                    if ramdisk is not None:
+                        ramdisk = link_boot_file(ramdisk, "ramdisk-")
+                args = first_boot_args(vms[uuid][1]['PV_args'], other_config)
+            except Exception, e:
+                log_exception("ERROR: ", traceback.format_exc())
+                results[uuid] = "error: " + describe_failure(e)
+                continue
+            results[uuid] = boot_spec(kernel, ramdisk, args)
+            ready.append((uuid, distros[other_config['install-distro']]))
+
+    if ready:
+        session = XenAPI.xapi_local()
+        session.login_with_password("", "", "", PROGRAM_NAME)
+        try:
+            for uuid, distro in ready:
+                ref = vms[uuid][0]
+                if rounds[distro] == 1 and not never_latch:
+                    switch_bootloader(session, ref, vms[uuid][1]['platform'])
+                advance_round(session, ref, 1, rounds[distro])
+        finally:
+            session.logout()
+
+    for uuid in uuids:
+        print uuid, results[uuid]
+    return len(ready) != len(uuids) and 1 or 0
 
-    xcp.logger.debug("VM limits: kernel %d, ramdisk %d" %
-                     (pv_kernel_max_size, pv_initrd_max_size))
+def install_proxy(proxy):
+    """ Make this thread's fetches use proxy server if one is supplied. """
+    if proxy:
+        fetch_context.opener = urllib2.build_opener(urllib2.ProxyHandler({"http" : proxy}))
+    else:
+        fetch_context.opener = None
 
 def main():
     if True: #os.path.exists(DEBUG_SWITCH):
@@ -1091,14 +5604,39 @@ def main():
                 argv.remove(a)
         opts, mandargs = getopt.getopt(
             argv, "q", ["vm=", "logging", "quiet", "args=",
-                        "extra_args=", "default_args="])
+                        "extra_args=", "default_args=",
+                        "cache-proxy", "listen=", "upstream=", "rebuild-index=",
+                        "batch", "prebuild", "compression=", "chunk-index="])
     except getopt.GetoptError:
         raise UsageError
 
     vm = None
     img = None
     args = ""
+    cache_proxy = False
+    listen = None
+    upstream = None
+    rebuild = []
+    batch = False
+    prebuilding = False
+    compressions = []
     for opt, val in opts:
+        if opt == "--prebuild":
+            prebuilding = True
+        if opt == "--chunk-index":
+            return write_chunk_index(val)
+        if opt == "--compression":
+            compressions.append(val)
+        if opt == "--batch":
+            batch = True
+        if opt == "--rebuild-index":
+            rebuild.append(val)
+        if opt == "--cache-proxy":
+            cache_proxy = True
+        if opt == "--listen":
+            listen = val
+        if opt == "--upstream":
+            upstream = val
         if opt == "--vm":
             vm = val
         if opt == "--logging":
@@ -1106,6 +5644,32 @@ def main():
         if opt in ["--args", "--extra_args", "--default_args"]:
             args += val + " "
 
+    if rebuild:
+        for dir in rebuild:
+            rebuild_index(dir)
+        return 0
+
+    if cache_proxy:
+        if not listen:
+            raise UsageError
+        return run_cache_proxy(listen, upstream)
+
+    if prebuilding:
+        enter_budget()
+        try:
+            return prebuild(mandargs, compressions)
+        finally:
+            finish_budget()
+
+    if batch:
+        if len(mandargs) < 1:
+            raise UsageError
+        enter_budget()
+        try:
+            return handle_batch(mandargs)
+        finally:
+            finish_budget()
+
     if len(mandargs) < 1:
         raise UsageError
 
@@ -1113,15 +5677,9 @@ def main():
 
     # support running this bootloader multiple times.  We switch bootloader
     # if all required rounds are completed
-    other_config = canonicaliseOtherConfig(vm)
+    other_config = resolve_config(vm)
     current_round = int(other_config['install-round'])
 
-    find_host_size_limits()
-    try:
-        find_vm_size_limits(vm)
-    except:
-        xcp.logger.debug("Ignorning exception while finding vm size limits")
-
     # how many rounds are required?
     try:
         distro = distros[other_config['install-distro']]
@@ -1129,17 +5687,34 @@ def main():
     except:
         raise UnsupportedInstallMethod, "Distribution '%s' is not supported." % other_config['install-distro']
 
-    # Make urllib2 use proxy server if one is supplied
-    proxy = other_config['install-proxy']
-    if proxy:
-        proxy_support = urllib2.ProxyHandler({"http" : proxy})
-        opener = urllib2.build_opener(proxy_support)
-        urllib2.install_opener(opener)
+    set_shared_cache(other_config['install-shared-cache'])
+
+    install_proxy(other_config['install-proxy'])
+
+    if current_round == 1 and prebuild_needed():
+        ensure_daemon(PREBUILD_PIDFILE, 'prebuild', ["--prebuild"])
 
     if current_round == 1:
-        handle_first_boot(vm, img, args, other_config)
-    elif current_round == 2:
-        handle_second_boot(vm, img, args, other_config)
+        enter_budget()
+    start_profile(vm, "round%d" % current_round)
+    start_boot_deadline()
+    try:
+        try:
+            if current_round == 1:
+                handle_first_boot(vm, img, args, other_config)
+            elif current_round == 2:
+                # only returns if it booted the system without pygrub, having
+                # updated the rounds already
+                handle_second_boot(vm, img, args, other_config)
+                return 0
+        except KeyboardInterrupt:
+            if not boot_cancelled:
+                raise
+            raise StepTimeout("Boot did not finish within %d seconds" % boot_deadline)
+    finally:
+        stop_boot_deadline()
+        finish_profile()
+        finish_budget()
 
     update_rounds(vm, current_round, rounds_required)
 
@@ -1157,7 +5732,9 @@ if __name__ == "__main__":
         log_exception("PYERROR: ", traceback.format_exc())
         raise RuntimeError, str(x)
     except UsageError, e:
-        msg = "Invalid usage. Usage: eliloader --vm <vm> <image>"
+        msg = "Invalid usage. Usage: eliloader --vm <vm> <image>\n" \
+              "                    eliloader --batch <vm> [<vm> ...]\n" \
+              "                    eliloader --prebuild [--compression=<c>] [<path> ...]"
         print >> sys.stderr, msg
         raise RuntimeError, "Invalid command line arguments."
     except StandardError, e:
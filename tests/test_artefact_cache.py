@@ -0,0 +1,212 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+URL = "http://repo.example.com/os/images/pxeboot/vmlinuz"
+DATA = "kernel" * 1000
+
+class ArtefactCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.tier = os.path.join(self.dir, "tier")
+        self.saved = eliloader.artefact_chunking, eliloader.hash_file
+        eliloader.artefact_chunking = False
+        src = os.path.join(self.dir, "src")
+        f = open(src, "wb")
+        f.write(DATA)
+        f.close()
+        self.key = eliloader.artefact_key(URL)
+        self.path = eliloader.entry_path(self.tier, self.key)
+        eliloader.publish_artefact(self.tier, self.key, src,
+                                   { 'url': URL, 'size': str(len(DATA)),
+                                     'md5': hashlib.md5(DATA).hexdigest() })
+        self.hashed = []
+        def hash_file(path, algo):
+            self.hashed.append(algo)
+            return self.saved[1](path, algo)
+        eliloader.hash_file = hash_file
+
+    def tearDown(self):
+        eliloader.artefact_chunking, eliloader.hash_file = self.saved
+        shutil.rmtree(self.dir)
+
+    def valid(self, expected):
+        meta = eliloader.find_entry(self.tier, self.key)
+        return eliloader.artefact_valid(URL, self.path, meta, 1 << 30, expected)
+
+    def test_published(self):
+        meta = eliloader.find_entry(self.tier, self.key)
+        self.assertEqual(meta['md5'], hashlib.md5(DATA).hexdigest())
+        self.assertEqual(eliloader.read_artefact_meta(self.path)['url'], URL)
+
+    def test_digest_recorded(self):
+        expected = ('sha256', hashlib.sha256(DATA).hexdigest())
+        self.assertTrue(self.valid(expected))
+        self.assertEqual(self.hashed, ['sha256'])
+        self.assertEqual(eliloader.read_artefact_meta(self.path)['sha256'], expected[1])
+        self.assertEqual(eliloader.CacheIndex(self.tier).lookup(self.key)[1]['sha256'],
+                         expected[1])
+        # the next lookup doesn't hash the file again
+        self.assertTrue(self.valid(expected))
+        self.assertEqual(self.hashed, ['sha256'])
+
+    def test_second_digest_from_meta(self):
+        sha256 = ('sha256', hashlib.sha256(DATA).hexdigest())
+        sha1 = ('sha1', hashlib.sha1(DATA).hexdigest())
+        self.assertTrue(self.valid(sha256))
+        self.assertTrue(self.valid(sha1))
+        self.assertTrue(self.valid(sha256))
+        self.assertTrue(self.valid(sha1))
+        self.assertEqual(self.hashed, ['sha256', 'sha1'])
+
+    def test_mismatch_not_recorded(self):
+        self.assertFalse(self.valid(('sha256', "0" * 64)))
+        self.assertFalse(eliloader.read_artefact_meta(self.path).has_key('sha256'))
+
+    def test_size_limit(self):
+        meta = eliloader.find_entry(self.tier, self.key)
+        self.assertFalse(eliloader.artefact_valid(URL, self.path, meta, 10,
+                                                  ('md5', meta['md5'])))
+
+class RecordingSink:
+    def __init__(self):
+        self.data = None
+        self.closed = False
+    def reset(self):
+        self.data = ""
+        self.closed = False
+    def write(self, block):
+        assert not self.closed
+        if isinstance(block, memoryview):
+            block = block.tobytes()
+        self.data += block
+    def close(self):
+        self.closed = True
+
+class CacheHitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.tier = os.path.join(self.dir, "tier")
+        self.saved = eliloader.artefact_chunking, list(eliloader.artefact_cache_tiers)
+        eliloader.artefact_chunking = False
+        eliloader.artefact_cache_tiers[:] = [self.tier]
+        src = os.path.join(self.dir, "src")
+        f = open(src, "wb")
+        f.write(DATA)
+        f.close()
+        eliloader.publish_artefact(self.tier, eliloader.artefact_key(URL), src,
+                                   { 'url': URL, 'size': str(len(DATA)),
+                                     'md5': hashlib.md5(DATA).hexdigest() })
+        self.dest = os.path.join(self.dir, "dest")
+
+    def tearDown(self):
+        eliloader.artefact_chunking = self.saved[0]
+        eliloader.artefact_cache_tiers[:] = self.saved[1]
+        shutil.rmtree(self.dir)
+
+    def test_sink_fed_and_closed(self):
+        sink = RecordingSink()
+        md5 = hashlib.md5(DATA).hexdigest()
+        self.assertEqual(eliloader.fetchFile(URL, self.dest, 1 << 30, ('md5', md5), sink), md5)
+        self.assertEqual(open(self.dest).read(), DATA)
+        self.assertEqual(sink.data, DATA)
+        self.assertTrue(sink.closed)
+
+    def test_miss_falls_through(self):
+        self.assertEqual(eliloader.fetch_cached(URL, self.dest, 1 << 30,
+                                                ('md5', "0" * 32), RecordingSink()), None)
+
+    def test_unpacker_pump_is_daemon(self):
+        unpacker = eliloader.StreamingUnpacker()
+        unpacker.reset()
+        saved = eliloader.subprocess.Popen
+        # cat stands in for both the decompressor and cpio
+        eliloader.subprocess.Popen = lambda cmd, **kwargs: saved(["cat"], **kwargs)
+        try:
+            unpacker.start("\x1f\x8b\x08\x00\x00\x00")
+        finally:
+            eliloader.subprocess.Popen = saved
+        try:
+            self.assertTrue(unpacker.pump.isDaemon())
+        finally:
+            unpacker.abort()
+
+class SharedTierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = os.path.realpath(tempfile.mkdtemp(prefix = "lgl-test-"))
+        self.local = os.path.join(self.dir, "local")
+        self.shared = os.path.join(self.dir, "sr-mount", "sr", "cache")
+        os.makedirs(self.shared)
+        self.saved = (eliloader.artefact_chunking, list(eliloader.artefact_cache_tiers),
+                      eliloader.shared_cache_roots)
+        eliloader.artefact_chunking = False
+        eliloader.artefact_cache_tiers[:] = [self.local]
+        eliloader.shared_cache_roots = [os.path.join(self.dir, "sr-mount")]
+
+    def tearDown(self):
+        eliloader.set_shared_cache(None)
+        eliloader.artefact_chunking = self.saved[0]
+        eliloader.artefact_cache_tiers[:] = self.saved[1]
+        eliloader.shared_cache_roots = self.saved[2]
+        shutil.rmtree(self.dir)
+
+    def test_outside_roots_ignored(self):
+        for path in [os.path.join(self.dir, "elsewhere"), "relative/cache",
+                     os.path.join(self.dir, "sr-mount"),
+                     os.path.join(self.dir, "sr-mount", "..", "elsewhere")]:
+            eliloader.set_shared_cache(path)
+            self.assertEqual(eliloader.artefact_cache_tiers, [self.local])
+        os.symlink(self.dir, os.path.join(self.shared, "escape"))
+        eliloader.set_shared_cache(os.path.join(self.shared, "escape"))
+        self.assertEqual(eliloader.artefact_cache_tiers, [self.local])
+        eliloader.set_shared_cache(self.shared)
+        self.assertEqual(eliloader.artefact_cache_tiers, [self.local, self.shared])
+
+    def test_pool_config_only(self):
+        self.assertEqual(eliloader.canonicalise({ 'install-shared-cache': "/vm" },
+                                                {})['install-shared-cache'], None)
+        self.assertEqual(eliloader.canonicalise({ 'install-shared-cache': "/vm" },
+                                                { 'install-shared-cache': "/pool" })
+                         ['install-shared-cache'], "/pool")
+
+    def test_existing_shared_entry_not_republished(self):
+        eliloader.set_shared_cache(self.shared)
+        key = eliloader.artefact_key(URL)
+        dest = os.path.join(self.dir, "dest")
+        f = open(dest, "wb")
+        f.write(DATA)
+        f.close()
+        eliloader.publish_artefact(self.shared, key, dest, { 'url': URL, 'size': "1",
+                                                             'md5': "other" })
+        eliloader.publish_fetched(URL, dest, hashlib.md5(DATA).hexdigest(), {}, None)
+        self.assertEqual(eliloader.find_entry(self.local, key)['size'], str(len(DATA)))
+        self.assertEqual(eliloader.find_entry(self.shared, key)['md5'], "other")
+
+    def test_shared_trim_throttled(self):
+        eliloader.set_shared_cache(self.shared)
+        saved = eliloader.artefact_cache_max_size[self.shared]
+        eliloader.artefact_cache_max_size[self.shared] = 0
+        try:
+            path = eliloader.entry_path(self.shared, eliloader.artefact_key(URL))
+            open(os.path.join(self.shared, ".trimmed"), "w").close()
+            for f in ["", ".meta"]:
+                open(path + f, "w").write("x")
+            eliloader.trim_artefact_cache(self.shared)
+            self.assertTrue(os.path.exists(path))
+            os.utime(os.path.join(self.shared, ".trimmed"), (0, 0))
+            eliloader.trim_artefact_cache(self.shared)
+            self.assertFalse(os.path.exists(path))
+        finally:
+            eliloader.artefact_cache_max_size[self.shared] = saved
+
+if __name__ == "__main__":
+    unittest.main()
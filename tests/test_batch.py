@@ -0,0 +1,98 @@
+import BaseHTTPServer
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+REPO = "http://repo.example.com/os/"
+
+class NamedProxy(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ A proxy answering every request with the name of its server. """
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.server.name)))
+        self.end_headers()
+        self.wfile.write(self.server.name)
+    def log_message(self, *args):
+        pass
+
+def start_proxy(name):
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), NamedProxy)
+    server.name = name
+    t = threading.Thread(target = server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server
+
+class Barrier:
+    def __init__(self, parties):
+        self.parties = parties
+        self.cond = threading.Condition()
+    def wait(self):
+        self.cond.acquire()
+        try:
+            self.parties -= 1
+            self.cond.notifyAll()
+            while self.parties > 0:
+                self.cond.wait(10)
+        finally:
+            self.cond.release()
+
+class ConcurrentGroupsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = (eliloader.REPO_HOSTS, eliloader.REPO_ABSENT, eliloader.MIRROR_STATS)
+        eliloader.REPO_HOSTS = os.path.join(self.dir, "repo-hosts")
+        eliloader.REPO_ABSENT = os.path.join(self.dir, "repo-absent")
+        eliloader.MIRROR_STATS = os.path.join(self.dir, "mirror-stats")
+        self.proxies = [start_proxy("group-a"), start_proxy("group-b")]
+
+    def tearDown(self):
+        for server in self.proxies:
+            server.shutdown()
+            server.server_close()
+        eliloader.REPO_HOSTS, eliloader.REPO_ABSENT, eliloader.MIRROR_STATS = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_two_groups(self):
+        barrier = Barrier(2)
+
+        def group(server, mirror):
+            eliloader.install_proxy("http://127.0.0.1:%d/" % server.server_address[1])
+            eliloader.register_mirrors(REPO, [mirror])
+            # both groups have set themselves up before either fetches
+            barrier.wait()
+            candidates = [m for m, _ in eliloader.mirror_candidates(REPO + "vmlinuz")]
+            fd = eliloader.urlopen(REPO + "vmlinuz")
+            try:
+                return sorted(candidates), fd.read()
+            finally:
+                fd.close()
+
+        jobs = [lambda : group(self.proxies[0], "http://mirror-a.example.com/os/"),
+                lambda : group(self.proxies[1], "http://mirror-b.example.com/os/")]
+        results = eliloader.run_pool(jobs, 2)
+
+        self.assertEqual(results[0], (True, (sorted([REPO, "http://mirror-a.example.com/os/"]),
+                                             "group-a")))
+        self.assertEqual(results[1], (True, (sorted([REPO, "http://mirror-b.example.com/os/"]),
+                                             "group-b")))
+        # and the main thread's settings are untouched
+        self.assertEqual(eliloader.fetch_context.mirrors, {})
+        self.assertEqual(eliloader.fetch_context.opener, None)
+
+    def test_digests(self):
+        results = eliloader.run_pool([lambda i = i: eliloader.remember_digest("f%d" % i, str(i))
+                                      for i in range(8)], 4)
+        self.assertEqual([ok for ok, _ in results], [True] * 8)
+        self.assertEqual([eliloader.known_digest("f%d" % i) for i in range(8)],
+                         [str(i) for i in range(8)])
+
+if __name__ == "__main__":
+    unittest.main()
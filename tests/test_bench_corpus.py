@@ -0,0 +1,70 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+import bench_initrd
+
+class CorpusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = eliloader.BOOTDIR
+        eliloader.BOOTDIR = self.dir
+
+    def tearDown(self):
+        eliloader.BOOTDIR = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_synthetic_data(self):
+        data = bench_initrd.synthetic_data("seed", 100000)
+        self.assertEqual(len(data), 100000)
+        # the same from one run (and commit) to the next
+        self.assertEqual(bench_initrd.synthetic_data("seed", 100000), data)
+        self.assertNotEqual(bench_initrd.synthetic_data("other", 100000), data)
+        # and compressing about as well as an initrd's binaries
+        ratio = len(zlib.compress(data, 6)) / float(len(data))
+        self.assertTrue(0.45 < ratio < 0.7, ratio)
+        self.assertEqual(len(bench_initrd.synthetic_data("odd", 4097)), 4097)
+
+    def test_make_tree(self):
+        count = bench_initrd.make_tree(self.dir, 1, 16 * 1024, "tree")
+        self.assertEqual(count, 64)
+        sizes = [os.path.getsize(os.path.join(root, f))
+                 for root, _, files in os.walk(self.dir) for f in files]
+        self.assertEqual(sizes, [16 * 1024] * 64)
+        # files larger than the tree make a single file
+        other = os.path.join(self.dir, "large")
+        os.mkdir(other)
+        self.assertEqual(bench_initrd.make_tree(other, 1, 8 * 1024 * 1024, "large"), 1)
+
+    def test_measure(self):
+        def step(path):
+            f = open(path, "wb")
+            f.write("x" * (4 * 1024 * 1024))
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        elapsed, rss, disk = bench_initrd.measure(step, os.path.join(self.dir, "out"))
+        self.assertTrue(elapsed >= 0)
+        self.assertTrue(rss > 0)
+        self.assertTrue(disk >= 0)
+        self.assertEqual(os.path.getsize(os.path.join(self.dir, "out")), 4 * 1024 * 1024)
+
+    def test_measure_failure(self):
+        def step():
+            raise ValueError
+        saved = sys.stderr
+        sys.stderr = open(os.devnull, "w")
+        try:
+            self.assertRaises(bench_initrd.StepFailed, bench_initrd.measure, step)
+        finally:
+            sys.stderr.close()
+            sys.stderr = saved
+
+if __name__ == "__main__":
+    unittest.main()
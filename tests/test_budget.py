@@ -0,0 +1,145 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+OWN = "/system.slice/xenopsd.service"
+
+def read(path):
+    return open(path).read()
+
+def write(path, data = ""):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    f = open(path, "w")
+    f.write(data)
+    f.close()
+
+class CgroupTest(unittest.TestCase):
+    """ enter_cgroups against a directory laid out like a cgroup v2 root. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix = "lgl-test-")
+        write(os.path.join(self.root, "cgroup.controllers"), "cpu io memory")
+        write(os.path.join(self.root, "cgroup.subtree_control"), "cpu io memory")
+        write(os.path.join(self.root, "lgl.slice", "cgroup.subtree_control"), "cpu io memory")
+        self.saved = eliloader.CGROUP_ROOT, eliloader.own_cgroups, \
+            eliloader.helper_cgroup_delegate
+        eliloader.CGROUP_ROOT = self.root
+        eliloader.own_cgroups = lambda : { '': OWN }
+        eliloader.helper_cgroup_delegate = "lgl.slice"
+        self.parent = os.path.join(self.root, "lgl.slice", eliloader.helper_cgroup)
+
+    def tearDown(self):
+        eliloader.CGROUP_ROOT, eliloader.own_cgroups, \
+            eliloader.helper_cgroup_delegate = self.saved
+        shutil.rmtree(self.root)
+
+    def test_run_cgroup(self):
+        joined, left = eliloader.enter_cgroups()
+        run = os.path.join(self.parent, "run-%d" % os.getpid())
+        self.assertEqual(joined, [run])
+        self.assertEqual(left, [os.path.join(self.root, OWN.lstrip("/"), "cgroup.procs")])
+        self.assertEqual(read(os.path.join(run, "cgroup.procs")), str(os.getpid()))
+        # limits per run, weights shared
+        self.assertEqual(read(os.path.join(run, "memory.max")),
+                         str(eliloader.helper_memory_max))
+        self.assertFalse(os.path.exists(os.path.join(self.parent, "memory.max")))
+        self.assertEqual(read(os.path.join(self.parent, "cpu.weight")),
+                         str(eliloader.helper_cpu_weight))
+        self.assertFalse(os.path.exists(os.path.join(run, "cpu.weight")))
+        # nothing above the delegated cgroup changed
+        self.assertEqual(sorted(os.listdir(self.root)),
+                         ["cgroup.controllers", "cgroup.subtree_control", "lgl.slice"])
+        self.assertEqual(read(os.path.join(self.root, "cgroup.subtree_control")),
+                         "cpu io memory")
+        self.assertEqual(read(os.path.join(self.root, "lgl.slice", "cgroup.subtree_control")),
+                         "cpu io memory")
+
+    def test_no_delegate(self):
+        eliloader.helper_cgroup_delegate = None
+        self.assertEqual(eliloader.enter_cgroups(), ([], []))
+        self.assertFalse(os.path.exists(self.parent))
+
+    def test_delegate_without_controllers(self):
+        write(os.path.join(self.root, "lgl.slice", "cgroup.subtree_control"), "cpu")
+        self.assertEqual(eliloader.enter_cgroups(), ([], []))
+        self.assertFalse(os.path.exists(self.parent))
+
+    def test_stale_runs_removed(self):
+        os.makedirs(os.path.join(self.parent, "run-1"))
+        busy = os.path.join(self.parent, "run-2")
+        os.makedirs(busy)
+        open(os.path.join(busy, "cgroup.procs"), "w").close()
+        eliloader.enter_cgroups()
+        self.assertFalse(os.path.exists(os.path.join(self.parent, "run-1")))
+        self.assertTrue(os.path.exists(busy))
+
+    def test_stats(self):
+        joined, _ = eliloader.enter_cgroups()
+        f = open(os.path.join(joined[0], "io.pressure"), "w")
+        f.write("some avg10=0.00 avg60=0.00 avg300=0.00 total=1234\n")
+        f.close()
+        f = open(os.path.join(self.parent, "cpu.stat"), "w")
+        f.write("usage_usec 10\nthrottled_usec 99\n")
+        f.close()
+        stats = eliloader.budget_stats(joined)
+        self.assertEqual(stats['io'], 1234)
+        self.assertEqual(stats['throttled'], 99)
+
+class CgroupV1Test(unittest.TestCase):
+    """ enter_cgroups against per-controller cgroup v1 hierarchies. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix = "lgl-test-")
+        for controller in ["cpu", "blkio", "memory"]:
+            write(os.path.join(self.root, controller, OWN.lstrip("/"), "cgroup.procs"))
+        self.saved = eliloader.CGROUP_ROOT, eliloader.own_cgroups
+        eliloader.CGROUP_ROOT = self.root
+        eliloader.own_cgroups = lambda : { 'cpu': OWN, 'blkio': OWN, 'memory': OWN }
+
+    def tearDown(self):
+        eliloader.CGROUP_ROOT, eliloader.own_cgroups = self.saved
+        shutil.rmtree(self.root)
+
+    def test_nested_under_own(self):
+        joined, left = eliloader.enter_cgroups()
+        run = "%s/run-%d" % (eliloader.helper_cgroup, os.getpid())
+        self.assertEqual(joined, [os.path.join(self.root, c, OWN.lstrip("/"), run)
+                                  for c in ["cpu", "blkio", "memory"]])
+        self.assertEqual(left, [os.path.join(self.root, c, OWN.lstrip("/"), "cgroup.procs")
+                                for c in ["cpu", "blkio", "memory"]])
+        self.assertEqual(read(os.path.join(joined[2], "memory.limit_in_bytes")),
+                         str(eliloader.helper_memory_max))
+        self.assertEqual(os.listdir(os.path.join(self.root, "cpu")), ["system.slice"])
+
+class HelperPriorityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = eliloader.budget
+
+    def tearDown(self):
+        eliloader.budget = self.saved
+
+    def niceness(self):
+        return int(subprocess.Popen(["nice"], stdout = subprocess.PIPE,
+                                    preexec_fn = eliloader.helper_preexec).communicate()[0])
+
+    def test_helpers_only(self):
+        own = os.nice(0)
+        eliloader.budget = None
+        self.assertEqual(self.niceness(), own)
+        eliloader.budget = ([], [], {})
+        self.assertEqual(self.niceness(), min(19, own + eliloader.helper_nice))
+        self.assertEqual(eliloader.run_command(["nice"], 'test')[1].strip(),
+                         str(min(19, own + eliloader.helper_nice)))
+        # eliloader itself carries on as it was
+        self.assertEqual(os.nice(0), own)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+def key(n, home = None):
+    """ A 20 byte key; keys sharing home probe from the same slot. """
+    k = hashlib.sha1(str(n)).digest()
+    if home is not None:
+        k = hashlib.sha1(str(home)).digest()[:8] + k[8:]
+    return k
+
+META = { 'size': "1234", 'md5': hashlib.md5("x").hexdigest(),
+         'sha256': hashlib.sha256("x").hexdigest(), 'etag': '"abc"',
+         'last-modified': "Mon, 19 Oct 2026 10:00:00 GMT" }
+
+class CacheIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = os.path.realpath(tempfile.mkdtemp(prefix = "lgl-test-"))
+        self.index = eliloader.CacheIndex(self.dir)
+
+    def tearDown(self):
+        eliloader.set_shared_cache(None)
+        shutil.rmtree(self.dir)
+
+    def add_entry(self, k, data = "x"):
+        """ An entry as publish_artefact leaves it, without its record. """
+        path = eliloader.entry_path(self.dir, k)
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        f = open(path + ".meta", "w")
+        f.write("size %d\nmd5 %s\n" % (len(data), hashlib.md5(data).hexdigest()))
+        f.close()
+
+    def test_missing_index(self):
+        self.assertEqual(self.index.lookup(key(1)), (False, None))
+        self.assertEqual(self.index.records(), {})
+
+    def test_put_lookup(self):
+        self.index.put(key(1), META, 1000.0)
+        known, meta = self.index.lookup(key(1))
+        self.assertTrue(known)
+        self.assertEqual(meta.pop('last-use'), "1000.000000")
+        self.assertEqual(meta, META)
+        self.assertEqual(self.index.lookup(key(2)), (True, None))
+        self.assertEqual(self.index.records().keys(), [key(1)])
+
+    def test_put_replaces(self):
+        self.index.put(key(1), META)
+        self.index.put(key(1), { 'size': "5" })
+        self.assertEqual(self.index.lookup(key(1))[1]['size'], "5")
+        self.assertEqual(len(self.index.records()), 1)
+
+    def test_touch(self):
+        self.index.put(key(1), META, 1000.0)
+        self.index.touch(key(1))
+        last_use = float(self.index.lookup(key(1))[1]['last-use'])
+        self.assertTrue(last_use > time.time() - 60)
+
+    def test_remove_keeps_probe_chain(self):
+        self.index.put(key(1, home = 0), META)
+        self.index.put(key(2, home = 0), META)
+        self.index.remove(key(1, home = 0))
+        self.assertEqual(self.index.lookup(key(1, home = 0)), (True, None))
+        self.assertTrue(self.index.lookup(key(2, home = 0))[1] is not None)
+        # the tombstone is reused
+        self.index.put(key(3, home = 0), META)
+        self.assertEqual(sorted(self.index.records().keys()),
+                         sorted([key(2, home = 0), key(3, home = 0)]))
+
+    def test_torn_record(self):
+        self.index.put(key(1), META)
+        offset = self.index.offsets(key(1), eliloader.index_slots_default).next()
+        f = open(self.index.path, "r+b")
+        try:
+            f.seek(offset + 30)
+            f.write("!")
+        finally:
+            f.close()
+        self.assertEqual(self.index.lookup(key(1)), (False, None))
+
+    def test_rebuild(self):
+        for n in range(3):
+            self.add_entry(key(n), "data%d" % n)
+        self.index.put(key(0), { 'size': "5" }, 1000.0)
+        stale = os.path.join(self.dir, ".publish-old")
+        open(stale, "w").close()
+        os.utime(stale, (0, 0))
+        os.unlink(eliloader.entry_path(self.dir, key(2)))
+
+        eliloader.rebuild_index(self.dir)
+
+        records = self.index.records()
+        self.assertEqual(sorted(records.keys()), sorted([key(0), key(1)]))
+        # last use carried over from the old index
+        self.assertEqual(records[key(0)]['last-use'], "1000.000000")
+        self.assertEqual(records[key(1)]['md5'], hashlib.md5("data1").hexdigest())
+        self.assertFalse(os.path.exists(stale))
+        self.assertFalse(os.path.exists(eliloader.entry_path(self.dir, key(2)) + ".meta"))
+
+    def test_rebuild_waits_for_writers(self):
+        self.add_entry(key(1))
+        fd = self.index.lock()
+        rebuild = threading.Thread(target = eliloader.rebuild_index, args = (self.dir,))
+        rebuild.start()
+        try:
+            time.sleep(0.2)
+            self.assertTrue(rebuild.isAlive())
+            # a writer publishing while the rebuild waits
+            self.add_entry(key(2))
+        finally:
+            os.close(fd)
+        rebuild.join(10)
+        self.assertEqual(sorted(self.index.records().keys()), sorted([key(1), key(2)]))
+        # writers find the new index, not the one renamed over
+        self.index.put(key(3), META)
+        self.assertTrue(self.index.lookup(key(3))[1] is not None)
+
+    def test_shared_tier_unindexed(self):
+        saved = eliloader.shared_cache_roots
+        eliloader.shared_cache_roots = [os.path.dirname(self.dir)]
+        try:
+            eliloader.set_shared_cache(self.dir)
+        finally:
+            eliloader.shared_cache_roots = saved
+        index = eliloader.CacheIndex(self.dir)
+        index.put(key(1), META)
+        self.assertFalse(os.path.exists(index.path))
+        self.assertEqual(index.lookup(key(1)), (False, None))
+        # so entries are found through their .meta files
+        self.add_entry(key(2))
+        self.assertEqual(eliloader.find_entry(self.dir, key(2))['size'], "1")
+
+if __name__ == "__main__":
+    unittest.main()
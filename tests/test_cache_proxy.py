@@ -0,0 +1,95 @@
+import httplib
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+class CacheProxyFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved_hosts = eliloader.CACHE_PROXY_HOSTS
+        eliloader.CACHE_PROXY_HOSTS = os.path.join(self.dir, "hosts")
+
+    def tearDown(self):
+        eliloader.CACHE_PROXY_HOSTS = self.saved_hosts
+        shutil.rmtree(self.dir)
+
+    def test_url_endpoint(self):
+        self.assertEqual(eliloader.url_endpoint("http://Repo.Example.com/os/"),
+                         "repo.example.com:80")
+        self.assertEqual(eliloader.url_endpoint("http://u@repo:8080/x"), "repo:8080")
+        self.assertEqual(eliloader.url_endpoint("ftp://repo/x"), "repo:21")
+        self.assertEqual(eliloader.url_endpoint("nfs:server:/path"), None)
+
+    def test_allowed_hosts(self):
+        eliloader.allow_cache_proxy_hosts(["http://repo.example.com/os/",
+                                           "http://mirror.example.com:8080/os/"])
+        self.assertEqual(sorted(eliloader.cache_proxy_hosts()),
+                         ["mirror.example.com:8080", "repo.example.com:80"])
+
+    def test_expired_hosts(self):
+        saved = eliloader.cache_proxy_host_ttl
+        eliloader.cache_proxy_host_ttl = -10
+        try:
+            eliloader.allow_cache_proxy_hosts(["http://repo.example.com/"])
+        finally:
+            eliloader.cache_proxy_host_ttl = saved
+        self.assertEqual(eliloader.cache_proxy_hosts(), [])
+
+    def test_refused_addresses(self):
+        for address in ["127.0.0.1", "127.1.2.3", "0.0.0.0", "169.254.169.254",
+                        "224.0.0.1"]:
+            self.assertTrue(eliloader.address_refused(socket.AF_INET, address), address)
+        for address in ["::1", "::", "fe80::1", "ff02::1", "::ffff:127.0.0.1"]:
+            self.assertTrue(eliloader.address_refused(socket.AF_INET6, address), address)
+        self.assertFalse(eliloader.address_refused(socket.AF_INET, "192.0.2.1"))
+        self.assertFalse(eliloader.address_refused(socket.AF_INET6, "2001:db8::1"))
+
+    def test_listen_address(self):
+        self.assertTrue(eliloader.cache_proxy_listen_valid("127.0.0.1:3128"))
+        for listen in ["192.0.2.1:3128", "repo.example.com:3128", "127.0.0.1",
+                       "127.0.0.1:0", "127.0.0.1:http", "127.0.0.1:70000"]:
+            self.assertFalse(eliloader.cache_proxy_listen_valid(listen), listen)
+        self.assertFalse(eliloader.ensure_cache_proxy("192.0.2.1:3128", None))
+
+    def test_pool_config_only(self):
+        self.assertEqual(eliloader.canonicalise({ 'install-cache-proxy': "10.0.0.1:3128" },
+                                                {})['install-cache-proxy'], None)
+        self.assertEqual(eliloader.canonicalise({}, { 'install-cache-proxy': "10.0.0.1:3128" })
+                         ['install-cache-proxy'], "10.0.0.1:3128")
+
+    def test_refusals(self):
+        eliloader.allow_cache_proxy_hosts(["http://localhost/", "http://127.0.0.1:8080/"])
+        self.assertNotEqual(eliloader.cache_proxy_refusal("ftp://localhost/"), None)
+        self.assertNotEqual(eliloader.cache_proxy_refusal("http://repo.example.com/"), None)
+        self.assertNotEqual(eliloader.cache_proxy_refusal("http://127.0.0.1/"), None)
+        # allowed, but loopback
+        self.assertNotEqual(eliloader.cache_proxy_refusal("http://localhost/x.rpm"), None)
+        self.assertNotEqual(eliloader.cache_proxy_refusal("http://127.0.0.1:8080/"), None)
+
+    def test_proxy_answers_403(self):
+        eliloader.allow_cache_proxy_hosts(["http://localhost/"])
+        server = eliloader.CachingProxy(("127.0.0.1", 0), self.dir, None)
+        t = threading.Thread(target = server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        try:
+            for url in ["http://127.0.0.1/", "http://localhost/os/x.rpm",
+                        "http://192.0.2.1/"]:
+                conn = httplib.HTTPConnection("127.0.0.1", server.server_address[1])
+                conn.request("GET", url)
+                self.assertEqual(conn.getresponse().status, 403, url)
+                conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+def noise(n, seed):
+    r = random.Random(seed)
+    return "".join([chr(r.randint(0, 255)) for _ in xrange(n)])
+
+class SplitChunksTest(unittest.TestCase):
+
+    def chunks(self, data):
+        return list(eliloader.split_chunks(StringIO.StringIO(data)))
+
+    def test_bounds(self):
+        data = noise(600 * 1024, 1)
+        chunks = self.chunks(data)
+        self.assertEqual("".join(chunks), data)
+        for c in chunks[:-1]:
+            self.assertTrue(eliloader.chunk_min_size <= len(c) <= eliloader.chunk_max_size)
+        self.assertTrue(0 < len(chunks[-1]) <= eliloader.chunk_max_size)
+
+    def test_uniform(self):
+        # nothing to cut on: every chunk is as large as allowed
+        data = chr(eliloader.chunk_table.index("0")) * (3 * eliloader.chunk_max_size + 10)
+        self.assertEqual([len(c) for c in self.chunks(data)],
+                         [eliloader.chunk_max_size] * 3 + [10])
+
+    def test_small_and_empty(self):
+        self.assertEqual(self.chunks("abc"), ["abc"])
+        self.assertEqual(self.chunks(""), [])
+
+    def test_insertion_moves_nearby_boundaries_only(self):
+        data = noise(1024 * 1024, 2)
+        edited = data[:500000] + "inserted" + data[500000:]
+        before = set(self.chunks(data))
+        after = self.chunks(edited)
+        changed = [c for c in after if c not in before]
+        self.assertEqual("".join(after), edited)
+        self.assertTrue(len(changed) <= 2, len(changed))
+
+    def test_independent_of_read_size(self):
+        data = noise(300 * 1024, 3)
+        saved = eliloader.copy_block_size
+        try:
+            eliloader.copy_block_size = 1000
+            small = self.chunks(data)
+        finally:
+            eliloader.copy_block_size = saved
+        self.assertEqual(small, self.chunks(data))
+
+class ChunkStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = eliloader.CHUNK_STORE
+        eliloader.CHUNK_STORE = os.path.join(self.dir, "chunks")
+
+    def tearDown(self):
+        eliloader.CHUNK_STORE = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_chunk_file(self):
+        data = noise(200 * 1024, 4)
+        path = os.path.join(self.dir, "file")
+        f = open(path, "wb")
+        f.write(data * 2)
+        f.close()
+        recipe = eliloader.chunk_file(path)
+        self.assertEqual(sum([l for _, l in recipe]), 2 * len(data))
+        for digest, _ in recipe:
+            f = open(eliloader.chunk_path(digest), "rb")
+            self.assertEqual(hashlib.sha1(f.read()).hexdigest(), digest)
+            f.close()
+
+        fd = eliloader.ChunkedFile(recipe)
+        out = ""
+        while True:
+            block = fd.read(10000)
+            if not block:
+                break
+            out += block
+        fd.close()
+        self.assertEqual(out, data * 2)
+
+    def test_recipe_format(self):
+        recipe = [("a" * 40, 10), ("b" * 40, 20)]
+        self.assertEqual(eliloader.parse_recipe(eliloader.format_recipe(recipe)), recipe)
+        self.assertEqual(eliloader.parse_recipe("A" * 40 + " 5\n"), [("a" * 40, 5)])
+        self.assertRaises(ValueError, eliloader.parse_recipe, "abc 5\n")
+        self.assertRaises(ValueError, eliloader.parse_recipe, "a" * 40 + "\n")
+
+if __name__ == "__main__":
+    unittest.main()
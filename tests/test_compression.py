@@ -0,0 +1,76 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+class ThreadedHelpersTest(unittest.TestCase):
+    """ pigz, xz and lbzip2 are used with several threads when there are
+    threads to spare and dom0 has them. """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = (eliloader.PIGZ, eliloader.XZ, eliloader.LBZIP2,
+                      eliloader.helper_thread_budget)
+        for name in ["PIGZ", "XZ", "LBZIP2"]:
+            setattr(eliloader, name, os.path.join(self.dir, name.lower()))
+        eliloader.helper_thread_budget = 4
+
+    def tearDown(self):
+        (eliloader.PIGZ, eliloader.XZ, eliloader.LBZIP2,
+         eliloader.helper_thread_budget) = self.saved
+        shutil.rmtree(self.dir)
+
+    def install(self, *tools):
+        for tool in tools:
+            open(tool, "w").close()
+
+    def test_helper_threads(self):
+        self.assertEqual(eliloader.helper_threads(), 4)
+        eliloader.helper_thread_budget = 0
+        self.assertEqual(eliloader.helper_threads(), os.sysconf('SC_NPROCESSORS_ONLN'))
+
+    def test_sniff(self):
+        self.assertEqual(eliloader.sniff_compression("\037\213\010\000\000\000"), "gzip")
+        self.assertEqual(eliloader.sniff_compression("\3757zXZ\000"), "xz")
+        self.assertEqual(eliloader.sniff_compression("\x5d\x00\x00\x80\x00\x00"), "lzma")
+        self.assertEqual(eliloader.sniff_compression("BZh91A"), "bzip2")
+        self.assertEqual(eliloader.sniff_compression("070701"), None)
+
+    def test_parallel_decompressors(self):
+        self.install(eliloader.PIGZ, eliloader.XZ, eliloader.LBZIP2)
+        self.assertEqual(eliloader.decompressor_for("gzip"),
+                         [eliloader.PIGZ, "-dc", "-p", "4"])
+        self.assertEqual(eliloader.decompressor_for("xz"),
+                         [eliloader.XZ, "-dc", "--threads=4"])
+        self.assertEqual(eliloader.decompressor_for("bzip2"),
+                         [eliloader.LBZIP2, "-dc", "-n", "4"])
+        # lzma can't be decoded in parallel
+        self.assertEqual(eliloader.decompressor_for("lzma"),
+                         ["/usr/bin/xzcat", "--format=lzma"])
+        self.assertEqual(eliloader.decompressor_for(None), None)
+
+    def test_serial_decompressors(self):
+        # without the tools, or without threads to spare
+        self.assertEqual(eliloader.decompressor_for("gzip"), ["/bin/zcat"])
+        self.assertEqual(eliloader.decompressor_for("bzip2"), ["/usr/bin/bzcat"])
+        self.install(eliloader.PIGZ)
+        eliloader.helper_thread_budget = 1
+        self.assertEqual(eliloader.decompressor_for("gzip"), ["/bin/zcat"])
+
+    def test_compressors(self):
+        self.assertEqual(eliloader.get_compressor('gzip:6'), ["/bin/gzip", "-c", "-6"])
+        self.install(eliloader.PIGZ)
+        self.assertEqual(eliloader.get_compressor('gzip:6'),
+                         [eliloader.PIGZ, "-c", "-p", "4", "-6"])
+        self.assertEqual(eliloader.get_compressor('gzip:6:2'),
+                         [eliloader.PIGZ, "-c", "-p", "2", "-6"])
+        self.assertEqual(eliloader.get_compressor('gzip:6:1'), ["/bin/gzip", "-c", "-6"])
+        self.assertEqual(eliloader.get_compressor('xz'),
+                         [eliloader.XZ, "-c", "--check=crc32", "--threads=4"])
+
+if __name__ == "__main__":
+    unittest.main()
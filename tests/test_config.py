@@ -0,0 +1,115 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+UUID = "6b1bd2b4-8e4f-4a31-9a3c-5f3c0d1c2e7a"
+
+class ConfigTest(unittest.TestCase):
+
+    def test_size_limits(self):
+        defaults = (eliloader.pv_kernel_max_size, eliloader.pv_initrd_max_size)
+        self.assertEqual(eliloader.size_limits(), defaults)
+        self.assertEqual(eliloader.size_limits({'kernel': None, 'ramdisk': None}), defaults)
+        self.assertEqual(eliloader.size_limits({'kernel': 1, 'ramdisk': None},
+                                               {'kernel': 2, 'ramdisk': 3}), (1, 3))
+        self.assertEqual(eliloader.size_limits({}, {'kernel': 2}),
+                         (2, eliloader.pv_initrd_max_size))
+        # resolving limits leaves the defaults alone
+        self.assertEqual((eliloader.pv_kernel_max_size, eliloader.pv_initrd_max_size),
+                         defaults)
+
+    def test_uuid_pattern(self):
+        self.assertTrue(eliloader.uuid_pattern.match(UUID))
+        self.assertTrue(eliloader.uuid_pattern.match(UUID.upper()))
+        for bad in ['', '-', UUID + '"', UUID + '" or field "uuid" = "x', UUID[:-1]]:
+            self.assertFalse(eliloader.uuid_pattern.match(bad), bad)
+
+    def test_unvalidated_uuids_rejected(self):
+        # before anything is asked of xenstore or xapi
+        bad = UUID + '" or true or "'
+        self.assertRaises(eliloader.UsageError, eliloader.resolve_config, bad)
+        self.assertRaises(eliloader.UsageError, eliloader.resolve_config, None)
+        self.assertRaises(eliloader.UsageError, eliloader.read_vm_records, [UUID, bad])
+
+    def test_boot_config_read_only(self):
+        config = eliloader.BootConfig({'install-round': '1'}, kernel_max_size = 1)
+        self.assertEqual(config['install-round'], '1')
+        self.assertEqual(config.kernel_max_size, 1)
+        self.assertRaises(TypeError, config.__setitem__, 'install-round', '2')
+        self.assertRaises(TypeError, setattr, config, 'kernel_max_size', 2)
+
+class FakeStore:
+    """ A xenstore connection holding the given paths. """
+    def __init__(self, values):
+        self.values = values
+        self.transactions = 0
+    def transaction_start(self):
+        self.transactions += 1
+        return self.transactions
+    def transaction_end(self, t):
+        return True
+    def read(self, t, path):
+        return self.values.get(path)
+    def ls(self, t, path):
+        return [k.split("/")[-1] for k in self.values.keys() if k.startswith(path + "/")]
+
+class HostConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = eliloader.HOST_CONFIG, eliloader.xs.xs
+        eliloader.HOST_CONFIG = os.path.join(self.dir, "host-config")
+
+    def tearDown(self):
+        eliloader.HOST_CONFIG, eliloader.xs.xs = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_pool_config_cached(self):
+        self.assertEqual(eliloader.read_host_config(), None)
+        eliloader.write_host_config({ 'install-shared-cache': "/var/run/sr-mount/x",
+                                      'other-key': "ignored" })
+        self.assertEqual(eliloader.read_host_config(),
+                         { 'install-shared-cache': "/var/run/sr-mount/x" })
+        saved = eliloader.host_config_ttl
+        eliloader.host_config_ttl = -1
+        try:
+            self.assertEqual(eliloader.read_host_config(), None)
+        finally:
+            eliloader.host_config_ttl = saved
+
+    def test_host_limits_read_every_time(self):
+        values = { eliloader.xs_host_limits['kernel']: "1000" }
+        eliloader.xs.xs = lambda : FakeStore(values)
+        self.assertEqual(eliloader.read_xenstore(None, True)[0]['kernel'], 1000)
+        values[eliloader.xs_host_limits['kernel']] = "2000"
+        self.assertEqual(eliloader.read_xenstore(None, True)[0]['kernel'], 2000)
+        # and no daemon is left behind to keep them current
+        self.assertFalse(hasattr(eliloader, 'watch_host_config'))
+
+    def test_vm_boot_config(self):
+        # as used by both single boots and batches
+        values = { eliloader.xs_host_limits['kernel']: "1000",
+                   eliloader.xs_host_limits['ramdisk']: "3000",
+                   "/vm/%s/domains/7" % UUID: "",
+                   eliloader.xs_vm_limit % (7, 'kernel'): "2000" }
+        eliloader.xs.xs = lambda : FakeStore(values)
+        record = { 'other_config': { 'install-distro': "debianlike",
+                                     'install-proxy': "http://proxy:3128/",
+                                     'install-shared-cache': "/tmp" },
+                   'platform': {}, 'PV_args': "quiet" }
+        pool_config = { 'install-shared-cache': "/var/run/sr-mount/x" }
+        config = eliloader.vm_boot_config(UUID, "OpaqueRef:vm", record, pool_config)
+        self.assertEqual(config.domid, 7)
+        self.assertEqual((config.kernel_max_size, config.initrd_max_size), (2000, 3000))
+        self.assertEqual(config['install-distro'], "debianlike")
+        self.assertEqual(config['install-proxy'], "http://proxy:3128/")
+        self.assertEqual(config['install-shared-cache'], "/var/run/sr-mount/x")
+        self.assertEqual(config.pv_args, "quiet")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+# enough to take a few growing blocks and a few full-sized ones
+DATA = "".join([chr(i % 251) for i in range(3 * eliloader.copy_block_size + 12345)])
+
+class CopyfdTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.source = os.path.join(self.dir, "source")
+        f = open(self.source, "wb")
+        f.write(DATA)
+        f.close()
+        self.saved_splice = eliloader.libc_splice
+
+    def tearDown(self):
+        eliloader.libc_splice = self.saved_splice
+        shutil.rmtree(self.dir)
+
+    def copy_to_file(self, mode):
+        dest = os.path.join(self.dir, "dest")
+        src = open(self.source, "rb")
+        dst = open(dest, mode)
+        try:
+            rc = eliloader.copyfd(src, dst, len(DATA))
+        finally:
+            dst.close()
+            src.close()
+        self.assertEqual(rc, (len(DATA), True))
+        self.assertEqual(open(dest, "rb").read(), DATA)
+
+    def test_binary_file(self):
+        eliloader.libc_splice = None
+        self.copy_to_file("wb")
+
+    def test_text_file(self):
+        eliloader.libc_splice = None
+        self.copy_to_file("w")
+
+    def copy_to_pipe(self):
+        r, w = os.pipe()
+        r, w = os.fdopen(r, "rb"), os.fdopen(w, "wb")
+        out = []
+        reader = threading.Thread(target = lambda : out.append(r.read()))
+        reader.start()
+        src = open(self.source, "rb")
+        try:
+            rc = eliloader.copyfd(src, w, len(DATA))
+        finally:
+            w.close()
+            src.close()
+        reader.join()
+        r.close()
+        self.assertEqual(rc, (len(DATA), True))
+        self.assertEqual(out[0], DATA)
+
+    def test_pipe_without_splice(self):
+        eliloader.libc_splice = None
+        self.copy_to_pipe()
+
+    def test_pipe(self):
+        self.copy_to_pipe()
+
+    def test_string_source(self):
+        dst = StringIO.StringIO()
+        self.assertEqual(eliloader.copyfd(StringIO.StringIO(DATA), dst, len(DATA)),
+                         (len(DATA), True))
+        self.assertEqual(dst.getvalue(), DATA)
+
+    def test_limit(self):
+        eliloader.libc_splice = None
+        dst = StringIO.StringIO()
+        length, success = eliloader.copyfd(open(self.source, "rb"), dst, 1000)
+        self.assertFalse(success)
+        self.assertTrue(length > 1000)
+
+    def test_digests(self):
+        digests = [hashlib.md5(), hashlib.sha256()]
+        eliloader.copyfd(open(self.source, "rb"), StringIO.StringIO(), len(DATA), digests)
+        self.assertEqual(digests[0].hexdigest(), hashlib.md5(DATA).hexdigest())
+        self.assertEqual(digests[1].hexdigest(), hashlib.sha256(DATA).hexdigest())
+
+    def test_uncompressed_ext2_initrd(self):
+        eliloader.libc_splice = None
+        dest = os.path.join(self.dir, "ext2")
+        eliloader.decompress_ext2_initrd(self.source, dest)
+        self.assertEqual(open(dest, "rb").read(), DATA)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+class PatchExt2Test(unittest.TestCase):
+    """ The debugfs batch patch_ext2_image writes, without running
+    debugfs. """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = eliloader.list_ext2_dirs, eliloader.run_debugfs
+        self.batches = []
+        eliloader.list_ext2_dirs = lambda image, dirs: {}
+        eliloader.run_debugfs = lambda image, commands, **kw: self.batches.append(commands)
+
+    def tearDown(self):
+        eliloader.list_ext2_dirs, eliloader.run_debugfs = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_symlink(self):
+        os.symlink("../lib/libc.so.6", os.path.join(self.dir, "libc"))
+        eliloader.patch_ext2_image("image", self.dir)
+        self.assertTrue("symlink libc ../lib/libc.so.6" in self.batches[0])
+
+    def test_unexpressible_targets(self):
+        for target in ["a b", "a\nrm /init", "a\tb", 'a"b', "a\x1bb", "a\x7fb"]:
+            link = os.path.join(self.dir, "link")
+            os.symlink(target, link)
+            try:
+                self.assertRaises(eliloader.Ext2PatchError,
+                                  eliloader.patch_ext2_image, "image", self.dir)
+            finally:
+                os.unlink(link)
+        self.assertEqual(self.batches, [])
+
+    def test_unexpressible_names(self):
+        open(os.path.join(self.dir, "a\x01b"), "w").close()
+        self.assertRaises(eliloader.Ext2PatchError,
+                          eliloader.patch_ext2_image, "image", self.dir)
+        self.assertEqual(self.batches, [])
+
+if __name__ == "__main__":
+    unittest.main()
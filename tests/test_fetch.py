@@ -0,0 +1,122 @@
+import hashlib
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+DATA = "vmlinuz" * 10000
+
+class Headers:
+    def __init__(self, length):
+        self.length = length
+    def getheader(self, name, default = None):
+        if name.lower() == 'content-length':
+            return str(self.length)
+        return default
+
+class BrokenResponse:
+    """ A response which fails with a socket error partway through. """
+    def __init__(self):
+        self.sent = False
+        self.closed = False
+    def info(self):
+        return Headers(len(DATA))
+    def read(self, n = -1):
+        if self.sent:
+            raise socket.timeout("timed out")
+        self.sent = True
+        return DATA[:1000]
+    def close(self):
+        self.closed = True
+
+class ChecksumParserTest(unittest.TestCase):
+
+    def test_treeinfo(self):
+        data = "[general]\nfamily = CentOS\n[checksums]\n" \
+               "images/pxeboot/vmlinuz = sha256:ABC\nimages/pxeboot/initrd.img = md5:def\n"
+        self.assertEqual(eliloader.parse_treeinfo(data),
+                         { 'images/pxeboot/vmlinuz': ('sha256', 'abc'),
+                           'images/pxeboot/initrd.img': ('md5', 'def') })
+
+    def test_suse_content(self):
+        data = "PRODUCT SLES\nHASH SHA256 ABC  boot/x86_64/loader/linux\n" \
+               "META SHA256 def  packages.en.gz\n"
+        self.assertEqual(eliloader.parse_suse_content(data),
+                         { 'boot/x86_64/loader/linux': ('sha256', 'abc') })
+
+    def test_sums(self):
+        data = "ABC  ./netboot/vmlinuz\ndef netboot/initrd.gz\nnonsense\n"
+        self.assertEqual(eliloader.sums_parser('md5')(data),
+                         { 'netboot/vmlinuz': ('md5', 'abc'),
+                           'netboot/initrd.gz': ('md5', 'def') })
+
+    def test_expected_digest(self):
+        index = "http://repo.example.com/os/.treeinfo"
+        eliloader.repo_digests[index] = { 'vmlinuz': ('sha256', 'abc'),
+                                          'initrd.img': ('whirlpool9', 'def') }
+        try:
+            self.assertEqual(eliloader.find_expected_digest(
+                index, None, "http://repo.example.com/os/vmlinuz"), ('sha256', 'abc'))
+            # an algorithm we can't compute is no checksum at all
+            self.assertEqual(eliloader.find_expected_digest(
+                index, None, "http://repo.example.com/os/initrd.img"), None)
+            self.assertEqual(eliloader.find_expected_digest(
+                index, None, "http://elsewhere.example.com/os/vmlinuz"), None)
+        finally:
+            del eliloader.repo_digests[index]
+
+class FetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.src = os.path.join(self.dir, "src")
+        f = open(self.src, "wb")
+        f.write(DATA)
+        f.close()
+        self.url = "file://" + self.src
+        self.dest = os.path.join(self.dir, "dest")
+        self.saved = eliloader.urlopen
+
+    def tearDown(self):
+        eliloader.urlopen = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_verified(self):
+        expected = ('sha256', hashlib.sha256(DATA).hexdigest())
+        self.assertEqual(eliloader.fetchFile(self.url, self.dest, 1 << 20, expected),
+                         hashlib.md5(DATA).hexdigest())
+        self.assertEqual(open(self.dest).read(), DATA)
+
+    def test_mismatch(self):
+        self.assertRaises(eliloader.InvalidSource, eliloader.fetchFile,
+                          self.url, self.dest, 1 << 20, ('sha256', "0" * 64))
+
+    def test_unknown_algorithm(self):
+        self.assertRaises(eliloader.InvalidSource, eliloader.fetchFile,
+                          self.url, self.dest, 1 << 20, ('whirlpool9', "0" * 64))
+
+    def test_too_large(self):
+        self.assertRaises(eliloader.ResourceTooLarge, eliloader.fetchFile,
+                          self.url, self.dest, 100)
+
+    def test_socket_error(self):
+        responses = []
+        def urlopen(source, method = None, headers = {}):
+            responses.append(BrokenResponse())
+            return responses[-1]
+        eliloader.urlopen = urlopen
+        self.assertRaises(eliloader.TransferError, eliloader.fetch_once,
+                          self.url, self.dest, 1 << 20, None, None)
+        self.assertTrue(responses[0].closed)
+        # retried, then reported as an access error
+        self.assertRaises(eliloader.ResourceAccessError, eliloader.fetchFile,
+                          self.url, self.dest, 1 << 20)
+        self.assertEqual(len(responses), 1 + eliloader.fetch_attempts)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+import gzip
+import os
+import shutil
+import StringIO
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+def elf64(notes = [], pad = 0):
+    """ A little-endian x86_64 ELF header with one PT_NOTE program header
+    holding notes, a list of (name, type, desc), placed pad bytes in. """
+    data = ""
+    for name, ntype, desc in notes:
+        name += "\0"
+        data += struct.pack("<III", len(name), len(desc), ntype)
+        data += name + "\0" * (-len(name) % 4) + desc + "\0" * (-len(desc) % 4)
+    phoff = 64
+    note_offset = phoff + 56 + pad
+    ehdr = "\177ELF\002\001\001" + "\0" * 9
+    ehdr += struct.pack("<HHIQQQIHHHHHH", 2, eliloader.EM_X86_64, 1, 0, phoff, 0,
+                        0, 64, 56, 1, 64, 0, 0)
+    phdr = struct.pack("<IIQQQQQQ", 4, 4, note_offset, 0, 0, len(data), len(data), 4)
+    return ehdr + phdr + "\0" * pad + data
+
+XEN_NOTES = [("Xen", eliloader.XEN_ELFNOTE_GUEST_OS, "linux\0")]
+
+def gzipped(data):
+    buf = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj = buf, mode = "wb")
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+def bzimage(payload):
+    setup_sects = 1
+    image = bytearray(512 * (setup_sects + 1))
+    image[0x1f1] = setup_sects
+    image[0x1fe:0x200] = "\x55\xaa"
+    image[0x202:0x206] = "HdrS"
+    image[0x206:0x208] = struct.pack("<H", 0x20a)
+    image[0x248:0x250] = struct.pack("<II", 0, len(payload))
+    return str(image) + payload
+
+def cpio(files):
+    """ A newc cpio archive of files, a list of (name, content). """
+    out = ""
+    for name, content in files + [("TRAILER!!!", "")]:
+        name += "\0"
+        out += "070701" + "%08x" * 13 % (0, 0100644, 0, 0, 1, 0, len(content),
+                                         0, 0, 0, 0, len(name), 0)
+        out += name
+        out += "\0" * (-len(out) % 4) + content
+        out += "\0" * (-len(out) % 4)
+    return out
+
+class InspectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved_limit = eliloader.inspect_inflate_limit
+
+    def tearDown(self):
+        eliloader.inspect_inflate_limit = self.saved_limit
+        shutil.rmtree(self.dir)
+
+    def file(self, data):
+        path = os.path.join(self.dir, "f")
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        return path
+
+    def test_elf_kernel(self):
+        info = eliloader.inspect_kernel(self.file(elf64(XEN_NOTES)))
+        self.assertEqual(info['format'], 'elf')
+        self.assertTrue(info['xen'])
+        self.assertEqual(info['xen-notes'], [eliloader.XEN_ELFNOTE_GUEST_OS])
+        self.assertEqual(info['machine'], eliloader.EM_X86_64)
+
+    def test_not_xen(self):
+        self.assertRaises(eliloader.InvalidSource, eliloader.inspect_kernel,
+                          self.file(elf64([("GNU", 3, "abcd")])))
+
+    def test_not_a_kernel(self):
+        self.assertRaises(eliloader.InvalidSource, eliloader.inspect_kernel,
+                          self.file("<html>Not found</html>"))
+        self.assertRaises(eliloader.InvalidSource, eliloader.inspect_kernel,
+                          self.file(""))
+
+    def test_gzipped_elf(self):
+        info = eliloader.inspect_kernel(self.file(gzipped(elf64(XEN_NOTES))))
+        self.assertEqual(info['format'], 'elf.gz')
+        self.assertTrue(info['xen'])
+
+    def test_bzimage(self):
+        info = eliloader.inspect_kernel(self.file(bzimage(gzipped(elf64(XEN_NOTES)))))
+        self.assertEqual(info['format'], 'bzImage')
+        self.assertEqual(info['protocol'], "2.10")
+        self.assertEqual(info['payload'], 'gzip')
+        self.assertTrue(info['xen'])
+
+    def test_notes_out_of_reach(self):
+        eliloader.inspect_inflate_limit = 64 * 1024
+        kernel = bzimage(gzipped(elf64(XEN_NOTES, pad = 128 * 1024)))
+        info = eliloader.inspect_kernel(self.file(kernel))
+        self.assertEqual(info['format'], 'bzImage')
+        self.assertEqual(info['xen'], None)
+
+    def test_cpio_initrd(self):
+        microcode = cpio([("kernel/x86/microcode/GenuineIntel.bin", "x" * 100)])
+        main = gzipped(cpio([("init", "#!/bin/sh\n")]))
+        info = eliloader.inspect_initrd(self.file(microcode + "\0" * 300 + main))
+        self.assertEqual(info['segments'], [(0, 'cpio'), (len(microcode) + 300, 'gzip')])
+
+    def test_unrecognised_segment(self):
+        zstd = "\x28\xb5\x2f\xfd" + "z" * 100
+        microcode = cpio([("early", "x")])
+        self.assertEqual(eliloader.inspect_initrd(self.file(zstd))['segments'],
+                         [(0, None)])
+        self.assertEqual(eliloader.inspect_initrd(self.file(microcode + zstd))['segments'],
+                         [(0, 'cpio'), (len(microcode), None)])
+
+    def test_ext2_initrd(self):
+        image = bytearray(4096)
+        image[1080:1082] = "\x53\xef"
+        self.assertEqual(eliloader.inspect_initrd(self.file(str(image)))['segments'],
+                         [(0, 'ext2')])
+
+    def test_bad_initrd(self):
+        self.assertRaises(eliloader.InvalidSource, eliloader.inspect_initrd,
+                          self.file(""))
+        archive = cpio([("init", "#!/bin/sh\n" * 50)])
+        self.assertRaises(eliloader.InvalidSource, eliloader.inspect_initrd,
+                          self.file(archive[:200]))
+
+    def test_large_kernel(self):
+        # only the headers and notes are looked at, however large the file
+        path = self.file(elf64(XEN_NOTES))
+        f = open(path, "r+b")
+        f.truncate(1 << 30)
+        f.close()
+        self.assertTrue(eliloader.inspect_kernel(path)['xen'])
+
+class InspectBootFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def file(self, name, data):
+        path = os.path.join(self.dir, name)
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        return path
+
+    def test_good(self):
+        kernel = self.file("vmlinuz", bzimage(gzipped(elf64(XEN_NOTES))))
+        ramdisk = self.file("initrd", gzipped(cpio([("init", "#!/bin/sh\n")])))
+        eliloader.inspect_boot_files(kernel, ramdisk)
+        eliloader.inspect_boot_files(kernel, None)
+
+    def test_bad(self):
+        kernel = self.file("vmlinuz", bzimage(gzipped(elf64(XEN_NOTES))))
+        page = self.file("error", "<html>403 Forbidden</html>")
+        self.assertRaises(eliloader.InvalidSource, eliloader.inspect_boot_files,
+                          page, None)
+        # formats we don't know are left to the kernel, but not empty or
+        # truncated archives
+        eliloader.inspect_boot_files(kernel, page)
+        truncated = self.file("initrd", cpio([("init", "#!/bin/sh\n" * 50)])[:200])
+        self.assertRaises(eliloader.InvalidSource, eliloader.inspect_boot_files,
+                          kernel, truncated)
+        self.assertRaises(eliloader.InvalidSource, eliloader.inspect_boot_files,
+                          kernel, self.file("empty", ""))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,278 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+SECTOR = eliloader.ISO_SECTOR
+
+def both_endian(n):
+    return struct.pack("<I", n) + struct.pack(">I", n)
+
+def record(extent, size, flags, name, su = ""):
+    pad = len(name) % 2 == 0 and "\0" or ""
+    length = 33 + len(name) + len(pad) + len(su)
+    return (chr(length) + "\0" + both_endian(extent) + both_endian(size) +
+            "\0" * 7 + chr(flags) + "\0\0" + struct.pack("<HH", 1, 1) +
+            chr(len(name)) + name + pad + su)
+
+def primary_name(name, is_dir):
+    if is_dir:
+        return name.upper()
+    name = name.upper()
+    if "." not in name:
+        name += "."
+    return name + ";1"
+
+def joliet_name(name, is_dir):
+    if is_dir:
+        return name.encode("utf-16-be")
+    return (name + ";1").encode("utf-16-be")
+
+def build_iso(path, tree, rock_ridge = False, joliet = False, catalog = None):
+    """ Write an ISO9660 image of tree, a dictionary mapping names to
+    contents or to further dictionaries. """
+    sectors = {}
+    free = [20]
+
+    def alloc(data):
+        sector = free[0]
+        free[0] += max(1, (len(data) + SECTOR - 1) / SECTOR)
+        sectors[sector] = data
+        return sector
+
+    def place(tree, encode, rr):
+        dot_su = rr and "SP\x07\x01\xbe\xef\x00" or ""
+        recs = [record(0, 0, 2, "\0", dot_su), record(0, 0, 2, "\1")]
+        for name, value in sorted(tree.items()):
+            is_dir = isinstance(value, dict)
+            if is_dir:
+                extent, size = place(value, encode, rr)
+            else:
+                extent, size = alloc(value), len(value)
+            su = rr and "NM" + chr(5 + len(name)) + "\1\0" + name or ""
+            recs.append(record(extent, size, is_dir and 2 or 0,
+                               encode(name, is_dir), su))
+        data = "".join(recs)
+        assert len(data) <= SECTOR
+        return alloc(data), len(data)
+
+    descriptors = []
+    root = place(tree, primary_name, rock_ridge)
+    pvd = bytearray(SECTOR)
+    pvd[0:7] = "\1CD001\1"
+    pvd[156:190] = record(root[0], root[1], 2, "\0")
+    descriptors.append(pvd)
+    if catalog is not None:
+        brvd = bytearray(SECTOR)
+        brvd[0:7] = "\0CD001\1"
+        brvd[7:30] = "EL TORITO SPECIFICATION"
+        brvd[0x47:0x4b] = struct.pack("<I", catalog)
+        descriptors.append(brvd)
+    if joliet:
+        jroot = place(tree, joliet_name, False)
+        svd = bytearray(SECTOR)
+        svd[0:7] = "\2CD001\1"
+        svd[88:91] = "%/E"
+        svd[156:190] = record(jroot[0], jroot[1], 2, "\0")
+        descriptors.append(svd)
+    terminator = bytearray(SECTOR)
+    terminator[0:7] = "\xffCD001\1"
+    descriptors.append(terminator)
+    assert len(descriptors) <= 4
+
+    image = bytearray(free[0] * SECTOR)
+    for i, vd in enumerate(descriptors):
+        image[(16 + i) * SECTOR:(17 + i) * SECTOR] = vd
+    for sector, data in sectors.items():
+        image[sector * SECTOR:sector * SECTOR + len(data)] = data
+    f = open(path, "wb")
+    try:
+        f.write(image)
+    finally:
+        f.close()
+
+KERNEL = "kernel" * 1000
+TREE = { 'images': { 'pxeboot': { 'vmlinuz': KERNEL, 'initrd.img': "initrd" } },
+         'README': "readme" }
+
+class IsoImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.path = os.path.join(self.dir, "image.iso")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, iso, path):
+        fd = iso.open(path)
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+
+    def test_primary(self):
+        build_iso(self.path, TREE)
+        iso = eliloader.IsoImage(self.path)
+        self.assertFalse(iso.rock_ridge)
+        self.assertEqual(iso.joliet_root, None)
+        self.assertEqual(iso.boot_catalog, None)
+        # 8.3 names match whatever their case, without version or dot
+        self.assertEqual(self.read(iso, "/images/pxeboot/vmlinuz"), KERNEL)
+        self.assertEqual(self.read(iso, "images/pxeboot/initrd.img"), "initrd")
+        self.assertEqual(self.read(iso, "/readme"), "readme")
+
+    def test_file_info(self):
+        build_iso(self.path, TREE)
+        fd = eliloader.IsoImage(self.path).open("/images/pxeboot/vmlinuz")
+        try:
+            self.assertEqual(fd.info().getheader("Content-Length"), str(len(KERNEL)))
+            buf = bytearray(100)
+            self.assertEqual(fd.readinto(buf), 100)
+            self.assertEqual(str(buf), KERNEL[:100])
+            self.assertEqual(fd.read(), KERNEL[100:])
+            self.assertEqual(fd.readinto(buf), 0)
+        finally:
+            fd.close()
+
+    def test_rock_ridge(self):
+        tree = { 'boot': { 'vmlinuz': "lower", 'VMLINUZ': "upper" } }
+        build_iso(self.path, tree, rock_ridge = True)
+        iso = eliloader.IsoImage(self.path)
+        self.assertTrue(iso.rock_ridge)
+        # exact names win over case-insensitive matches
+        self.assertEqual(self.read(iso, "/boot/vmlinuz"), "lower")
+        self.assertEqual(self.read(iso, "/boot/VMLINUZ"), "upper")
+
+    def test_joliet(self):
+        tree = { 'isolinux': { 'vmlinuz-3.10.0': KERNEL } }
+        build_iso(self.path, tree, joliet = True)
+        iso = eliloader.IsoImage(self.path)
+        self.assertNotEqual(iso.joliet_root, None)
+        self.assertEqual(self.read(iso, "/isolinux/vmlinuz-3.10.0"), KERNEL)
+
+    def test_el_torito(self):
+        build_iso(self.path, TREE, catalog = 19)
+        self.assertEqual(eliloader.IsoImage(self.path).boot_catalog, 19)
+
+    def test_lookup_errors(self):
+        build_iso(self.path, TREE)
+        iso = eliloader.IsoImage(self.path)
+        self.assertRaises(eliloader.IsoError, iso.lookup, "/images/pxeboot/missing")
+        self.assertRaises(eliloader.IsoError, iso.lookup, "/images")
+        self.assertRaises(eliloader.IsoError, iso.lookup, "/readme/vmlinuz")
+
+    def test_not_iso(self):
+        f = open(self.path, "wb")
+        f.write("\0" * 20 * SECTOR)
+        f.close()
+        self.assertRaises(eliloader.IsoError, eliloader.IsoImage, self.path)
+        f = open(self.path, "wb")
+        f.write("\0" * SECTOR)
+        f.close()
+        self.assertRaises(eliloader.IsoError, eliloader.IsoImage, self.path)
+
+    def test_urlopen(self):
+        build_iso(self.path, TREE)
+        url = eliloader.iso_repo_url(self.path)
+        try:
+            fd = eliloader.urlopen(url + "images/pxeboot/vmlinuz")
+            try:
+                self.assertEqual(fd.read(), KERNEL)
+            finally:
+                fd.close()
+            self.assertRaises(IOError, eliloader.urlopen, url + "missing")
+        finally:
+            del eliloader.iso_images[self.path]
+
+class DamagedIsoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.path = os.path.join(self.dir, "image.iso")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def patch(self, find, offset, value):
+        data = bytearray(open(self.path, "rb").read())
+        pos = data.find(find)
+        self.assertTrue(pos > 0)
+        data[pos + offset] = value
+        open(self.path, "wb").write(data)
+
+    def test_overlong_record(self):
+        build_iso(self.path, TREE)
+        # the length of the record naming VMLINUZ
+        self.patch("VMLINUZ.;1", -33, 255)
+        iso = eliloader.IsoImage(self.path)
+        self.assertRaises(eliloader.IsoError, iso.lookup, "/images/pxeboot/vmlinuz")
+
+    def test_bad_name_length(self):
+        build_iso(self.path, TREE)
+        self.patch("VMLINUZ.;1", -1, 200)
+        iso = eliloader.IsoImage(self.path)
+        self.assertRaises(eliloader.IsoError, iso.lookup, "/images/pxeboot/vmlinuz")
+
+    def test_bad_joliet_name(self):
+        build_iso(self.path, { 'vmlinuz': KERNEL }, joliet = True)
+        # an odd number of bytes can't be UTF-16
+        self.patch(joliet_name("vmlinuz", False), -1, 15)
+        iso = eliloader.IsoImage(self.path)
+        self.assertRaises(eliloader.IsoError, iso.lookup, "/vmlinuz")
+        url = eliloader.iso_repo_url(self.path)
+        try:
+            self.assertFalse(eliloader.checkFile(url + "vmlinuz"))
+            self.assertRaises(IOError, eliloader.urlopen, url + "vmlinuz")
+        finally:
+            del eliloader.iso_images[self.path]
+
+class FakeCdromRepo:
+    def __init__(self, img):
+        self.mntpoint = "/mnt/" + os.path.basename(img)
+
+class CdromFallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.path = os.path.join(self.dir, "image.iso")
+        build_iso(self.path, TREE)
+        self.saved = eliloader.rhel_first_boot_handler, eliloader.CdromRepo
+        eliloader.CdromRepo = FakeCdromRepo
+        self.urls = []
+
+    def tearDown(self):
+        eliloader.rhel_first_boot_handler, eliloader.CdromRepo = self.saved
+        eliloader.iso_images.pop(self.path, None)
+        shutil.rmtree(self.dir)
+
+    def fetch(self):
+        return eliloader.fetch_first_boot("vm", self.path,
+                                          { 'install-distro': 'rhlike',
+                                            'install-repository': 'cdrom' })
+
+    def test_read_without_mounting(self):
+        def handler(vm, repo_url, other_config):
+            self.urls.append(repo_url)
+            return "kernel", "ramdisk"
+        eliloader.rhel_first_boot_handler = handler
+        self.assertEqual(self.fetch(), ("kernel", "ramdisk"))
+        self.assertEqual(self.urls, ["iso:%s!/" % self.path])
+
+    def test_mount_when_reading_fails(self):
+        def handler(vm, repo_url, other_config):
+            self.urls.append(repo_url)
+            if repo_url.startswith("iso:"):
+                raise eliloader.ResourceAccessError(repo_url + "images/pxeboot/vmlinuz")
+            return "kernel", "ramdisk"
+        eliloader.rhel_first_boot_handler = handler
+        self.assertEqual(self.fetch(), ("kernel", "ramdisk"))
+        self.assertEqual(self.urls, ["iso:%s!/" % self.path, "file:///mnt/image.iso/"])
+
+if __name__ == "__main__":
+    unittest.main()
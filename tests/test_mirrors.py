@@ -0,0 +1,143 @@
+import BaseHTTPServer
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answer with the server's status and name, after its delay. """
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.delay)
+        self.send_response(self.server.code)
+        self.send_header("Content-Length", str(len(self.server.name)))
+        self.end_headers()
+        self.wfile.write(self.server.name)
+    def log_message(self, *args):
+        pass
+
+def start_mirror(name, delay = 0, code = 200):
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), MirrorHandler)
+    server.name = name
+    server.delay = delay
+    server.code = code
+    server.requests = 0
+    server.url = "http://127.0.0.1:%d/%s/" % (server.server_address[1], name)
+    t = threading.Thread(target = server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server
+
+class MirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = (eliloader.REPO_HOSTS, eliloader.REPO_ABSENT, eliloader.MIRROR_STATS,
+                      eliloader.hedge_delay_default, eliloader.fetch_context.mirrors)
+        eliloader.REPO_HOSTS = os.path.join(self.dir, "repo-hosts")
+        eliloader.REPO_ABSENT = os.path.join(self.dir, "repo-absent")
+        eliloader.MIRROR_STATS = os.path.join(self.dir, "mirror-stats")
+        eliloader.hedge_delay_default = 0.2
+        eliloader.fetch_context.mirrors = {}
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        (eliloader.REPO_HOSTS, eliloader.REPO_ABSENT, eliloader.MIRROR_STATS,
+         eliloader.hedge_delay_default, eliloader.fetch_context.mirrors) = self.saved
+        shutil.rmtree(self.dir)
+
+    def mirror(self, *args, **kwargs):
+        server = start_mirror(*args, **kwargs)
+        self.servers.append(server)
+        return server
+
+    def open(self, source):
+        fd = eliloader.hedged_urlopen(eliloader.mirror_candidates(source), None)
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+
+    def test_ranking(self):
+        repo = "http://repo.example.com/os/"
+        eliloader.register_mirrors(repo, ["http://a.example.com/os",
+                                          "ftp://b.example.com/os/",
+                                          "nfs:c.example.com:/os/"])
+        # nothing known: the order given
+        self.assertEqual(eliloader.mirror_candidates(repo + "images/vmlinuz"),
+                         [(repo, repo + "images/vmlinuz"),
+                          ("http://a.example.com/os/", "http://a.example.com/os/images/vmlinuz"),
+                          ("ftp://b.example.com/os/", "ftp://b.example.com/os/images/vmlinuz")])
+        eliloader.record_mirror(repo, ttfb = 0.5, throughput = 1024 * 1024)
+        eliloader.record_mirror("ftp://b.example.com/os/", ttfb = 0.1,
+                                throughput = 50 * 1024 * 1024)
+        eliloader.record_mirror("http://a.example.com/os/", ttfb = 0.05,
+                                throughput = 50 * 1024 * 1024)
+        eliloader.record_mirror("http://a.example.com/os/", failed = True)
+        self.assertEqual([m for m, _ in eliloader.mirror_candidates(repo + "x")],
+                         ["ftp://b.example.com/os/", "http://a.example.com/os/", repo])
+        # sources from elsewhere are left alone
+        self.assertEqual(eliloader.mirror_candidates("http://other/x"), [(None, "http://other/x")])
+
+    def test_hedge_slow_mirror(self):
+        slow = self.mirror("slow", delay = 2)
+        fast = self.mirror("fast")
+        eliloader.register_mirrors(slow.url, [fast.url])
+        start = time.time()
+        self.assertEqual(self.open(slow.url + "vmlinuz"), "fast")
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertEqual((slow.requests, fast.requests), (1, 1))
+        stats = eliloader.read_mirror_stats()
+        # the slow mirror is charged at least the time we waited for it
+        self.assertTrue(stats[slow.url][0] >= 0.2)
+        self.assertTrue(stats[fast.url][0] < stats[slow.url][0])
+        # so the next run starts with the fast one, and doesn't hedge
+        self.assertEqual(eliloader.mirror_candidates(slow.url + "vmlinuz")[0][0], fast.url)
+        self.assertEqual(self.open(slow.url + "vmlinuz"), "fast")
+        self.assertEqual(slow.requests, 1)
+
+    def test_no_hedge_when_prompt(self):
+        first = self.mirror("first")
+        second = self.mirror("second")
+        eliloader.register_mirrors(first.url, [second.url])
+        self.assertEqual(self.open(first.url + "vmlinuz"), "first")
+        self.assertEqual(second.requests, 0)
+
+    def test_failover(self):
+        broken = self.mirror("broken", code = 503)
+        good = self.mirror("good")
+        eliloader.register_mirrors(broken.url, [good.url])
+        self.assertEqual(self.open(broken.url + "vmlinuz"), "good")
+        self.assertEqual(eliloader.read_mirror_stats()[broken.url][2], 1)
+
+    def test_absent_not_hedged(self):
+        # a mirror without the file means the others don't have it either
+        first = self.mirror("first", code = 404)
+        second = self.mirror("second")
+        eliloader.register_mirrors(first.url, [second.url])
+        try:
+            self.open(first.url + "vmlinuz")
+            self.fail("expected a 404")
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 404)
+        self.assertEqual(second.requests, 0)
+
+    def test_all_fail(self):
+        a = self.mirror("a", code = 500)
+        b = self.mirror("b", code = 502)
+        eliloader.register_mirrors(a.url, [b.url])
+        self.assertRaises(urllib2.HTTPError, self.open, a.url + "vmlinuz")
+        self.assertEqual((a.requests, b.requests), (1, 1))
+
+if __name__ == "__main__":
+    unittest.main()
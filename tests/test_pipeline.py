@@ -0,0 +1,134 @@
+import gzip
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+def newc(files):
+    """ A newc cpio archive of files, a dictionary mapping names to
+    contents. """
+    def pad(data):
+        return data + "\0" * (-len(data) % 4)
+    out = []
+    entries = sorted(files.items()) + [("TRAILER!!!", "")]
+    for ino, (name, data) in enumerate(entries):
+        mode = name != "TRAILER!!!" and 0100644 or 0
+        fields = [ino + 1, mode, 0, 0, 1, 0, len(data), 0, 0, 0, 0, len(name) + 1, 0]
+        out.append(pad("070701" + "".join(["%08x" % f for f in fields]) + name + "\0"))
+        out.append(pad(data))
+    return "".join(out)
+
+def config(pipeline, compression = 'none'):
+    return eliloader.BootConfig({ 'install-initrd-pipeline': pipeline,
+                                  'install-initrd-compression': compression },
+                                initrd_max_size = 1 << 20)
+
+class UnpackerChoiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = (eliloader.TWEAKED_CACHE, eliloader.guest_installer_dir,
+                      eliloader.cpio_initrd_fixups)
+        eliloader.TWEAKED_CACHE = os.path.join(self.dir, "tweaked")
+        eliloader.guest_installer_dir = self.dir
+        eliloader.cpio_initrd_fixups = { "a" * 32: "overlay.cpio" }
+        self.overlay = os.path.join(self.dir, "overlay.cpio")
+        open(self.overlay, "w").close()
+
+    def tearDown(self):
+        (eliloader.TWEAKED_CACHE, eliloader.guest_installer_dir,
+         eliloader.cpio_initrd_fixups) = self.saved
+        shutil.rmtree(self.dir)
+
+    def choice(self, expected, pipeline):
+        unpacker = eliloader.initrd_unpacker(expected, config(pipeline))
+        if unpacker is None:
+            return None
+        return unpacker.__class__.__name__
+
+    def test_settings(self):
+        known = ('md5', "a" * 32)
+        unknown = ('md5', "b" * 32)
+        self.assertEqual(self.choice(known, 'false'), None)
+        self.assertEqual(self.choice(None, 'true'), "StreamingUnpacker")
+        self.assertEqual(self.choice(known, 'auto'), "StreamingUnpacker")
+        # only worth it if the repository tells us we'll need it
+        self.assertEqual(self.choice(unknown, 'auto'), None)
+        self.assertEqual(self.choice(None, 'auto'), None)
+        self.assertEqual(self.choice(('sha256', "a" * 32), 'auto'), None)
+
+    def test_no_fixups(self):
+        eliloader.cpio_initrd_fixups = {}
+        self.assertEqual(self.choice(None, 'true'), None)
+
+    def test_already_tweaked(self):
+        key = eliloader.tweaked_key("a" * 32, 'none', self.overlay)
+        built = os.path.join(self.dir, "built")
+        open(built, "w").write("tweaked")
+        eliloader.publish_tweaked(key, built, "a" * 32, 'none')
+        self.assertEqual(self.choice(('md5', "a" * 32), 'true'), None)
+
+class StreamingUnpackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fetch(self, data, unpacker):
+        src = os.path.join(self.dir, "initrd")
+        f = open(src, "wb")
+        f.write(data)
+        f.close()
+        dest = os.path.join(self.dir, "dest")
+        digest = eliloader.fetchFile("file://" + src, dest, 1 << 20, sink = unpacker)
+        self.assertEqual(digest, hashlib.md5(data).hexdigest())
+        self.assertEqual(open(dest).read(), data)
+
+    def test_not_cpio(self):
+        # e.g. an ext2 image: left for tweak_initrd, nothing started
+        unpacker = eliloader.StreamingUnpacker()
+        self.fetch("\0" * 4096, unpacker)
+        self.assertTrue(unpacker.failed)
+        self.assertFalse(unpacker.complete)
+        self.assertEqual(unpacker.procs, [])
+        working_dir = unpacker.working_dir
+        unpacker.abort()
+        self.assertFalse(os.path.exists(working_dir))
+
+    def gzipped(self, data):
+        path = os.path.join(self.dir, "gz")
+        f = gzip.open(path, "wb")
+        f.write(data)
+        f.close()
+        return open(path, "rb").read()
+
+    @unittest.skipUnless(os.path.exists("/bin/cpio"), "needs cpio")
+    def test_unpacked_while_fetching(self):
+        files = { "init": "#!/bin/sh\n", "etc-release": "x" * 10000 }
+        for data in [newc(files), self.gzipped(newc(files))]:
+            unpacker = eliloader.StreamingUnpacker()
+            self.fetch(data, unpacker)
+            self.assertTrue(unpacker.complete)
+            working_dir = unpacker.claim()
+            try:
+                for name, content in files.items():
+                    self.assertEqual(open(os.path.join(working_dir, name)).read(), content)
+            finally:
+                shutil.rmtree(working_dir)
+
+    @unittest.skipUnless(os.path.exists("/bin/cpio"), "needs cpio")
+    def test_too_large(self):
+        unpacker = eliloader.StreamingUnpacker(limit = 1000)
+        self.fetch(self.gzipped(newc({ "big": "x" * 10000 })), unpacker)
+        self.assertFalse(unpacker.complete)
+        unpacker.abort()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+VENDOR = "vendor initrd" * 100
+DIGEST = hashlib.md5(VENDOR).hexdigest()
+
+class PrebuildTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = (eliloader.PREBUILD_STATE, eliloader.TWEAKED_CACHE, eliloader.BOOTDIR,
+                      eliloader.guest_installer_dir, eliloader.mapfiles,
+                      eliloader.cpio_initrd_fixups, eliloader.artefact_cache_tiers[:])
+        eliloader.PREBUILD_STATE = os.path.join(self.dir, "prebuilt")
+        eliloader.TWEAKED_CACHE = os.path.join(self.dir, "tweaked")
+        eliloader.BOOTDIR = os.path.join(self.dir, "boot")
+        eliloader.guest_installer_dir = self.dir
+        eliloader.mapfiles = ["test.map"]
+        eliloader.cpio_initrd_fixups = { DIGEST: "overlay.cpio" }
+        eliloader.artefact_cache_tiers[:] = [os.path.join(self.dir, "artefacts")]
+        self.map = self.write("test.map", "%s overlay.cpio\n" % DIGEST)
+        self.overlay = self.write("overlay.cpio", "overlay")
+
+    def tearDown(self):
+        (eliloader.PREBUILD_STATE, eliloader.TWEAKED_CACHE, eliloader.BOOTDIR,
+         eliloader.guest_installer_dir, eliloader.mapfiles,
+         eliloader.cpio_initrd_fixups, eliloader.artefact_cache_tiers[:]) = self.saved
+        eliloader.verified_digests.clear()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        return path
+
+    def test_needed_when_maps_change(self):
+        self.assertTrue(eliloader.prebuild_needed())
+        self.publish('none')
+        eliloader.prebuild([], [])
+        self.assertFalse(eliloader.prebuild_needed())
+        os.utime(self.map, (0, 0))
+        self.assertTrue(eliloader.prebuild_needed())
+
+    def publish(self, compression):
+        key = eliloader.tweaked_key(DIGEST, compression, self.overlay)
+        built = self.write("built-" + compression, "tweaked")
+        eliloader.publish_tweaked(key, built, DIGEST, compression)
+
+    def test_find_vendor_initrds(self):
+        media = self.write("media/images/pxeboot/initrd.img", VENDOR)
+        self.write("media/images/pxeboot/vmlinuz", VENDOR)
+        self.write("media/images/other.img", "not wanted")
+        wanted = { DIGEST: None }
+        self.assertEqual(eliloader.find_vendor_initrds(wanted, [os.path.join(self.dir, "media")]),
+                         { DIGEST: media })
+        self.assertEqual(eliloader.find_vendor_initrds(wanted, [media]), { DIGEST: media })
+        self.assertEqual(eliloader.find_vendor_initrds(wanted, []), {})
+
+        # and from the artefact cache, by the MD5 recorded when it was fetched
+        tier = eliloader.artefact_cache_tiers[0]
+        key = eliloader.artefact_key("http://repo/images/pxeboot/initrd.img")
+        eliloader.publish_artefact(tier, key, media, { 'size': str(len(VENDOR)),
+                                                       'md5': DIGEST })
+        self.assertEqual(eliloader.find_vendor_initrds(wanted, []),
+                         { DIGEST: eliloader.entry_path(tier, key) })
+
+    def test_only_missing_built(self):
+        built = []
+        saved = eliloader.tweak_initrd
+        def tweak_initrd(src, compression):
+            built.append(compression)
+            return self.write("boot/tweaked-" + compression, "tweaked")
+        eliloader.tweak_initrd = tweak_initrd
+        try:
+            self.write("media/initrd.img", VENDOR)
+            self.publish('none')
+            self.publish('gzip')
+            eliloader.prebuild([os.path.join(self.dir, "media")], ['xz'])
+        finally:
+            eliloader.tweak_initrd = saved
+        # with the compressions used before, and those asked for
+        self.assertEqual(built, ['xz'])
+        self.assertEqual(os.listdir(eliloader.BOOTDIR), [])
+
+if __name__ == "__main__":
+    unittest.main()
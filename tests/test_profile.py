@@ -0,0 +1,76 @@
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+VM = "6b1bd2b4-8e4f-4a31-9a3c-5f3c0d1c2e7a"
+
+class Leaked(object):
+    pass
+
+def work():
+    return [Leaked() for _ in range(1000)]
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = (eliloader.DEBUG_SWITCH, eliloader.PROFILE_DIR,
+                      eliloader.profile_runs, eliloader.profile_vms)
+        eliloader.DEBUG_SWITCH = os.path.join(self.dir, "debug")
+        eliloader.PROFILE_DIR = os.path.join(self.dir, "profiles")
+
+    def tearDown(self):
+        eliloader.finish_profile()
+        (eliloader.DEBUG_SWITCH, eliloader.PROFILE_DIR,
+         eliloader.profile_runs, eliloader.profile_vms) = self.saved
+        shutil.rmtree(self.dir)
+
+    def profile(self, vm, phase):
+        eliloader.start_profile(vm, phase)
+        kept = work()
+        eliloader.finish_profile()
+        return kept
+
+    def runs(self, vm):
+        return sorted(os.listdir(os.path.join(eliloader.PROFILE_DIR, vm)))
+
+    def test_off_without_switch(self):
+        self.profile(VM, "round1")
+        self.assertEqual(eliloader.active_profile, None)
+        self.assertFalse(os.path.exists(eliloader.PROFILE_DIR))
+
+    def test_profile_written(self):
+        open(eliloader.DEBUG_SWITCH, "w").close()
+        self.profile(VM, "round1")
+        files = self.runs(VM)
+        self.assertEqual([os.path.splitext(f)[1] for f in files], [".alloc", ".prof"])
+        self.assertTrue(files[0].endswith("-%d-round1.alloc" % os.getpid()))
+        prefix = os.path.join(eliloader.PROFILE_DIR, VM, os.path.splitext(files[0])[0])
+        stats = pstats.Stats(prefix + ".prof")
+        self.assertTrue([f for f in stats.stats.keys() if f[2] == "work"])
+        alloc = open(prefix + ".alloc").read()
+        self.assertTrue(alloc.startswith("wall "))
+        self.assertTrue(" test_profile.Leaked\n" in alloc)
+
+    def test_trimmed(self):
+        open(eliloader.DEBUG_SWITCH, "w").close()
+        eliloader.profile_runs = 2
+        eliloader.profile_vms = 2
+        for phase in ["a", "b", "c"]:
+            # the run names sort by time, then by phase
+            self.profile(VM, phase)
+        self.assertEqual([f.split("-")[-1] for f in self.runs(VM)],
+                         ["b.alloc", "b.prof", "c.alloc", "c.prof"])
+        os.utime(os.path.join(eliloader.PROFILE_DIR, VM), (0, 0))
+        for vm in ["vm1", "vm2"]:
+            self.profile(vm, "round1")
+        self.assertEqual(sorted(os.listdir(eliloader.PROFILE_DIR)), ["vm1", "vm2"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import BaseHTTPServer
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answer every request with the server's current status. """
+    def do_GET(self):
+        self.server.requests += 1
+        self.send_response(self.server.code)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("ok")
+    def log_message(self, *args):
+        pass
+
+class RepoHealthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = (eliloader.REPO_HOSTS, eliloader.REPO_ABSENT,
+                      eliloader.breaker_cooldown, eliloader.absent_ttl)
+        eliloader.REPO_HOSTS = os.path.join(self.dir, "repo-hosts")
+        eliloader.REPO_ABSENT = os.path.join(self.dir, "repo-absent")
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), StatusHandler)
+        self.server.code = 200
+        self.server.requests = 0
+        self.host = "127.0.0.1:%d" % self.server.server_address[1]
+        self.url = "http://%s/os/vmlinuz" % self.host
+        t = threading.Thread(target = self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+    def tearDown(self):
+        if self.server is not None:
+            self.stop()
+        (eliloader.REPO_HOSTS, eliloader.REPO_ABSENT,
+         eliloader.breaker_cooldown, eliloader.absent_ttl) = self.saved
+        shutil.rmtree(self.dir)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+
+    def open(self, url = None):
+        fd = eliloader.open_url(url or self.url)
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+
+    def failures(self):
+        return eliloader.read_state_file(eliloader.REPO_HOSTS).get(self.host)
+
+    def test_breaker_opens_and_closes(self):
+        self.server.code = 503
+        for i in range(eliloader.breaker_threshold):
+            self.assertRaises(urllib2.HTTPError, self.open)
+        self.assertEqual(self.server.requests, eliloader.breaker_threshold)
+        self.assertTrue(eliloader.breaker_open(
+                eliloader.read_state_file(eliloader.REPO_HOSTS), self.host, time.time()))
+
+        # open: fail without asking the host
+        self.server.code = 200
+        self.assertRaises(urllib2.URLError, self.open)
+        self.assertEqual(self.server.requests, eliloader.breaker_threshold)
+
+        # cooled down: let through, and a success forgets the failures
+        eliloader.update_state_file(eliloader.REPO_HOSTS,
+                                    lambda hosts: hosts[self.host].__setitem__(2, "0"))
+        self.assertEqual(self.open(), "ok")
+        self.assertEqual(self.failures(), None)
+
+    def test_reopens_on_first_failure(self):
+        eliloader.breaker_cooldown = 0
+        self.server.code = 500
+        for i in range(eliloader.breaker_threshold):
+            self.assertRaises(urllib2.HTTPError, self.open)
+        # the cooldown is over, but the host is still failing
+        self.assertRaises(urllib2.HTTPError, self.open)
+        self.assertEqual(self.failures()[0], str(eliloader.breaker_threshold + 1))
+
+    def test_failures_outside_window(self):
+        self.server.code = 500
+        self.assertRaises(urllib2.HTTPError, self.open)
+        eliloader.update_state_file(eliloader.REPO_HOSTS,
+                                    lambda hosts: hosts[self.host].__setitem__(1, "0"))
+        self.assertRaises(urllib2.HTTPError, self.open)
+        self.assertEqual(self.failures()[0], "1")
+
+    def test_unreachable_host(self):
+        self.stop()
+        for i in range(eliloader.breaker_threshold):
+            self.assertRaises(urllib2.URLError, self.open)
+        self.assertEqual(self.failures()[0], str(eliloader.breaker_threshold))
+
+    def test_absent_remembered(self):
+        self.server.code = 404
+        self.assertRaises(urllib2.HTTPError, self.open)
+        self.assertRaises(urllib2.HTTPError, self.open)
+        self.assertEqual(self.server.requests, 1)
+        # absence isn't a failure of the host, nor of its other files
+        self.assertEqual(self.failures(), None)
+        self.server.code = 200
+        self.assertEqual(self.open(self.url + ".sig"), "ok")
+
+    def test_absent_expires(self):
+        eliloader.absent_ttl = -1
+        self.server.code = 404
+        self.assertRaises(urllib2.HTTPError, self.open)
+        self.server.code = 200
+        self.assertEqual(self.open(), "ok")
+        self.assertEqual(self.server.requests, 2)
+
+if __name__ == "__main__":
+    unittest.main()
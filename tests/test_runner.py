@@ -0,0 +1,114 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+class RunCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = eliloader.step_deadlines, eliloader.kill_grace
+        eliloader.step_deadlines = { 'test': 1 }
+        eliloader.kill_grace = 2
+
+    def tearDown(self):
+        eliloader.step_deadlines, eliloader.kill_grace = self.saved
+
+    def test_output(self):
+        self.assertEqual(eliloader.run_command(["sh", "-c", "echo out; echo err >&2; exit 3"],
+                                               'test'),
+                         (3, "out\n", "err\n"))
+        self.assertEqual(eliloader.watchdogs, [])
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertRaises(eliloader.StepTimeout, eliloader.run_command,
+                          ["sleep", "30"], 'test')
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(eliloader.watchdogs, [])
+
+    def test_timeout_kills_group(self):
+        # the shell's child holds the pipes open: unless it is killed too,
+        # communicate() waits for it
+        start = time.time()
+        self.assertRaises(eliloader.StepTimeout, eliloader.run_command,
+                          ["sh", "-c", "sleep 30; true"], 'test')
+        self.assertTrue(time.time() - start < 10)
+
+    def test_watchdog_stopped_in_time(self):
+        w = eliloader.Watchdog('test')
+        self.assertEqual(w.deadline, 1)
+        w.stop()
+        self.assertFalse(w.expired)
+        self.assertEqual(eliloader.Watchdog('unknown').deadline, eliloader.boot_deadline)
+        eliloader.watchdogs[0].cancel()
+        self.assertEqual(eliloader.watchdogs, [])
+
+class StepTest(unittest.TestCase):
+
+    def test_value(self):
+        self.assertEqual(eliloader.start_step(lambda a, b: a + b, 1, 2).result(), 3)
+
+    def test_error(self):
+        def fail():
+            raise ValueError("broken")
+        step = eliloader.start_step(fail)
+        try:
+            step.result()
+        except ValueError, e:
+            self.assertEqual(str(e), "broken")
+            # the traceback is the step's
+            tb = sys.exc_info()[2]
+            while tb.tb_next:
+                tb = tb.tb_next
+            self.assertEqual(tb.tb_frame.f_code.co_name, "fail")
+        else:
+            self.fail("no error")
+
+    def test_timeout(self):
+        step = eliloader.start_step(time.sleep, 1)
+        self.assertRaises(eliloader.StepTimeout, step.result, 0.1)
+        self.assertEqual(step.result(5), None)
+
+class BootDeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = eliloader.boot_deadline
+        eliloader.boot_deadline = 0.2
+
+    def tearDown(self):
+        eliloader.stop_boot_deadline()
+        eliloader.boot_deadline = self.saved
+        eliloader.boot_cancelled = False
+        shutil.rmtree(self.dir)
+
+    def wait(self, seconds):
+        end = time.time() + seconds
+        while time.time() < end:
+            time.sleep(0.01)
+
+    def test_interrupts(self):
+        eliloader.start_boot_deadline()
+        self.assertRaises(KeyboardInterrupt, self.wait, 5)
+        self.assertTrue(eliloader.boot_cancelled)
+
+    def test_state_file_written_whole(self):
+        path = os.path.join(self.dir, "state")
+        def update(records):
+            records['a'] = ["1"]
+            # the deadline passes while the file is being rewritten
+            self.wait(0.5)
+            records['b'] = ["2"]
+        eliloader.start_boot_deadline()
+        self.assertRaises(KeyboardInterrupt, eliloader.update_state_file, path, update)
+        self.assertEqual(eliloader.read_state_file(path), { 'a': ["1"], 'b': ["2"] })
+        self.assertEqual(eliloader.critical_depth, 0)
+        self.assertFalse(eliloader.interrupt_pending)
+
+if __name__ == "__main__":
+    unittest.main()
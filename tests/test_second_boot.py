@@ -0,0 +1,222 @@
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+# Stand-ins for pygrub's fsimage and grub.GrubConf, giving what they give:
+# GrubConfigFile turns "default" into a number (0 for "saved"), while
+# Grub2ConfigFile leaves it as the string that was set.
+
+class FakeFile:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size = 0, offset = 0):
+        if size:
+            return self.data[offset:offset + size]
+        return self.data[offset:]
+
+class FakeFs:
+    def __init__(self, files):
+        self.files = files
+
+    def file_exists(self, path):
+        return path in self.files
+
+    def open_file(self, path):
+        return FakeFile(self.files[path])
+
+class FakeImage:
+    def __init__(self, title):
+        self.title = title
+        self.kernel = None
+        self.initrd = None
+        self.args = ""
+
+class GrubConfigFile:
+    def parse(self, data):
+        self.default = 0
+        self.images = []
+        for line in data.splitlines():
+            words = line.split(None, 1)
+            if len(words) < 2:
+                continue
+            com, arg = words
+            if com == "default":
+                self.default = arg.isdigit() and int(arg) or 0
+            elif com == "title":
+                self.images.append(FakeImage(arg))
+            elif com == "kernel":
+                kernel = arg.split(None, 1)
+                self.images[-1].kernel = (None, kernel[0])
+                self.images[-1].args = kernel[1:] and kernel[1] or ""
+            elif com == "initrd":
+                self.images[-1].initrd = (None, arg)
+
+class Grub2ConfigFile:
+    def parse(self, data):
+        self.default = "0"
+        self.images = []
+        for line in data.splitlines():
+            line = line.strip()
+            m = re.match(r'set default="(.*)"', line)
+            if m:
+                self.default = m.group(1)
+            m = re.match(r"menuentry '([^']*)'", line)
+            if m:
+                self.images.append(FakeImage(m.group(1)))
+            words = line.split(None, 2)
+            if words and words[0] == "linux":
+                self.images[-1].kernel = (None, words[1])
+                self.images[-1].args = words[2:] and words[2] or ""
+            elif words and words[0] == "initrd":
+                self.images[-1].initrd = (None, words[1])
+
+class FakeGrubConf:
+    GrubConfigFile = GrubConfigFile
+    Grub2ConfigFile = Grub2ConfigFile
+
+class FakeGrub:
+    GrubConf = FakeGrubConf
+
+MENU_LST = """default %s
+title CentOS (2.6.32-754)
+    kernel /vmlinuz-754 ro root=/dev/xvda2
+    initrd /initrd-754.img
+title CentOS (2.6.32-696)
+    kernel /vmlinuz-696 ro root=/dev/xvda2
+    initrd /initrd-696.img
+"""
+
+GRUB_CFG = """set default="%s"
+menuentry 'CentOS Linux (3.10.0-1160)' {
+    linux /vmlinuz-1160 ro root=/dev/xvda2
+    initrd /initramfs-1160.img
+}
+submenu 'Advanced options' {
+    menuentry 'CentOS Linux (3.10.0-957)' {
+        linux /vmlinuz-957 ro root=/dev/xvda2
+        initrd /initramfs-957.img
+    }
+}
+"""
+
+class ReadEntryTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = eliloader.fsimage, eliloader.grub, eliloader.partition_offsets
+        self.files = {}
+        files = self.files
+        class FakeFsimage:
+            @staticmethod
+            def open(img, offset):
+                return FakeFs(files)
+        eliloader.fsimage = FakeFsimage
+        eliloader.grub = FakeGrub
+        eliloader.partition_offsets = lambda img: [0]
+
+    def tearDown(self):
+        eliloader.fsimage, eliloader.grub, eliloader.partition_offsets = self.saved
+
+    def entry(self, path, config):
+        self.files.clear()
+        self.files[path] = config
+        for name in ["754", "696", "1160", "957"]:
+            self.files["/vmlinuz-" + name] = "kernel"
+            self.files["/initrd-%s.img" % name] = "initrd"
+            self.files["/initramfs-%s.img" % name] = "initrd"
+        return eliloader.read_installed_entry("disk")
+
+    def test_menu_lst(self):
+        for default, kernel in [("0", "/vmlinuz-754"), ("1", "/vmlinuz-696"),
+                                ("saved", "/vmlinuz-754"), ("5", "/vmlinuz-754")]:
+            entry = self.entry("/boot/grub/menu.lst", MENU_LST % default)
+            self.assertEqual(entry['kernel'], kernel)
+        self.assertEqual(entry['initrd'], "/initrd-754.img")
+        self.assertEqual(entry['args'], "ro root=/dev/xvda2")
+
+    def test_grub2(self):
+        for default, kernel in [("0", "/vmlinuz-1160"), ("1", "/vmlinuz-957"),
+                                ("CentOS Linux (3.10.0-957)", "/vmlinuz-957"),
+                                ("Advanced options>CentOS Linux (3.10.0-957)", "/vmlinuz-957"),
+                                ("${saved_entry}", "/vmlinuz-1160"),
+                                ("Fedora", "/vmlinuz-1160"), ("7", "/vmlinuz-1160")]:
+            entry = self.entry("/boot/grub2/grub.cfg", GRUB_CFG % default)
+            self.assertEqual(entry['kernel'], kernel, default)
+        self.assertEqual(entry['titles'], ['CentOS Linux (3.10.0-1160)',
+                                           'CentOS Linux (3.10.0-957)'])
+
+    def test_no_entries(self):
+        self.assertEqual(self.entry("/grub/menu.lst", "default 0\n"), None)
+
+    def test_missing_kernel(self):
+        self.files.clear()
+        self.files["/grub/menu.lst"] = MENU_LST % 0
+        self.assertEqual(eliloader.read_installed_entry("disk"), None)
+
+class FingerprintTest(unittest.TestCase):
+    def setUp(self):
+        self.head_size = eliloader.fingerprint_head_size
+        eliloader.fingerprint_head_size = 4
+        self.files = {"/vmlinuz": "KERNEL-1", "/initrd": "INITRD"}
+        self.entry = { 'fs': FakeFs(self.files), 'config': "cfg",
+                       'kernel': "/vmlinuz", 'initrd': "/initrd" }
+
+    def tearDown(self):
+        eliloader.fingerprint_head_size = self.head_size
+
+    def fingerprint(self):
+        return eliloader.entry_fingerprint(self.entry, [
+                ("kernel", "/vmlinuz", 1 << 20, "vmlinuz-"),
+                ("ramdisk", "/initrd", 1 << 20, "ramdisk-")])
+
+    def test_size_change(self):
+        before = self.fingerprint()
+        self.assertEqual(self.fingerprint(), before)
+        self.files["/vmlinuz"] = "KERNEL-10"
+        self.assertNotEqual(self.fingerprint(), before)
+
+    def test_head_change(self):
+        before = self.fingerprint()
+        self.files["/initrd"] = "initrd"
+        self.assertNotEqual(self.fingerprint(), before)
+
+class ExtractTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = eliloader.BOOTDIR, eliloader.SECOND_BOOT_CACHE, eliloader.fingerprint_head_size
+        eliloader.BOOTDIR = os.path.join(self.tmp, "boot")
+        eliloader.SECOND_BOOT_CACHE = os.path.join(self.tmp, "cache")
+        eliloader.fingerprint_head_size = 4
+        os.mkdir(eliloader.BOOTDIR)
+        self.files = {"/vmlinuz": "KERNEL-1", "/initrd": "INITRD"}
+        self.entry = { 'fs': FakeFs(self.files), 'config': "cfg",
+                       'kernel': "/vmlinuz", 'initrd': "/initrd" }
+        self.other_config = eliloader.BootConfig({}, kernel_max_size = 1 << 20,
+                                                   initrd_max_size = 1 << 20)
+
+    def tearDown(self):
+        eliloader.BOOTDIR, eliloader.SECOND_BOOT_CACHE, eliloader.fingerprint_head_size = self.saved
+        shutil.rmtree(self.tmp)
+
+    def extract(self):
+        kernel, ramdisk = eliloader.extract_entry("vm", self.entry, self.other_config)
+        try:
+            return open(kernel).read(), open(ramdisk).read()
+        finally:
+            os.unlink(kernel)
+            os.unlink(ramdisk)
+
+    def test_in_place_update(self):
+        self.assertEqual(self.extract(), ("KERNEL-1", "INITRD"))
+        self.assertEqual(self.extract(), ("KERNEL-1", "INITRD"))
+        # same first bytes, different size: not the cached copy
+        self.files["/vmlinuz"] = "KERNEL-12"
+        self.assertEqual(self.extract(), ("KERNEL-12", "INITRD"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import eliloader
+
+VENDOR = "vendor initrd" * 100
+DIGEST = hashlib.md5(VENDOR).hexdigest()
+
+class CompressionSettingTest(unittest.TestCase):
+
+    def test_none(self):
+        self.assertEqual(eliloader.get_compressor('none'), None)
+
+    def test_levels(self):
+        self.assertEqual(eliloader.get_compressor('gzip:9:1'), ["/bin/gzip", "-c", "-9"])
+        self.assertEqual(eliloader.get_compressor('gzip::1'), ["/bin/gzip", "-c"])
+        # the kernel can only check CRC32s
+        self.assertEqual(eliloader.get_compressor('xz:6:1'),
+                         [eliloader.XZ, "-c", "--check=crc32", "--threads=1", "-6"])
+
+    def test_unsupported(self):
+        for bad in ['bzip2', 'gzip:10', 'gzip:-1', 'gzip:x', 'xz:1:-2', 'gzip:1:1:1', '']:
+            self.assertRaises(eliloader.UnsupportedInstallMethod,
+                              eliloader.get_compressor, bad)
+
+class TweakedCacheTest(unittest.TestCase):
+    """ Tweaked initrds are kept per vendor initrd, compression and overlay,
+    and reused without unpacking anything. """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "lgl-test-")
+        self.saved = (eliloader.TWEAKED_CACHE, eliloader.BOOTDIR,
+                      eliloader.guest_installer_dir, eliloader.cpio_initrd_fixups)
+        eliloader.TWEAKED_CACHE = os.path.join(self.dir, "tweaked")
+        eliloader.BOOTDIR = os.path.join(self.dir, "boot")
+        eliloader.guest_installer_dir = self.dir
+        eliloader.cpio_initrd_fixups = { DIGEST: "overlay.cpio" }
+        os.mkdir(eliloader.BOOTDIR)
+        self.overlay = self.write("overlay.cpio", "overlay")
+        self.vendor = self.write("vendor", VENDOR)
+
+    def tearDown(self):
+        (eliloader.TWEAKED_CACHE, eliloader.BOOTDIR,
+         eliloader.guest_installer_dir, eliloader.cpio_initrd_fixups) = self.saved
+        eliloader.verified_digests.clear()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        return path
+
+    def publish(self, compression, data):
+        key = eliloader.tweaked_key(DIGEST, compression, self.overlay)
+        eliloader.publish_tweaked(key, self.write("built-" + compression, data),
+                                  DIGEST, compression)
+
+    def test_key(self):
+        key = eliloader.tweaked_key(DIGEST, 'gzip', self.overlay)
+        self.assertEqual(eliloader.tweaked_key(DIGEST, 'gzip', self.overlay), key)
+        self.assertNotEqual(eliloader.tweaked_key(DIGEST, 'xz', self.overlay), key)
+        self.assertNotEqual(eliloader.tweaked_key("0" * 32, 'gzip', self.overlay), key)
+        os.utime(self.overlay, (0, 0))
+        self.assertNotEqual(eliloader.tweaked_key(DIGEST, 'gzip', self.overlay), key)
+        self.assertEqual(eliloader.tweaked_key(DIGEST, 'gzip', self.overlay + "x"), None)
+
+    def test_reused(self):
+        self.publish('gzip:9', "tweaked, gzipped")
+        self.publish('none', "tweaked")
+        eliloader.remember_digest(self.vendor, DIGEST)
+        path = eliloader.tweak_initrd(self.vendor, 'gzip:9')
+        self.assertEqual(os.path.dirname(path), eliloader.BOOTDIR)
+        self.assertEqual(open(path).read(), "tweaked, gzipped")
+        path = eliloader.tweak_initrd(self.vendor, 'none')
+        self.assertEqual(open(path).read(), "tweaked")
+        self.assertEqual(eliloader.used_compressions(), set(['gzip:9', 'none']))
+
+    def test_damaged_entry(self):
+        self.publish('none', "tweaked")
+        key = eliloader.tweaked_key(DIGEST, 'none', self.overlay)
+        self.write(os.path.join("tweaked", eliloader.entry_path("", key)), "short")
+        self.assertEqual(eliloader.find_tweaked(key), None)
+        self.assertEqual(eliloader.reuse_tweaked(key), None)
+
+    def test_untouched(self):
+        # initrds without fixups are used as they are
+        other = self.write("other", "other initrd")
+        self.assertEqual(eliloader.tweak_initrd(other, 'gzip'), None)
+
+if __name__ == "__main__":
+    unittest.main()